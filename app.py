@@ -1,4 +1,5 @@
 import os
+import sys
 import logging
 from datetime import datetime
 from flask import Flask, request
@@ -23,10 +24,15 @@ except Exception as e:
     logger = logging.getLogger(__name__)
     logger.warning(f"Using fallback logging configuration due to: {e}")
 
+# Bu skriptlar app ni faqat DB uchun import qiladi - bot polling ishga tushirilmaydi
+BOT_MANAGER_SKIP_SCRIPTS = ('migrations.py', 'add_indices.py', 'celery_worker.py')
+
 class Base(DeclarativeBase):
     pass
 
-db = SQLAlchemy(model_class=Base)
+# O'qish/yozish marshrutlash sessiyasi (DATABASE_READ_URL berilsa - replika)
+from db_routing import RoutingSession, configure_read_replica, replica_engine_options
+db = SQLAlchemy(model_class=Base, session_options={'class_': RoutingSession})
 login_manager = LoginManager()
 
 # Create the app
@@ -151,6 +157,19 @@ if database_url and not database_url.startswith('sqlite'):
         
         app.config["SQLALCHEMY_DATABASE_URI"] = result
         
+        # Optional read replica - dashboard, eksport va hisobotlar uchun
+        database_read_url = os.environ.get("DATABASE_READ_URL")
+        if database_read_url:
+            logger.info("🔌 Testing read replica connection...")
+            replica_success, replica_result = test_database_connection(database_read_url, timeout=10)
+            if replica_success:
+                configure_read_replica(
+                    app, replica_result, replica_engine_options(app.config["SQLALCHEMY_ENGINE_OPTIONS"])
+                )
+                logger.info("📖 Read replica configured - read-only workloads will use DATABASE_READ_URL")
+            else:
+                logger.warning(f"⚠️ Read replica unavailable ({replica_result}) - all queries use the primary")
+        
     else:
         # PostgreSQL connection failed - fall back to SQLite
         logger.warning(f"❌ PostgreSQL connection failed: {result}")
@@ -178,6 +197,10 @@ app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
 
 # Initialize extensions
 db.init_app(app)
+
+# SQL so'rovlar soni / N+1 monitoringi (request va bot handler scope lari)
+from query_monitor import install_query_monitor
+install_query_monitor(app)
 login_manager.init_app(app)
 login_manager.login_view = 'auth.login'  # type: ignore
 login_manager.login_message = 'Iltimos, tizimga kiring.'
@@ -225,6 +248,14 @@ with app.app_context():
                 raise ValueError(f"Production deployment requires: {', '.join(missing_vars)}")
         
         db.create_all()
+        
+        # Versiyalangan migratsiyalar (mavjud jadvallar uchun indekslar va h.k.) - odatda deploy bosqichida
+        # `python migrations.py` bilan; AUTO_MIGRATE=1 faqat lokal / bitta instansiya uchun
+        if os.environ.get('AUTO_MIGRATE', '0') == '1':
+            from migrations import run_migrations
+            applied = run_migrations()
+            if applied:
+                logger.info(f"Applied migrations: {', '.join(applied)}")
         logger.info("Database schema up to date")
         
         # Create admin user only if environment variables are provided (for initial setup)
@@ -272,30 +303,36 @@ with app.app_context():
                 raise
     
     # Initialize Bot Manager - Start all active bots polling in background
-    try:
-        logger.info("🤖 Initializing BotFactory AI Bot Manager...")
-        from bot_manager import initialize_bot_manager
+    # (migratsiya / release bosqichi va Celery workerlar botlarni poll qilmaydi - aks holda
+    # ishlayotgan web instansiya bilan parallel getUpdates: Telegram 409 va takroriy javoblar)
+    main_script = os.path.basename(getattr(sys.modules.get('__main__'), '__file__', None) or '')
+    if os.environ.get('DISABLE_BOT_MANAGER', '0') == '1' or main_script in BOT_MANAGER_SKIP_SCRIPTS:
+        logger.info(f"Bot manager disabled for this process ({main_script or 'DISABLE_BOT_MANAGER=1'})")
+    else:
+        try:
+            logger.info("🤖 Initializing BotFactory AI Bot Manager...")
+            from bot_manager import initialize_bot_manager
         
-        if is_production:
-            # Production: Check API keys before initializing bot manager
-            api_keys_present = {
-                'GOOGLE_API_KEY': bool(os.environ.get('GOOGLE_API_KEY')),
-                'TELEGRAM_BOT_TOKEN': bool(os.environ.get('TELEGRAM_BOT_TOKEN'))
-            }
-            missing_apis = [k for k, v in api_keys_present.items() if not v]
-            if missing_apis:
-                logger.warning(f"⚠️ Missing API keys in production: {missing_apis}")
-                logger.warning("⚠️ Bot functionality will be limited until API keys are added to Render.com")
+            if is_production:
+                # Production: Check API keys before initializing bot manager
+                api_keys_present = {
+                    'GOOGLE_API_KEY': bool(os.environ.get('GOOGLE_API_KEY')),
+                    'TELEGRAM_BOT_TOKEN': bool(os.environ.get('TELEGRAM_BOT_TOKEN'))
+                }
+                missing_apis = [k for k, v in api_keys_present.items() if not v]
+                if missing_apis:
+                    logger.warning(f"⚠️ Missing API keys in production: {missing_apis}")
+                    logger.warning("⚠️ Bot functionality will be limited until API keys are added to Render.com")
         
-        global_bot_manager = initialize_bot_manager()
+            global_bot_manager = initialize_bot_manager()
         
-        if global_bot_manager:
-            logger.info("✅ Bot manager successfully initialized - all active bots will start polling!")
-        else:
-            logger.warning("⚠️ Bot manager initialization failed - bots will not auto-start")
+            if global_bot_manager:
+                logger.info("✅ Bot manager successfully initialized - all active bots will start polling!")
+            else:
+                logger.warning("⚠️ Bot manager initialization failed - bots will not auto-start")
             
-    except Exception as bot_manager_error:
-        logger.error(f"❌ Critical error initializing bot manager: {bot_manager_error}")
-        if is_production:
-            logger.error("🔥 PRODUCTION: Bot manager failed - check Render.com logs and environment variables")
-        logger.warning("⚠️ Application will continue without bot polling - bots will not respond to messages!")
+        except Exception as bot_manager_error:
+            logger.error(f"❌ Critical error initializing bot manager: {bot_manager_error}")
+            if is_production:
+                logger.error("🔥 PRODUCTION: Bot manager failed - check Render.com logs and environment variables")
+            logger.warning("⚠️ Application will continue without bot polling - bots will not respond to messages!")
@@ -1,15 +1,167 @@
 import os
 import io
+import hashlib
 import logging
-import tempfile
-import requests
+import threading
+import multiprocessing
 from pathlib import Path
+from typing import List, Optional
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
 import google.generativeai as genai
 from google.cloud import speech
 from ai import get_ai_response
+from media_fetcher import download_media
+from redis_cache import cached_transcript, cached_transcript_any, cache_transcripts
+
+try:
+    from pydub import AudioSegment
+    from pydub.silence import split_on_silence
+    PYDUB_AVAILABLE = True
+except ImportError:
+    PYDUB_AVAILABLE = False
+    logging.warning("pydub not available, long audio will not be split into chunks")
+
+TRANSCRIPT_CACHE_TTL = int(os.environ.get('TRANSCRIPT_CACHE_TTL', str(7 * 24 * 3600)))
+
+# Sinxron recognize 60 soniyagacha audio qabul qiladi - bo'laklar undan qisqa bo'lishi kerak
+AUDIO_CHUNK_MAX_MS = int(os.environ.get('AUDIO_CHUNK_MAX_MS', '55000'))
+AUDIO_SAMPLE_RATE = 16000
+AUDIO_TRANSCODE_WORKERS = int(os.environ.get('AUDIO_TRANSCODE_WORKERS', '2'))
+AUDIO_TRANSCRIBE_WORKERS = int(os.environ.get('AUDIO_TRANSCRIBE_WORKERS', '8'))
+# Bitta audio transkodi uchun vaqt chegarasi (soniya) - osilib qolgan ffmpeg handlerni to'xtatib qo'ymasin
+AUDIO_TRANSCODE_TIMEOUT = float(os.environ.get('AUDIO_TRANSCODE_TIMEOUT', '120'))
+# fork emas: gunicorn / Celery jarayonidagi threadlar, lock lar va DB ulanishlari child ga o'tmasin
+AUDIO_TRANSCODE_START_METHOD = os.environ.get('AUDIO_TRANSCODE_START_METHOD', 'forkserver')
 
 logger = logging.getLogger(__name__)
 
+# Kengaytma -> ffmpeg format nomi
+EXTENSION_FORMATS = {
+    '.ogg': 'ogg', '.oga': 'ogg', '.opus': 'ogg',
+    '.mp3': 'mp3', '.wav': 'wav', '.flac': 'flac',
+    '.m4a': 'mp4', '.mp4': 'mp4', '.aac': 'aac', '.amr': 'amr',
+}
+
+def probe_audio_format(content: bytes, file_extension: Optional[str] = None) -> Optional[str]:
+    """
+    Audio formatini fayl boshidagi "magic" baytlar bo'yicha aniqlash
+    
+    Returns:
+        str: ffmpeg format nomi (ogg, mp3, wav, mp4, ...) yoki None
+    """
+    header = content[:16]
+    if header.startswith(b'OggS'):
+        return 'ogg'
+    if header.startswith(b'RIFF') and header[8:12] == b'WAVE':
+        return 'wav'
+    if header.startswith(b'fLaC'):
+        return 'flac'
+    if header[4:8] == b'ftyp':
+        return 'mp4'
+    if header.startswith(b'#!AMR'):
+        return 'amr'
+    if header.startswith(b'ID3') or (len(header) > 1 and header[0] == 0xFF and header[1] & 0xE0 == 0xE0):
+        # ADTS AAC ham 0xFFF bilan boshlanadi - layer bitlari 00 bo'ladi
+        if header[0] == 0xFF and header[1] & 0xF6 == 0xF0:
+            return 'aac'
+        return 'mp3'
+    if file_extension:
+        return EXTENSION_FORMATS.get(file_extension.lower())
+    return None
+
+def transcode_and_split(content: bytes, audio_format: Optional[str] = None,
+                        max_chunk_ms: int = AUDIO_CHUNK_MAX_MS) -> List[bytes]:
+    """
+    Audio ni 16 kHz mono LINEAR16 ga o'girish va jimlik bo'yicha bo'laklash
+    (ProcessPoolExecutor da ishlaydi - CPU talab qiladigan ffmpeg/pydub ishi)
+    
+    Returns:
+        list: Har bir bo'lak uchun xom PCM baytlar (tartib saqlangan)
+    """
+    segment = AudioSegment.from_file(io.BytesIO(content), format=audio_format)
+    segment = segment.set_channels(1).set_frame_rate(AUDIO_SAMPLE_RATE).set_sample_width(2)
+    
+    if len(segment) <= max_chunk_ms:
+        return [segment.raw_data]
+    
+    # Jimlik bo'yicha bo'laklash, so'ng qisqa bo'laklarni max_chunk_ms gacha birlashtirish
+    pieces = split_on_silence(
+        segment,
+        min_silence_len=500,
+        silence_thresh=segment.dBFS - 16,
+        keep_silence=200
+    ) or [segment]
+    
+    chunks = []
+    current = None
+    for piece in pieces:
+        # Jimliksiz uzun bo'laklarni qattiq kesish
+        while len(piece) > max_chunk_ms:
+            if current is not None:
+                chunks.append(current)
+                current = None
+            chunks.append(piece[:max_chunk_ms])
+            piece = piece[max_chunk_ms:]
+        if current is None:
+            current = piece
+        elif len(current) + len(piece) <= max_chunk_ms:
+            current += piece
+        else:
+            chunks.append(current)
+            current = piece
+    if current is not None and len(current) > 0:
+        chunks.append(current)
+    
+    return [chunk.raw_data for chunk in chunks]
+
+_transcode_pool = None
+_transcribe_pool = None
+_pools_pid = None
+_pool_lock = threading.Lock()
+
+def _new_transcode_pool() -> Optional[ProcessPoolExecutor]:
+    method = AUDIO_TRANSCODE_START_METHOD
+    if method not in multiprocessing.get_all_start_methods():
+        method = 'spawn'
+    try:
+        return ProcessPoolExecutor(max_workers=AUDIO_TRANSCODE_WORKERS, mp_context=multiprocessing.get_context(method))
+    except Exception as e:
+        logger.warning(f"Process pool unavailable, transcoding in-process: {e}")
+        return None
+
+def _get_pools():
+    """Transkod (process) va transkripsiya (thread) pool lari - har bir jarayonda bir marta (fork dan keyin qayta)"""
+    global _transcode_pool, _transcribe_pool, _pools_pid
+    pid = os.getpid()
+    if _pools_pid != pid:
+        with _pool_lock:
+            if _pools_pid != pid:
+                # Ota jarayondan meros qolgan pool ishchilari va threadlari bu jarayonda yo'q
+                _transcode_pool = _new_transcode_pool()
+                _transcribe_pool = ThreadPoolExecutor(
+                    max_workers=AUDIO_TRANSCRIBE_WORKERS, thread_name_prefix="speech"
+                )
+                _pools_pid = pid
+    return _transcode_pool, _transcribe_pool
+
+def _replace_transcode_pool(pool: ProcessPoolExecutor) -> None:
+    """Buzilgan (ishchi o'lgan) yoki osilib qolgan pool ni yangisi bilan almashtirish"""
+    global _transcode_pool
+    with _pool_lock:
+        if _transcode_pool is not pool:
+            return  # Boshqa thread allaqachon almashtirgan
+        _transcode_pool = _new_transcode_pool()
+    # shutdown() ishlayotgan ishchini to'xtatmaydi va pool._processes ni None qiladi -
+    # osilib qolgan ffmpeg jarayonlari shutdown dan OLDIN olinadi va o'ldiriladi
+    processes = list((getattr(pool, '_processes', None) or {}).values())
+    for process in processes:
+        try:
+            process.terminate()
+        except Exception:
+            pass
+    pool.shutdown(wait=False, cancel_futures=True)
+
 class AudioProcessor:
     """Audio xabarlarni matnga o'girish va AI javob berish"""
     
@@ -21,6 +173,19 @@ class AudioProcessor:
         
         self.supported_formats = ['.ogg', '.mp3', '.wav', '.m4a', '.aac']
         
+        # Speech client bir marta yaratiladi va barcha chaqiruvlarda qayta ishlatiladi
+        self._speech_client = None
+        self._speech_client_lock = threading.Lock()
+    
+    @property
+    def speech_client(self):
+        """Google Speech client (lazy, thread-safe)"""
+        if self._speech_client is None:
+            with self._speech_client_lock:
+                if self._speech_client is None:
+                    self._speech_client = speech.SpeechClient()
+        return self._speech_client
+        
     def process_audio_message(self, audio_file_path, user_id, language='uz'):
         """
         Audio faylni matnga o'girish va AI javob berish
@@ -35,9 +200,35 @@ class AudioProcessor:
         """
         try:
             logger.info(f"Audio xabarni qayta ishlash boshlandi: {audio_file_path}")
+            with io.open(audio_file_path, "rb") as audio_file:
+                content = audio_file.read()
+            return self.process_audio_content(
+                content, user_id, language, file_extension=Path(audio_file_path).suffix
+            )
             
+        except Exception as e:
+            logger.error(f"Audio processingda xato: {str(e)}")
+            return "❌ Audio xabarni qayta ishlashda xatolik yuz berdi! Iltimos, qaytadan urinib ko'ring."
+
+    def process_audio_content(self, content, user_id, language='uz', media_key=None, file_extension=None):
+        """
+        Audio baytlarini matnga o'girish va AI javob berish
+        
+        Args:
+            content (bytes): Audio fayl mazmuni
+            user_id (str): Foydalanuvchi ID
+            language (str): Til kodi (uz, ru, en)
+            media_key (str): Platformaning barqaror media ID si (kesh kaliti)
+            file_extension (str): Format haqida ishora
+        
+        Returns:
+            str: AI tomonidan yaratilgan javob
+        """
+        try:
             # 1. Audio faylni matnga o'girish
-            text_from_audio = self.transcribe_audio(audio_file_path, language)
+            text_from_audio = self.transcribe_audio_content(
+                content, language, media_key=media_key, file_extension=file_extension
+            )
             
             if not text_from_audio:
                 return "❌ Audio faylni tushunib bo'lmadi. Iltimos, aniqroq gapiring yoki boshqa formatda yuboring!"
@@ -65,12 +256,91 @@ class AudioProcessor:
             str: Transkripsiya qilingan matn
         """
         try:
-            # Google Speech client yaratish
-            client = speech.SpeechClient()
-            
             # Audio faylni o'qish
             with io.open(audio_file_path, "rb") as audio_file:
                 content = audio_file.read()
+        except Exception as e:
+            logger.error(f"Audio faylni o'qishda xato: {str(e)}")
+            return None
+        return self.transcribe_audio_content(content, language, file_extension=Path(audio_file_path).suffix)
+    
+    def transcribe_audio_content(self, content, language='uz', media_key=None, file_extension=None):
+        """
+        Audio baytlarini matnga o'girish (Google Speech-to-Text)
+        
+        Natija media_key (masalan, Telegram file_unique_id) va kontent
+        hash i bo'yicha keshlanadi - takroriy audio qayta transkripsiya qilinmaydi.
+        
+        Args:
+            content (bytes): Audio fayl mazmuni
+            language (str): Til kodi
+            media_key (str): Platformaning barqaror media ID si
+            file_extension (str): Format haqida ishora (magic baytlar aniqlanmasa)
+        
+        Returns:
+            str: Transkripsiya qilingan matn
+        """
+        content_key = f"sha256:{hashlib.sha256(content).hexdigest()}"
+        # Ikkala kalit bitta round trip da o'qiladi va yoziladi
+        transcript = cached_transcript_any((media_key, content_key), language)
+        if transcript:
+            return transcript
+        
+        transcript = self._transcribe_chunked(content, language, file_extension)
+        if transcript:
+            cache_transcripts((media_key, content_key), language, transcript, ttl=TRANSCRIPT_CACHE_TTL)
+        return transcript
+    
+    def _transcribe_chunked(self, content, language='uz', file_extension=None):
+        """
+        Formatni aniqlash -> LINEAR16 ga transkod -> jimlik bo'yicha bo'laklash ->
+        bo'laklarni parallel transkripsiya qilish -> tartib bo'yicha birlashtirish
+        """
+        if not PYDUB_AVAILABLE:
+            return self._recognize(content, language)
+        
+        audio_format = probe_audio_format(content, file_extension)
+        transcode_pool, transcribe_pool = _get_pools()
+        try:
+            chunks = None
+            if transcode_pool is not None:
+                try:
+                    future = transcode_pool.submit(transcode_and_split, content, audio_format)
+                    chunks = future.result(timeout=AUDIO_TRANSCODE_TIMEOUT)
+                except FutureTimeoutError:
+                    future.cancel()
+                    _replace_transcode_pool(transcode_pool)
+                    raise RuntimeError(f"transcode timed out after {AUDIO_TRANSCODE_TIMEOUT}s")
+                except BrokenProcessPool as e:
+                    # Ishchi jarayon o'ldi (OOM, segfault) - keyingi so'rovlar uchun yangi pool;
+                    # shu audio ni jarayon ichida qayta transkod qilmaymiz (asosiy jarayonni ham yiqitishi mumkin)
+                    _replace_transcode_pool(transcode_pool)
+                    raise RuntimeError(f"transcode pool broken: {e}")
+                except (OSError, AssertionError, RuntimeError) as e:
+                    # Masalan, Celery daemon jarayonida child process yaratib bo'lmaydi
+                    logger.warning(f"Transcode pool failed, transcoding in-process: {e}")
+            if chunks is None:
+                chunks = transcode_and_split(content, audio_format)
+        except Exception as e:
+            # ffmpeg yo'q yoki format tanilmadi - eski OGG_OPUS yo'liga qaytamiz
+            logger.error(f"Audio transkod xatosi ({audio_format}): {str(e)}")
+            return self._recognize(content, language)
+        
+        if len(chunks) == 1:
+            return self._recognize(chunks[0], language, linear16=True)
+        
+        logger.info(f"Uzun audio {len(chunks)} ta bo'lakka bo'lindi")
+        # map natijalari bo'laklar tartibida qaytadi
+        parts = list(transcribe_pool.map(
+            lambda chunk: self._recognize(chunk, language, linear16=True), chunks
+        ))
+        transcript = " ".join(part for part in parts if part)
+        return transcript or None
+    
+    def _recognize(self, content, language='uz', linear16=False):
+        """Google Speech-to-Text so'rovi"""
+        try:
+            client = self.speech_client
             
             audio = speech.RecognitionAudio(content=content)
             
@@ -85,9 +355,13 @@ class AudioProcessor:
             alternative_languages = [code for code in language_codes.values() if code != primary_language]
             
             # Konfiguratsiya
+            if linear16:
+                encoding = speech.RecognitionConfig.AudioEncoding.LINEAR16
+            else:
+                encoding = speech.RecognitionConfig.AudioEncoding.OGG_OPUS
             config = speech.RecognitionConfig(
-                encoding=speech.RecognitionConfig.AudioEncoding.OGG_OPUS,
-                sample_rate_hertz=16000,
+                encoding=encoding,
+                sample_rate_hertz=AUDIO_SAMPLE_RATE,
                 language_code=primary_language,
                 alternative_language_codes=alternative_languages[:2],  # Maksimal 3 ta til
                 enable_automatic_punctuation=True,
@@ -99,7 +373,11 @@ class AudioProcessor:
             response = client.recognize(config=config, audio=audio)
             
             if response.results:
-                transcript = response.results[0].alternatives[0].transcript
+                # Har bir natija audio ning ketma-ket qismi - hammasini birlashtiramiz
+                transcript = " ".join(
+                    result.alternatives[0].transcript.strip()
+                    for result in response.results if result.alternatives
+                )
                 confidence = response.results[0].alternatives[0].confidence
                 
                 logger.info(f"Transkripsiya muvaffaqiyatli: {transcript} (confidence: {confidence})")
@@ -112,38 +390,21 @@ class AudioProcessor:
             logger.error(f"Audio transkripsiyada xato: {str(e)}")
             return None
     
-    def download_audio_from_url(self, audio_url, file_extension='.ogg'):
+    def download_audio(self, audio_url, headers=None):
         """
-        URL dan audio faylni yuklash
+        URL dan audio faylni xotiraga yuklash (vaqtincha fayl yaratilmaydi)
         
         Args:
             audio_url (str): Audio fayl URL
-            file_extension (str): Fayl kengaytmasi
+            headers (dict): Qo'shimcha HTTP sarlavhalar (masalan, Authorization)
         
         Returns:
-            str: Yuklangan fayl yo'li
+            bytes: Audio fayl mazmuni yoki None
         """
-        try:
-            response = requests.get(audio_url, timeout=30)
-            response.raise_for_status()
-            
-            # Vaqtincha fayl yaratish
-            with tempfile.NamedTemporaryFile(suffix=file_extension, delete=False) as temp_file:
-                temp_file.write(response.content)
-                return temp_file.name
-                
-        except Exception as e:
-            logger.error(f"Audio yuklab olishda xato: {str(e)}")
-            return None
-    
-    def cleanup_temp_file(self, file_path):
-        """Vaqtincha faylni o'chirish"""
-        try:
-            if os.path.exists(file_path):
-                os.unlink(file_path)
-                logger.info(f"Vaqtincha fayl o'chirildi: {file_path}")
-        except Exception as e:
-            logger.error(f"Faylni o'chirishda xato: {str(e)}")
+        content = download_media(audio_url, headers=headers)
+        if content is None:
+            logger.error("Audio yuklab olishda xato")
+        return content
 
 # Global audio processor instance
 audio_processor = AudioProcessor()
@@ -152,7 +413,8 @@ def process_audio_message(audio_file_path, user_id, language='uz'):
     """Audio xabarni qayta ishlash (wrapper function)"""
     return audio_processor.process_audio_message(audio_file_path, user_id, language)
 
-def download_and_process_audio(audio_url, user_id, language='uz', file_extension='.ogg'):
+def download_and_process_audio(audio_url, user_id, language='uz', file_extension='.ogg', headers=None,
+                               media_key=None):
     """
     Audio URL dan yuklab olib qayta ishlash
     
@@ -160,25 +422,44 @@ def download_and_process_audio(audio_url, user_id, language='uz', file_extension
         audio_url (str): Audio fayl URL
         user_id (str): Foydalanuvchi ID
         language (str): Til kodi
-        file_extension (str): Fayl kengaytmasi
+        file_extension (str): Fayl kengaytmasi (format haqida ishora)
+        headers (dict): Yuklab olish uchun HTTP sarlavhalar
+        media_key (str): Platformaning barqaror media ID si (kesh kaliti)
     
     Returns:
         str: AI javob
     """
-    temp_file_path = None
-    try:
-        # Audio faylni yuklash
-        temp_file_path = audio_processor.download_audio_from_url(audio_url, file_extension)
-        
-        if not temp_file_path:
-            return "❌ Audio faylni yuklab olishda xatolik yuz berdi!"
-        
-        # Audio faylni qayta ishlash
-        result = audio_processor.process_audio_message(temp_file_path, user_id, language)
-        
-        return result
-        
-    finally:
-        # Vaqtincha faylni o'chirish
-        if temp_file_path:
-            audio_processor.cleanup_temp_file(temp_file_path)
\ No newline at end of file
+    # Transkripsiya keshda bo'lsa faylni yuklab olish shart emas
+    transcript = cached_transcript(media_key, language) if media_key else None
+    if transcript:
+        ai_response = get_ai_response(transcript, user_id)
+        return f"🎤 Sizning xabaringiz: \"{transcript}\"\n\n{ai_response}"
+    
+    # Audio faylni xotiraga yuklash
+    content = audio_processor.download_audio(audio_url, headers=headers)
+    
+    if not content:
+        return "❌ Audio faylni yuklab olishda xatolik yuz berdi!"
+    
+    # Audio baytlarini to'g'ridan-to'g'ri qayta ishlash
+    return audio_processor.process_audio_content(
+        content, user_id, language, media_key=media_key, file_extension=file_extension
+    )
+
+def download_and_transcribe_audio(audio_url, language='uz', file_extension='.ogg', headers=None, media_key=None):
+    """
+    Audio URL dan yuklab olib faqat matnga o'girish
+    
+    Returns:
+        str: Transkripsiya qilingan matn yoki None
+    """
+    transcript = cached_transcript(media_key, language) if media_key else None
+    if transcript:
+        return transcript
+    
+    content = audio_processor.download_audio(audio_url, headers=headers)
+    if not content:
+        return None
+    return audio_processor.transcribe_audio_content(
+        content, language, media_key=media_key, file_extension=file_extension
+    )
@@ -0,0 +1,58 @@
+"""
+Cached bot registry
+bot_id -> platform credentials for Celery send tasks (L1 + Redis, invalidated on Bot changes)
+"""
+import os
+import logging
+from typing import Optional, Dict, Any
+
+from redis_cache import get_or_compute, invalidate_keys, cache_key
+
+logger = logging.getLogger(__name__)
+
+BOT_REGISTRY_TTL = int(os.environ.get('BOT_REGISTRY_TTL', '600'))
+# Bot o'zgarganda commit hook kalitni o'chiradi - stale oyna faqat DB sekin bo'lganda yordam beradi
+BOT_REGISTRY_STALE_TTL = int(os.environ.get('BOT_REGISTRY_STALE_TTL', '60'))
+
+def _load_bot(bot_id: int) -> Optional[Dict[str, Any]]:
+    from app import app, db
+    from models import Bot
+
+    with app.app_context():
+        bot = db.session.get(Bot, bot_id)
+        if not bot:
+            return None
+        return {
+            'id': bot.id,
+            'user_id': bot.user_id,
+            'name': bot.name,
+            'platform': bot.platform,
+            'is_active': bool(bot.is_active),
+            'telegram_token': bot.telegram_token,
+            'instagram_token': bot.instagram_token,
+            'whatsapp_token': bot.whatsapp_token,
+            'whatsapp_phone_id': bot.whatsapp_phone_id
+        }
+
+def get_bot_record(bot_id: int) -> Optional[Dict[str, Any]]:
+    """
+    Bot ma'lumotlari (tokenlar bilan) - keshdan, bo'lmasa bitta chaqiruvchi DB dan o'qiydi
+    Mavjud bo'lmagan bot ham (None) TTL davomida keshlanadi
+    """
+    return get_or_compute(cache_key("bot", bot_id), lambda: _load_bot(bot_id), BOT_REGISTRY_TTL,
+                          stale_ttl=BOT_REGISTRY_STALE_TTL, tiered=True)
+
+def get_telegram_token(bot_id: int) -> Optional[str]:
+    """Faol Telegram bot tokeni (bot o'chirilgan / nofaol bo'lsa None)"""
+    record = get_bot_record(bot_id)
+    if not record or not record['is_active']:
+        return None
+    return record['telegram_token']
+
+def invalidate_bot(bot_id: int):
+    """Bot tokeni / holati o'zgarganda (barcha workerlarda)"""
+    try:
+        invalidate_keys(cache_key("bot", bot_id))
+        logger.debug(f"Invalidated bot registry entry for bot {bot_id}")
+    except Exception as e:
+        logger.error(f"Bot registry invalidate error: {e}")
@@ -3,10 +3,11 @@ Bot Status Monitoring and Health Check Service
 Provides real-time status monitoring for all platform bots
 """
 
-from flask import Blueprint, jsonify, render_template_string
+from flask import Blueprint, jsonify, render_template_string, request
 from flask_login import login_required, current_user
 from bot_manager import bot_manager
 import logging
+import os
 from datetime import datetime, timedelta
 
 logger = logging.getLogger(__name__)
@@ -295,4 +296,278 @@ def restart_bot_api(bot_id):
         return jsonify({
             "error": str(e),
             "bot_id": bot_id
-        }), 500
\ No newline at end of file
+        }), 500
+
+@bot_status_bp.route('/metrics')
+@login_required
+def metrics_page():
+    """DB so'rovlar va kesh metrikalari sahifasi (request / handler scope lari, kesh prefikslari bo'yicha)"""
+    if not current_user.is_admin:
+        return "Access denied - Admin only", 403
+    
+    metrics_template = """
+    <!DOCTYPE html>
+    <html>
+    <head>
+        <title>Metrics - BotFactory AI</title>
+        <meta charset="utf-8">
+        <style>
+            body { font-family: Arial, sans-serif; margin: 20px; background: #f5f5f5; }
+            .container { max-width: 1400px; margin: 0 auto; }
+            .status-card {
+                background: white;
+                border-radius: 10px;
+                padding: 20px;
+                margin-bottom: 20px;
+                box-shadow: 0 2px 10px rgba(0,0,0,0.1);
+            }
+            table { width: 100%; border-collapse: collapse; font-size: 14px; }
+            th, td { text-align: left; padding: 8px; border-bottom: 1px solid #eee; vertical-align: top; }
+            th { background: #f8f9fa; }
+            td.num { text-align: right; white-space: nowrap; }
+            tr.warn { background: #fff3cd; }
+            code { font-size: 12px; word-break: break-all; }
+            pre { background: #f8f9fa; padding: 10px; overflow-x: auto; font-size: 12px; }
+            .metric-block { border-bottom: 1px solid #eee; padding: 10px 0; }
+        </style>
+    </head>
+    <body>
+        <div class="container">
+            <div class="status-card">
+                <h1>📈 DB Query Metrics</h1>
+                <p>Budget: request {{ budgets.request }}, handler {{ budgets.handler }} queries;
+                   N+1 threshold: {{ budgets.n_plus_one }} · Updated: {{ current_time }}</p>
+                <p><strong>⚠️ Faqat shu worker jarayoni (pid {{ pid }}):</strong> so'rov, statement va kesh hisoblagichlari
+                   har bir gunicorn/Celery jarayonida alohida yuritiladi - boshqa workerlar bu yerda ko'rinmaydi.
+                   Key size sample va Redis maintenance - Redis dan, barcha jarayonlar uchun umumiy.</p>
+            </div>
+            
+            <div class="status-card">
+                <h2>🔎 Queries per scope (pid {{ pid }})</h2>
+                {% if scopes %}
+                <table>
+                    <tr>
+                        <th>Scope</th><th>Calls</th><th>Avg queries</th><th>Max queries</th>
+                        <th>Avg DB ms</th><th>Total DB ms</th><th>Over budget</th><th>N+1</th><th>Last repeated statement</th>
+                    </tr>
+                    {% for name, entry in scopes %}
+                    <tr class="{{ 'warn' if entry.over_budget or entry.n_plus_one else '' }}">
+                        <td>{{ name }}</td>
+                        <td class="num">{{ entry.calls }}</td>
+                        <td class="num">{{ entry.avg_queries }}</td>
+                        <td class="num">{{ entry.max_queries }}</td>
+                        <td class="num">{{ entry.avg_db_time_ms }}</td>
+                        <td class="num">{{ entry.db_time_ms }}</td>
+                        <td class="num">{{ entry.over_budget }}</td>
+                        <td class="num">{{ entry.n_plus_one }}</td>
+                        <td>{% if entry.last_offender %}<code>x{{ entry.last_offender.count }} {{ entry.last_offender.statement }}</code>{% endif %}</td>
+                    </tr>
+                    {% endfor %}
+                </table>
+                {% else %}
+                <p>Hali ma'lumot yo'q.</p>
+                {% endif %}
+            </div>
+            
+            {% for title, rows in [('⏱ Top statements by total time', top_by_time), ('🔁 Top statements by count', top_by_count)] %}
+            <div class="status-card">
+                <h2>{{ title }}</h2>
+                {% if rows %}
+                <table>
+                    <tr><th>Statement</th><th>Count</th><th>Total ms</th><th>Avg ms</th><th>Max ms</th><th>Slow</th></tr>
+                    {% for row in rows %}
+                    <tr class="{{ 'warn' if row.slow_count else '' }}">
+                        <td><code>{{ row.statement }}</code></td>
+                        <td class="num">{{ row.count }}</td>
+                        <td class="num">{{ row.total_ms }}</td>
+                        <td class="num">{{ row.avg_ms }}</td>
+                        <td class="num">{{ row.max_ms }}</td>
+                        <td class="num">{{ row.slow_count }}</td>
+                    </tr>
+                    {% endfor %}
+                </table>
+                {% else %}
+                <p>Hali ma'lumot yo'q.</p>
+                {% endif %}
+            </div>
+            {% endfor %}
+            
+            <div class="status-card">
+                <h2>🐢 Slow queries (&ge; {{ budgets.slow_ms }}ms) and EXPLAIN samples</h2>
+                {% for row in slow_queries %}
+                <div class="metric-block">
+                    <p><code>{{ row.statement }}</code></p>
+                    <p>Slow: {{ row.slow_count }} / {{ row.count }} · Max: {{ row.max_ms }}ms · Last: {{ row.last_slow_at }}</p>
+                    {% if row.explain and row.explain.plan %}
+                    <pre>{{ row.explain.plan }}</pre>
+                    <p><small>Captured {{ row.explain.captured_at }} in {{ row.explain.duration_ms }}ms</small></p>
+                    {% elif row.explain and row.explain.error %}
+                    <p><small>EXPLAIN failed: {{ row.explain.error }}</small></p>
+                    {% endif %}
+                </div>
+                {% else %}
+                <p>Sekin so'rovlar yo'q.</p>
+                {% endfor %}
+            </div>
+            
+            <div class="status-card">
+                <h2>🗄 Cache by prefix (pid {{ pid }})</h2>
+                {% for tier, prefixes in cache_tiers %}
+                <h3>{{ tier }}</h3>
+                {% if prefixes %}
+                <table>
+                    <tr>
+                        <th>Prefix</th><th>Hits</th><th>Misses</th><th>Hit ratio</th><th>Sets</th><th>Deletes</th>
+                        <th>Evictions</th><th>Bytes written</th><th>Avg value</th><th>Max value</th>
+                        <th>Avg get ms</th><th>p95 get ms (&le;)</th><th>Avg set ms</th><th>p95 set ms (&le;)</th>
+                    </tr>
+                    {% for prefix, entry in prefixes %}
+                    <tr class="{{ 'warn' if entry.max_value_bytes >= key_sizes.min_bytes else '' }}">
+                        <td>{{ prefix }}</td>
+                        <td class="num">{{ entry.hits }}</td>
+                        <td class="num">{{ entry.misses }}</td>
+                        <td class="num">{{ (entry.hit_ratio * 100)|round(1) }}%</td>
+                        <td class="num">{{ entry.sets }}</td>
+                        <td class="num">{{ entry.deletes }}</td>
+                        <td class="num">{{ entry.evictions }}</td>
+                        <td class="num">{{ entry.bytes_written }}</td>
+                        <td class="num">{{ entry.avg_value_bytes }}</td>
+                        <td class="num">{{ entry.max_value_bytes }}</td>
+                        <td class="num">{{ entry.avg_get_ms }}</td>
+                        <td class="num">{{ entry.p95_get_ms }}</td>
+                        <td class="num">{{ entry.avg_set_ms }}</td>
+                        <td class="num">{{ entry.p95_set_ms }}</td>
+                    </tr>
+                    {% endfor %}
+                </table>
+                {% else %}
+                <p>Hali ma'lumot yo'q.</p>
+                {% endif %}
+                {% endfor %}
+            </div>
+            
+            <div class="status-card">
+                <h2>📦 Key size sample ({{ key_sizes.sampled }} keys)</h2>
+                {% if key_sizes.error %}
+                <p>Sampling failed: {{ key_sizes.error }}</p>
+                {% endif %}
+                <table>
+                    <tr><th>Prefix</th><th>Keys</th><th>Total bytes</th><th>Avg bytes</th><th>Max bytes</th></tr>
+                    {% for prefix, entry in key_sizes.prefixes|dictsort %}
+                    <tr>
+                        <td>{{ prefix }}</td>
+                        <td class="num">{{ entry['keys'] }}</td>
+                        <td class="num">{{ entry.total_bytes }}</td>
+                        <td class="num">{{ entry.avg_bytes }}</td>
+                        <td class="num">{{ entry.max_bytes }}</td>
+                    </tr>
+                    {% endfor %}
+                </table>
+                <h3>Oversized entries (&ge; {{ key_sizes.min_bytes }} bytes)</h3>
+                {% for row in key_sizes.oversized %}
+                <p><code>{{ row.key }}</code> · {{ row.bytes }} bytes · TTL {{ row.ttl }}s</p>
+                {% else %}
+                <p>Katta yozuvlar yo'q.</p>
+                {% endfor %}
+            </div>
+            
+            <div class="status-card">
+                <h2>🧹 Redis maintenance</h2>
+                <table>
+                    <tr>
+                        <th>Job</th><th>Runs</th><th>Full cycles</th><th>Keys scanned</th><th>Expired</th><th>Deleted</th>
+                        <th>Total ms</th><th>Last run</th><th>Last scanned</th><th>Last ms</th><th>Cursor</th>
+                    </tr>
+                    {% for name, entry in maintenance|dictsort %}
+                    <tr>
+                        <td>{{ name }}</td>
+                        {% if entry.error %}
+                        <td colspan="10">{{ entry.error }}</td>
+                        {% else %}
+                        <td class="num">{{ entry.runs or 0 }}</td>
+                        <td class="num">{{ entry.cycles or 0 }}</td>
+                        <td class="num">{{ entry.scanned or 0 }}</td>
+                        <td class="num">{{ entry.expired or 0 }}</td>
+                        <td class="num">{{ entry.deleted or 0 }}</td>
+                        <td class="num">{{ entry.time_ms or 0 }}</td>
+                        <td>{{ entry.last_run or '-' }}</td>
+                        <td class="num">{{ entry.last_scanned or 0 }}</td>
+                        <td class="num">{{ entry.last_time_ms or 0 }}</td>
+                        <td class="num">{{ entry.cursor or 0 }}</td>
+                        {% endif %}
+                    </tr>
+                    {% endfor %}
+                </table>
+            </div>
+        </div>
+    </body>
+    </html>
+    """
+    
+    try:
+        from query_monitor import (query_stats, slow_query_log, QUERY_BUDGET_REQUEST, QUERY_BUDGET_HANDLER,
+                                   N_PLUS_ONE_THRESHOLD, SLOW_QUERY_MS)
+        from redis_cache import cache_metrics_snapshot, sample_key_sizes
+        from redis_maintenance import maintenance_stats
+        
+        scopes = sorted(query_stats.snapshot().items(), key=lambda item: item[1]['db_time_ms'], reverse=True)
+        cache_tiers = [
+            (tier, sorted(prefixes.items(), key=lambda item: item[1]['hits'] + item[1]['misses'], reverse=True))
+            for tier, prefixes in cache_metrics_snapshot().items()
+        ]
+        return render_template_string(
+            metrics_template,
+            scopes=scopes,
+            cache_tiers=cache_tiers,
+            key_sizes=sample_key_sizes(),
+            maintenance=maintenance_stats(),
+            top_by_time=slow_query_log.top(key='total_ms'),
+            top_by_count=slow_query_log.top(key='count'),
+            slow_queries=slow_query_log.slow(),
+            budgets={
+                'request': QUERY_BUDGET_REQUEST,
+                'handler': QUERY_BUDGET_HANDLER,
+                'n_plus_one': N_PLUS_ONE_THRESHOLD,
+                'slow_ms': SLOW_QUERY_MS
+            },
+            pid=os.getpid(),
+            current_time=datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        )
+        
+    except Exception as e:
+        logger.error(f"Error rendering metrics page: {e}")
+        return f"Error loading metrics: {str(e)}", 500
+
+@bot_status_bp.route('/api/metrics', methods=['GET', 'DELETE'])
+@login_required
+def api_metrics():
+    """
+    DB so'rovlar va kesh metrikalari (JSON, ?sample=1 - kalitlar hajmi namunasi); DELETE - hisoblagichlarni nollash
+    queries / statements / cache - faqat javob bergan worker jarayoniga (pid) tegishli
+    """
+    if not current_user.is_admin:
+        return jsonify({"error": "Access denied"}), 403
+    
+    from query_monitor import query_stats, slow_query_log
+    from redis_cache import cache_metrics_snapshot, reset_cache_metrics, sample_key_sizes
+    from redis_maintenance import maintenance_stats
+    
+    if request.method == 'DELETE':
+        query_stats.reset()
+        slow_query_log.reset()
+        reset_cache_metrics()
+        return jsonify({"success": True, "pid": os.getpid()})
+    
+    return jsonify({
+        "pid": os.getpid(),
+        "queries": query_stats.snapshot(),
+        "statements": {
+            "by_total_time": slow_query_log.top(key='total_ms'),
+            "by_count": slow_query_log.top(key='count'),
+            "slow": slow_query_log.slow()
+        },
+        "cache": cache_metrics_snapshot(),
+        "cache_key_sizes": sample_key_sizes() if request.args.get('sample') == '1' else None,
+        "redis_maintenance": maintenance_stats(),
+        "timestamp": datetime.now().isoformat()
+    })
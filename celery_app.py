@@ -4,6 +4,34 @@ Handles AI responses and heavy operations to improve performance
 """
 import os
 from celery import Celery
+from kombu import Queue
+
+# Navbatlar topologiyasi:
+#   interactive - foydalanuvchi javob kutayotgan qisqa tasklar (AI javobi, yuborish, tarix)
+#   bulk        - ommaviy yuborishlar va eksportlar
+#   media       - audio / media qayta ishlash (uzoq, CPU/IO og'ir)
+#   maintenance - tozalash va xizmat tasklari
+CELERY_QUEUES = ('interactive', 'bulk', 'media', 'maintenance')
+
+# Workerlar ishga tushirilmagan deploy uchun 0: scheduler va broadcast tasklarni navbatga qo'ymay shu jarayonda
+# bajaradi (Redis bor, lekin navbatni hech kim o'qimasa xabarlar jimgina yo'qoladi)
+CELERY_ENABLED = os.environ.get('CELERY_ENABLED', '1') == '1'
+
+# Redis broker da prioritet: 0 - eng yuqori, 9 - eng past (har navbat 10 ta pog'onaga bo'linadi)
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 5
+PRIORITY_LOW = 9
+
+CELERY_TASK_ROUTES = {
+    'tasks.generate_ai_response': {'queue': 'interactive', 'priority': PRIORITY_HIGH},
+    'tasks.send_telegram_message': {'queue': 'interactive', 'priority': PRIORITY_HIGH},
+    'tasks.save_chat_history': {'queue': 'interactive', 'priority': PRIORITY_NORMAL},
+    'tasks.send_telegram_batch': {'queue': 'bulk', 'priority': PRIORITY_NORMAL},
+    'tasks.send_subscription_notices': {'queue': 'bulk', 'priority': PRIORITY_NORMAL},
+    'tasks.export_chat_history': {'queue': 'bulk', 'priority': PRIORITY_HIGH},
+    'tasks.process_audio': {'queue': 'media', 'priority': PRIORITY_HIGH},
+    'tasks.cleanup_old_tasks': {'queue': 'maintenance', 'priority': PRIORITY_LOW},
+}
 
 def make_celery(app=None):
     """Create Celery instance for async tasks"""
@@ -28,18 +56,24 @@ def make_celery(app=None):
         
         # Performance optimization
         task_acks_late=True,              # Acknowledge after completion
-        worker_prefetch_multiplier=4,     # Prefetch 4 tasks per worker
-        task_routes={
-            'tasks.generate_ai_response': {'queue': 'ai_responses'},
-            'tasks.process_audio': {'queue': 'media_processing'},
-            'tasks.send_telegram_message': {'queue': 'notifications'},
+        # Uzoq tasklar qisqalari orqasida turib qolmasligi uchun 1; bulk profili CLI da oshiradi
+        worker_prefetch_multiplier=int(os.environ.get('CELERY_PREFETCH_MULTIPLIER', '1')),
+        task_queues=[Queue(name) for name in CELERY_QUEUES],
+        task_default_queue='interactive',
+        task_routes=CELERY_TASK_ROUTES,
+        task_default_priority=PRIORITY_NORMAL,
+        broker_transport_options={
+            'priority_steps': list(range(10)),
+            'sep': ':',
+            'queue_order_strategy': 'priority',
+            'visibility_timeout': 3600,   # acks_late: eng uzun task (eksport) dan katta
         },
         
         # Retry configuration
         task_default_retry_delay=60,      # Retry after 60 seconds
         task_max_retries=3,               # Max 3 retries
         
-        # Result expiration
+        # Natijalar: fire-and-forget tasklar ignore_result=True (tasks.py), faqat eksport holati o'qiladi
         result_expires=3600,              # Results expire after 1 hour
         
         # Worker configuration
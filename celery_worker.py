@@ -1,7 +1,14 @@
 #!/usr/bin/env python3
 """
 Celery worker startup script for async task processing
-Run this in a separate process: python celery_worker.py
+Run this in a separate process: python celery_worker.py [profile]
+
+Profiles (yoki CELERY_WORKER_PROFILE env):
+    interactive  - AI javoblari, yuborish, tarix (ko'p thread, prefetch 1)
+    bulk         - ommaviy yuborish, eksport (prefetch 4)
+    media        - audio qayta ishlash (kam parallel, uzun timeout)
+    maintenance  - tozalash tasklari (bitta thread)
+    all          - barcha navbatlar bitta workerda (development)
 """
 import os
 import sys
@@ -10,21 +17,41 @@ import sys
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 
 # Import Celery app
-from celery_app import celery
+from celery_app import celery, CELERY_QUEUES
 from app import app
 
 # Import all task modules to register them
 import tasks
 
-if __name__ == '__main__':
-    # Configure Celery worker
-    celery.worker_main([
+# profile -> (navbatlar, concurrency, prefetch multiplier, time limit, soft time limit)
+WORKER_PROFILES = {
+    'interactive': (['interactive'], 16, 1, 120, 90),
+    'bulk': (['bulk'], 4, 4, 3600, 3300),
+    'media': (['media'], 2, 1, 600, 540),
+    'maintenance': (['maintenance'], 1, 1, 900, 840),
+    'all': (list(CELERY_QUEUES), 4, 1, 3600, 3300),
+}
+
+def worker_args(profile: str) -> list:
+    queues, concurrency, prefetch, time_limit, soft_time_limit = WORKER_PROFILES[profile]
+    return [
         'worker',
         '--loglevel=info',
-        '--concurrency=4',  # Number of worker processes
+        f'--queues={",".join(queues)}',
+        f'--hostname={profile}@%h',
+        f'--concurrency={int(os.environ.get("CELERY_CONCURRENCY", concurrency))}',  # Number of worker threads
+        f'--prefetch-multiplier={prefetch}',
         '--max-tasks-per-child=1000',  # Restart worker after 1000 tasks
-        '--time-limit=300',  # 5 minute task timeout
-        '--soft-time-limit=240',  # 4 minute soft timeout
+        f'--time-limit={time_limit}',
+        f'--soft-time-limit={soft_time_limit}',
         '--without-heartbeat',  # Disable heartbeat for simplicity
         '--pool=threads',  # Use thread pool for I/O bound tasks
-    ])
\ No newline at end of file
+    ]
+
+if __name__ == '__main__':
+    profile = sys.argv[1] if len(sys.argv) > 1 else os.environ.get('CELERY_WORKER_PROFILE', 'all')
+    if profile not in WORKER_PROFILES:
+        sys.exit(f"Unknown worker profile '{profile}', choose one of: {', '.join(WORKER_PROFILES)}")
+    
+    # Configure Celery worker
+    celery.worker_main(worker_args(profile))
@@ -0,0 +1,188 @@
+"""
+Streaming chat history export
+Pages through chat_history with a keyset join to bot, writing CSV/JSONL/XLSX incrementally
+"""
+import os
+import io
+import csv
+import json
+import logging
+import tempfile
+from datetime import datetime, timedelta
+from typing import Dict, Any, Iterator, Optional, Tuple
+
+from app import db
+from db_routing import read_replica
+from models import Bot, ChatHistory
+
+logger = logging.getLogger(__name__)
+
+EXPORT_CHUNK_SIZE = int(os.environ.get('EXPORT_CHUNK_SIZE', '2000'))
+# XLSX shu hajmgacha xotirada, undan keyin diskka o'tadi
+EXPORT_SPOOL_MAX_BYTES = int(os.environ.get('EXPORT_SPOOL_MAX_BYTES', str(16 * 1024 * 1024)))
+# Fon eksportlari: Celery worker yozadi, web jarayon o'qiydi - ikkalasi ko'radigan umumiy katalog (NFS / volume)
+# bo'lishi shart, shuning uchun lokal temp ga default yo'q; berilmasa background=1 ishlamaydi
+EXPORT_DIR = os.environ.get('EXPORT_DIR', '').strip()
+
+EXPORT_FORMATS = {
+    'csv': ('text/csv; charset=utf-8', 'csv'),
+    'jsonl': ('application/x-ndjson; charset=utf-8', 'jsonl'),
+    'xlsx': ('application/vnd.openxmlformats-officedocument.spreadsheetml.sheet', 'xlsx'),
+}
+
+EXPORT_HEADERS = ['Vaqt', 'Bot nomi', 'Platform', 'Telegram ID', 'Instagram ID',
+                  'WhatsApp raqami', 'Foydalanuvchi xabari', 'Bot javobi', 'Til']
+
+def parse_export_filters(args) -> Dict[str, Any]:
+    """
+    So'rov parametrlaridan filtrlar (JSON ga serializatsiya qilinadigan)
+
+    Parametrlar: bot_id, user_id (tenant), date_from, date_to (YYYY-MM-DD)
+    """
+    filters = {}
+    for key in ('bot_id', 'user_id'):
+        value = args.get(key, type=int)
+        if value:
+            filters[key] = value
+    for key in ('date_from', 'date_to'):
+        value = (args.get(key) or '').strip()
+        if value:
+            # Noto'g'ri sana bo'lsa ValueError
+            filters[key] = datetime.strptime(value, '%Y-%m-%d').strftime('%Y-%m-%d')
+    return filters
+
+def _filtered_query(filters: Dict[str, Any]):
+    query = db.session.query(
+        ChatHistory.id, ChatHistory.created_at, Bot.name, Bot.platform,
+        ChatHistory.user_telegram_id, ChatHistory.user_instagram_id, ChatHistory.user_whatsapp_number,
+        ChatHistory.message, ChatHistory.response, ChatHistory.language
+    ).outerjoin(Bot, ChatHistory.bot_id == Bot.id)
+
+    if filters.get('bot_id'):
+        query = query.filter(ChatHistory.bot_id == filters['bot_id'])
+    if filters.get('user_id'):
+        query = query.filter(Bot.user_id == filters['user_id'])
+    if filters.get('date_from'):
+        query = query.filter(ChatHistory.created_at >= datetime.strptime(filters['date_from'], '%Y-%m-%d'))
+    if filters.get('date_to'):
+        # date_to kuni ham kiradi
+        date_to = datetime.strptime(filters['date_to'], '%Y-%m-%d') + timedelta(days=1)
+        query = query.filter(ChatHistory.created_at < date_to)
+    return query
+
+def iter_chat_rows(filters: Dict[str, Any], chunk_size: int = EXPORT_CHUNK_SIZE) -> Iterator[list]:
+    """Eksport qatorlari - keyset (id DESC) bo'yicha chunk lab, eng yangisidan boshlab (replikadan)"""
+    query = _filtered_query(filters)
+    last_id = None
+    while True:
+        page = query
+        if last_id is not None:
+            page = page.filter(ChatHistory.id < last_id)
+        with read_replica():
+            rows = page.order_by(ChatHistory.id.desc()).limit(chunk_size).all()
+        if not rows:
+            return
+
+        for (chat_id, created_at, bot_name, platform, telegram_id, instagram_id,
+             whatsapp_number, message, response, language) in rows:
+            yield [
+                created_at.strftime('%d.%m.%Y %H:%M:%S') if created_at else '',
+                bot_name or 'Noma\'lum bot',
+                platform or 'Noma\'lum',
+                telegram_id or '',
+                instagram_id or '',
+                whatsapp_number or '',
+                message or '',
+                response or '',
+                language or 'uz'
+            ]
+
+        last_id = rows[-1][0]
+        if len(rows) < chunk_size:
+            return
+
+@read_replica()
+def has_chat_rows(filters: Dict[str, Any]) -> bool:
+    return db.session.query(_filtered_query(filters).exists()).scalar()
+
+def stream_csv(filters: Dict[str, Any]) -> Iterator[str]:
+    """CSV ni bo'laklab yield qilish (Excel uchun UTF-8 BOM bilan)"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    buffer.write('\ufeff')
+    writer.writerow(EXPORT_HEADERS)
+    for index, row in enumerate(iter_chat_rows(filters), 1):
+        writer.writerow(row)
+        if index % EXPORT_CHUNK_SIZE == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+def stream_jsonl(filters: Dict[str, Any]) -> Iterator[str]:
+    """JSON Lines ni bo'laklab yield qilish"""
+    lines = []
+    for row in iter_chat_rows(filters):
+        lines.append(json.dumps(dict(zip(EXPORT_HEADERS, row)), ensure_ascii=False))
+        if len(lines) >= EXPORT_CHUNK_SIZE:
+            yield '\n'.join(lines) + '\n'
+            lines = []
+    if lines:
+        yield '\n'.join(lines) + '\n'
+
+def write_xlsx(filters: Dict[str, Any], fileobj) -> None:
+    """openpyxl write-only rejimida XLSX yozish (qatorlar xotirada to'planmaydi)"""
+    from openpyxl import Workbook
+
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet('Bot Yozishmalari')
+    sheet.append(EXPORT_HEADERS)
+    for row in iter_chat_rows(filters):
+        sheet.append(row)
+    workbook.save(fileobj)
+
+def build_xlsx(filters: Dict[str, Any]):
+    """XLSX ni spooled faylga yozish - kichik eksport xotirada, kattasi diskda"""
+    spooled = tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_MAX_BYTES)
+    write_xlsx(filters, spooled)
+    spooled.seek(0)
+    return spooled
+
+def export_filename(fmt: str) -> str:
+    return f"bot_yozishmalari_{datetime.now().strftime('%Y%m%d_%H%M%S')}.{EXPORT_FORMATS[fmt][1]}"
+
+def export_to_file(filters: Dict[str, Any], fmt: str, export_id: str) -> Tuple[str, int]:
+    """
+    Fon rejimi uchun: eksportni EXPORT_DIR dagi faylga yozish
+
+    Returns:
+        (fayl yo'li, hajmi baytlarda)
+
+    Raises:
+        RuntimeError: EXPORT_DIR sozlanmagan
+    """
+    if not EXPORT_DIR:
+        raise RuntimeError("EXPORT_DIR is not set - background exports need a directory shared by web and worker")
+    os.makedirs(EXPORT_DIR, exist_ok=True)
+    path = os.path.join(EXPORT_DIR, f"chat_export_{export_id}.{EXPORT_FORMATS[fmt][1]}")
+
+    # Yarim yozilgan fayl yuklab olinmasligi uchun .part ga yozib, keyin nomini almashtiramiz
+    partial_path = path + '.part'
+    if fmt == 'xlsx':
+        with open(partial_path, 'wb') as output:
+            write_xlsx(filters, output)
+    else:
+        chunks = stream_csv(filters) if fmt == 'csv' else stream_jsonl(filters)
+        with open(partial_path, 'w', encoding='utf-8', newline='') as output:
+            for chunk in chunks:
+                output.write(chunk)
+    os.replace(partial_path, path)
+
+    return path, os.path.getsize(path)
+
+def export_file_path(export_id: str, fmt: str) -> Optional[str]:
+    """Tayyor fon eksporti fayli (bo'lmasa None)"""
+    if not EXPORT_DIR or fmt not in EXPORT_FORMATS or not export_id.replace('-', '').isalnum():
+        return None
+    path = os.path.join(EXPORT_DIR, f"chat_export_{export_id}.{EXPORT_FORMATS[fmt][1]}")
+    return path if os.path.exists(path) else None
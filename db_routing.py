@@ -0,0 +1,143 @@
+"""
+Read/write session routing
+Optional DATABASE_READ_URL replica: read-only workloads inside read_replica() go to the replica,
+everything else (and reads shortly after a write by the same user / chat) goes to the primary
+"""
+import os
+import time
+import logging
+import threading
+import contextvars
+from contextlib import contextmanager
+from typing import Dict, Any, Optional
+
+from flask import has_request_context, session as flask_session
+from flask_sqlalchemy.session import Session
+from sqlalchemy import event
+from sqlalchemy.sql import Select
+
+logger = logging.getLogger(__name__)
+
+REPLICA_BIND_KEY = 'replica'
+# Yozuvdan keyin shuncha soniya o'qishlar primary dan (replika kechikishi uchun zaxira)
+READ_YOUR_WRITES_SECONDS = float(os.environ.get('DB_READ_YOUR_WRITES_SECONDS', '5'))
+# Flask session (cookie) dagi oxirgi yozuv vaqti kaliti
+WRITE_MARK_SESSION_KEY = '_db_write_at'
+_RECENT_WRITES_MAX = 10000
+
+_read_scope: contextvars.ContextVar = contextvars.ContextVar('db_read_scope', default=False)
+_consistency_key: contextvars.ContextVar = contextvars.ContextVar('db_consistency_key', default=None)
+
+_recent_writes: Dict[str, float] = {}
+_recent_writes_lock = threading.Lock()
+_replica_configured = False
+
+def replica_engine_options(primary_options: Dict[str, Any]) -> Dict[str, Any]:
+    """Replika uchun engine sozlamalari: primary asosida, faqat o'qish tranzaksiyalari"""
+    options = dict(primary_options)
+    connect_args = dict(options.get('connect_args', {}))
+    connect_args['application_name'] = f"{connect_args.get('application_name', 'chatbot_factory')}_replica"
+    connect_args['connect_timeout'] = connect_args.get('connect_timeout', 10)
+    # Tasodifiy yozuv replikaga tushsa - darhol xato; og'ir hisobotlar uchun timeout
+    statement_timeout = int(os.environ.get('DB_READ_STATEMENT_TIMEOUT_MS', '30000'))
+    connect_args['options'] = f"-c default_transaction_read_only=on -c statement_timeout={statement_timeout}"
+    options['connect_args'] = connect_args
+    options['pool_size'] = int(os.environ.get('DB_READ_POOL_SIZE', str(options.get('pool_size', 5))))
+    options['max_overflow'] = int(os.environ.get('DB_READ_MAX_OVERFLOW', str(options.get('max_overflow', 10))))
+    options['pool_pre_ping'] = True
+    return options
+
+def configure_read_replica(app, read_url: str, engine_options: Dict[str, Any]) -> None:
+    """Replikani SQLALCHEMY_BINDS ga qo'shish (db.init_app dan oldin chaqiriladi)"""
+    global _replica_configured
+    binds = dict(app.config.get('SQLALCHEMY_BINDS') or {})
+    binds[REPLICA_BIND_KEY] = {'url': read_url, **engine_options}
+    app.config['SQLALCHEMY_BINDS'] = binds
+    _replica_configured = True
+
+def replica_enabled() -> bool:
+    return _replica_configured
+
+@contextmanager
+def read_replica():
+    """
+    Ichidagi faqat-o'qish SELECT lar replikaga yuboriladi
+    (dashboard, eksport, hisobotlar, prompt uchun tarix). Dekorator sifatida ham ishlaydi.
+    """
+    token = _read_scope.set(True)
+    try:
+        yield
+    finally:
+        _read_scope.reset(token)
+
+@contextmanager
+def consistency_key(key: Optional[str]):
+    """Read-your-writes kaliti (masalan, telegram chat) - shu kalit bilan yozilgandan keyin o'qishlar primary dan"""
+    token = _consistency_key.set(key)
+    try:
+        yield
+    finally:
+        _consistency_key.reset(token)
+
+def mark_written(key: Optional[str] = None) -> None:
+    """Commit qilingan yozuvni qayd etish (joriy so'rov foydalanuvchisi va/yoki kalit uchun)"""
+    if not _replica_configured:
+        return
+    if has_request_context():
+        try:
+            flask_session[WRITE_MARK_SESSION_KEY] = time.time()
+        except Exception:
+            # Javob allaqachon yuborilayotgan bo'lsa (streaming) cookie ni o'zgartirib bo'lmaydi
+            pass
+    key = key or _consistency_key.get()
+    if key:
+        now = time.monotonic()
+        with _recent_writes_lock:
+            if len(_recent_writes) >= _RECENT_WRITES_MAX:
+                for stale in [k for k, deadline in _recent_writes.items() if deadline <= now]:
+                    del _recent_writes[stale]
+            _recent_writes[key] = now + READ_YOUR_WRITES_SECONDS
+
+def _written_recently() -> bool:
+    if has_request_context():
+        written_at = flask_session.get(WRITE_MARK_SESSION_KEY)
+        if written_at and time.time() - written_at < READ_YOUR_WRITES_SECONDS:
+            return True
+    key = _consistency_key.get()
+    if key:
+        with _recent_writes_lock:
+            deadline = _recent_writes.get(key)
+        if deadline and time.monotonic() < deadline:
+            return True
+    return False
+
+class RoutingSession(Session):
+    """Flask-SQLAlchemy sessiyasi: read_replica() ichidagi toza SELECT lar -> replika"""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and _replica_configured:
+            if not isinstance(clause, Select):
+                # flush, bulk_*_mappings, UPDATE/DELETE, text() - yozuv deb hisoblanadi
+                self.info['db_routing_wrote'] = True
+            elif self._use_replica(clause):
+                engine = self._db.engines.get(REPLICA_BIND_KEY)
+                if engine is not None:
+                    return engine
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+    def _use_replica(self, clause) -> bool:
+        if not _read_scope.get() or self._flushing or clause._for_update_arg is not None:
+            return False
+        # Shu tranzaksiyada yozuv bo'lgan yoki kutilayotgan bo'lsa - primary (o'z yozuvini ko'rishi uchun)
+        if self.info.get('db_routing_wrote') or self.new or self.dirty or self.deleted:
+            return False
+        return not _written_recently()
+
+@event.listens_for(RoutingSession, 'after_commit')
+def _after_commit(session):
+    if session.info.pop('db_routing_wrote', False):
+        mark_written()
+
+@event.listens_for(RoutingSession, 'after_rollback')
+def _after_rollback(session):
+    session.info.pop('db_routing_wrote', None)
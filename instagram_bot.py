@@ -8,6 +8,8 @@ from flask import Blueprint, request, jsonify, url_for
 from app import db, app
 from models import User, Bot, ChatHistory
 from ai import get_ai_response, process_knowledge_base
+from redis_cache import get_knowledge_base
+from rate_limiter import check_message_rate, rate_limit_message
 from audio_processor import download_and_process_audio
 
 # Configure logging
@@ -184,8 +186,14 @@ class InstagramBot:
                     self.send_message(sender_id, welcome_message)
                     return True
                 
+                # Rate limit - AI kvotasini himoya qilish
+                rate = check_message_rate(self.bot_id, f"ig:{sender_id}", bot.owner.subscription_type if bot.owner else None)
+                if not rate.allowed:
+                    self.send_message(sender_id, rate_limit_message(rate, user.language))
+                    return True
+                
                 # AI javobini olish
-                knowledge_base = process_knowledge_base(self.bot_id)
+                knowledge_base = get_knowledge_base(self.bot_id, process_knowledge_base)
                 
                 ai_response = get_ai_response(
                     message=message_text,
@@ -267,6 +275,12 @@ class InstagramBot:
                     self.send_message(sender_id, "❌ Obunangiz tugagan! Iltimos, obunani yangilang.")
                     return False
                 
+                # Rate limit - transkripsiya va AI kvotasini himoya qilish
+                rate = check_message_rate(self.bot_id, f"ig:{sender_id}", bot.owner.subscription_type if bot.owner else None)
+                if not rate.allowed:
+                    self.send_message(sender_id, rate_limit_message(rate, db_user.language))
+                    return True
+                
                 # Process audio
                 ai_response = download_and_process_audio(
                     audio_url=audio_url,
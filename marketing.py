@@ -625,6 +625,73 @@ https://t.me/akramjon0011"""
             'success': success_count,
             'failed': total_count - success_count
         }
+    
+    def send_subscription_notices(self, kind, user_ids, old_subscription_type=None):
+        """
+        Obuna eslatmalari/bildirishnomalarini bir guruh foydalanuvchiga yuborish
+        (scheduler dan Celery orqali partiyalab chaqiriladi)
+        
+        Args:
+            kind: 'paid_reminder', 'free_reminder', 'paid_expired' yoki 'free_expired'
+            user_ids: Foydalanuvchi ID lari
+            old_subscription_type: 'paid_expired' uchun eski ta'rif nomi
+        """
+        from notification_service import TelegramNotificationService
+        
+        success_count = 0
+        total_count = len(user_ids)
+        
+        with app.app_context():
+            users = User.query.filter(User.id.in_(user_ids)).all()
+            telegram_service = TelegramNotificationService()
+            now = datetime.utcnow()
+            
+            for user in users:
+                try:
+                    if kind in ('paid_reminder', 'free_reminder'):
+                        if not user.subscription_end_date:
+                            continue
+                        days_left = (user.subscription_end_date - now).days
+                        success = self.send_subscription_reminder(user, days_left)
+                        if kind == 'free_reminder':
+                            success = self.send_trial_ending_sms(user, days_left) or success
+                        
+                        # Telegram orqali ham eslatma (agar admin chat ID mavjud bo'lsa)
+                        if user.admin_chat_id:
+                            user_info = {
+                                'username': user.username,
+                                'subscription_type': user.subscription_type,
+                                'subscription_end_date': format_date(user.subscription_end_date)
+                            }
+                            success = telegram_service.send_subscription_reminder(
+                                user.admin_chat_id, user_info, days_left
+                            ) or success
+                    elif kind == 'paid_expired':
+                        success = False
+                        if user.admin_chat_id:
+                            user_info = {
+                                'username': user.username,
+                                'old_subscription_type': old_subscription_type or 'basic'
+                            }
+                            success = telegram_service.send_subscription_expired_notification(
+                                user.admin_chat_id, user_info
+                            )
+                    elif kind == 'free_expired':
+                        success = self.send_subscription_expired_notification(user)
+                    else:
+                        success = False
+                    
+                    if success:
+                        success_count += 1
+                        
+                except Exception as e:
+                    logger.error(f"Subscription notice ({kind}) error for user {user.id}: {str(e)}")
+        
+        return {
+            'total': total_count,
+            'success': success_count,
+            'failed': total_count - success_count
+        }
 
 # Marketing campaigns instance
 campaigns = MarketingCampaigns()
@@ -0,0 +1,106 @@
+"""
+Media fetch layer for voice/audio messages
+Caches Telegram getFile lookups and streams downloads into memory (no temp files)
+"""
+import os
+import io
+import logging
+import requests
+from typing import Optional, Dict
+
+from redis_cache import cache, cache_key
+
+logger = logging.getLogger(__name__)
+
+TELEGRAM_API_URL = "https://api.telegram.org"
+
+# Telegram file_path kamida 1 soat amal qiladi - biroz kamroq saqlaymiz
+TELEGRAM_FILE_PATH_TTL = int(os.environ.get('TELEGRAM_FILE_PATH_TTL', '3000'))
+# Bot API orqali yuklab olinadigan fayl hajmi chegarasi (20MB)
+MEDIA_MAX_BYTES = int(os.environ.get('MEDIA_MAX_BYTES', str(20 * 1024 * 1024)))
+MEDIA_CHUNK_SIZE = 64 * 1024
+MEDIA_TIMEOUT = (10, 30)  # (connect, read) soniya
+
+def _token_bot_id(bot_token: str) -> str:
+    """Token ning ochiq qismi (bot ID) - kalitda tokenni saqlamaslik uchun"""
+    return bot_token.split(':', 1)[0]
+
+def get_telegram_file_path(bot_token: str, file_id: str,
+                           session: Optional[requests.Session] = None) -> Optional[str]:
+    """
+    file_id -> file_path (getFile) TTL bilan keshlangan
+    """
+    key = cache_key("tg_file", _token_bot_id(bot_token), file_id)
+    try:
+        cached_path = cache.get(key)
+        if cached_path:
+            logger.debug(f"Cache HIT for getFile {file_id[:12]}")
+            return cached_path
+    except Exception as e:
+        logger.error(f"getFile cache get error: {e}")
+
+    http = session or requests
+    try:
+        response = http.get(
+            f"{TELEGRAM_API_URL}/bot{bot_token}/getFile",
+            params={'file_id': file_id},
+            timeout=MEDIA_TIMEOUT
+        )
+        data = response.json()
+    except Exception as e:
+        logger.error(f"Telegram getFile request error: {str(e)}")
+        return None
+
+    if not data.get('ok') or 'result' not in data:
+        logger.error(f"Telegram getFile API error: {data.get('description', 'unknown')}")
+        return None
+
+    file_path = data['result'].get('file_path')
+    if file_path:
+        try:
+            cache.set(key, file_path, ex=TELEGRAM_FILE_PATH_TTL)
+        except Exception as e:
+            logger.error(f"getFile cache set error: {e}")
+    return file_path
+
+def get_telegram_file_url(bot_token: str, file_id: str,
+                          session: Optional[requests.Session] = None) -> Optional[str]:
+    """Telegram fayl uchun yuklab olish URL"""
+    file_path = get_telegram_file_path(bot_token, file_id, session=session)
+    if not file_path:
+        return None
+    return f"{TELEGRAM_API_URL}/file/bot{bot_token}/{file_path}"
+
+def download_media(url: str, headers: Optional[Dict[str, str]] = None,
+                   max_bytes: int = MEDIA_MAX_BYTES,
+                   session: Optional[requests.Session] = None) -> Optional[bytes]:
+    """
+    Media faylni bo'laklab (chunk) xotiradagi buferga yuklash
+
+    Returns:
+        bytes yoki None (xato yoki hajm chegarasidan oshsa)
+    """
+    http = session or requests
+    try:
+        with http.get(url, headers=headers, stream=True, timeout=MEDIA_TIMEOUT) as response:
+            response.raise_for_status()
+
+            declared_size = int(response.headers.get('Content-Length') or 0)
+            if declared_size > max_bytes:
+                logger.warning(f"Media too large: {declared_size} bytes (limit {max_bytes})")
+                return None
+
+            buffer = io.BytesIO()
+            for chunk in response.iter_content(chunk_size=MEDIA_CHUNK_SIZE):
+                if not chunk:
+                    continue
+                buffer.write(chunk)
+                if buffer.tell() > max_bytes:
+                    logger.warning(f"Media download exceeded {max_bytes} bytes, aborted")
+                    return None
+
+            return buffer.getvalue()
+
+    except Exception as e:
+        logger.error(f"Media download error: {str(e)}")
+        return None
@@ -1,132 +1,224 @@
 """
 Database migrations and performance indices
-Adds critical indices for high-load performance
+Versioned, dialect-aware migration runner (schema_migrations jadvali bilan)
+
+Usage:
+    python migrations.py            # Kutilayotgan migratsiyalarni qo'llash
+    python migrations.py --status   # Qo'llangan / kutilayotgan versiyalar
 """
+import re
+import sys
 import logging
+from datetime import datetime
+from typing import Callable, List, Tuple
+
+from sqlalchemy import MetaData, Table, Column, String, DateTime, text, inspect
+from sqlalchemy.schema import CreateIndex
 from app import app, db
-from sqlalchemy import text, Index
 
 logger = logging.getLogger(__name__)
 
-def add_performance_indices():
+# Bir vaqtda faqat bitta jarayon migratsiya qiladi (gunicorn workerlar)
+MIGRATION_LOCK_ID = 740153
+
+_migration_metadata = MetaData()
+schema_migrations = Table(
+    'schema_migrations', _migration_metadata,
+    Column('version', String(64), primary_key=True),
+    Column('applied_at', DateTime, nullable=False, default=datetime.utcnow),
+)
+
+# Eski add_performance_indices / add_indices.py yaratgan, endi modeldagi indekslar bilan takrorlanadigan indekslar
+LEGACY_INDEXES = [
+    ('idx_user_telegram_id', 'user'),
+    ('idx_user_username', 'user'),
+    ('idx_user_email', 'user'),
+    ('idx_user_subscription', 'user'),
+    ('idx_user_subscription_active', 'user'),
+    ('idx_bot_user_id', 'bot'),
+    ('idx_bot_active', 'bot'),
+    ('idx_chat_bot_user', 'chat_history'),
+    ('idx_chat_created_desc', 'chat_history'),
+    ('idx_chat_bot_created', 'chat_history'),
+    ('idx_chat_recent_history', 'chat_history'),
+    ('idx_kb_bot_id', 'knowledge_base'),
+    ('idx_kb_content_type', 'knowledge_base'),
+    ('idx_kb_bot_type', 'knowledge_base'),
+    ('idx_payment_user', 'payment'),
+    ('idx_payment_status', 'payment'),
+    ('idx_payment_created', 'payment'),
+]
+
+def _existing_indexes(conn, table_name: str) -> set:
+    return {index['name'] for index in inspect(conn).get_indexes(table_name)}
+
+def _drop_invalid_pg_index(conn, index_name: str) -> None:
+    """Uzilib qolgan CREATE INDEX CONCURRENTLY INVALID indeks qoldiradi - uni tozalash"""
+    invalid = conn.execute(text(
+        "SELECT 1 FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid "
+        "WHERE c.relname = :name AND NOT i.indisvalid"
+    ), {'name': index_name}).first()
+    if invalid:
+        logger.warning(f"Dropping invalid index {index_name} left by an interrupted build")
+        conn.execute(text(f'DROP INDEX CONCURRENTLY IF EXISTS "{index_name}"'))
+
+def create_index(conn, index) -> bool:
     """
-    Add database indices for high-performance queries
-    Critical for handling high load scenarios
+    Modelda e'lon qilingan indeksni yaratish (mavjud bo'lsa - o'tkazib yuborish)
+    PostgreSQL da CREATE INDEX CONCURRENTLY - yozuvlarni bloklamaydi
     """
-    with app.app_context():
+    dialect = conn.dialect.name
+    if dialect == 'postgresql':
+        _drop_invalid_pg_index(conn, index.name)
+    if index.name in _existing_indexes(conn, index.table.name):
+        return False
+
+    ddl = str(CreateIndex(index).compile(dialect=conn.dialect))
+    if dialect == 'postgresql':
+        ddl = re.sub(r'^CREATE (UNIQUE )?INDEX', r'CREATE \1INDEX CONCURRENTLY IF NOT EXISTS', ddl)
+    elif dialect == 'sqlite':
+        ddl = re.sub(r'^CREATE (UNIQUE )?INDEX', r'CREATE \1INDEX IF NOT EXISTS', ddl)
+
+    started = datetime.utcnow()
+    conn.execute(text(ddl))
+    logger.info(f"Created index {index.name} on {index.table.name} in {(datetime.utcnow() - started).total_seconds():.1f}s")
+    return True
+
+def drop_index(conn, index_name: str, table_name: str) -> bool:
+    """Indeksni dialektga mos o'chirish"""
+    if index_name not in _existing_indexes(conn, table_name):
+        return False
+    dialect = conn.dialect.name
+    preparer = conn.dialect.identifier_preparer
+    if dialect == 'postgresql':
+        conn.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {preparer.quote(index_name)}"))
+    elif dialect == 'mysql':
+        conn.execute(text(f"DROP INDEX {preparer.quote(index_name)} ON {preparer.quote(table_name)}"))
+    else:
+        conn.execute(text(f"DROP INDEX IF EXISTS {preparer.quote(index_name)}"))
+    logger.info(f"Dropped index {index_name} on {table_name}")
+    return True
+
+# --- Migratsiyalar (versiya tartibida, faqat oxiriga qo'shiladi) ---
+
+def _0001_model_indexes(conn) -> None:
+    """Modellarda e'lon qilingan barcha indekslar (mavjud jadvallar uchun)"""
+    table_names = set(inspect(conn).get_table_names())
+    for table in db.metadata.sorted_tables:
+        if table.name not in table_names:
+            continue
+        for index in sorted(table.indexes, key=lambda index: index.name):
+            create_index(conn, index)
+
+def _0002_drop_legacy_indexes(conn) -> None:
+    """Takrorlanuvchi eski idx_* indekslar - har biri yozuvlarni sekinlashtiradi"""
+    table_names = set(inspect(conn).get_table_names())
+    for index_name, table_name in LEGACY_INDEXES:
+        if table_name in table_names:
+            drop_index(conn, index_name, table_name)
+
+MIGRATIONS: List[Tuple[str, Callable]] = [
+    ('0001_model_indexes', _0001_model_indexes),
+    ('0002_drop_legacy_indexes', _0002_drop_legacy_indexes),
+]
+
+def _applied_versions(conn) -> set:
+    return {row[0] for row in conn.execute(schema_migrations.select())}
+
+def _acquire_lock(conn) -> bool:
+    if conn.dialect.name == 'postgresql':
+        return bool(conn.execute(text("SELECT pg_try_advisory_lock(:id)"), {'id': MIGRATION_LOCK_ID}).scalar())
+    return True
+
+def _release_lock(conn) -> None:
+    if conn.dialect.name == 'postgresql':
+        conn.execute(text("SELECT pg_advisory_unlock(:id)"), {'id': MIGRATION_LOCK_ID})
+
+def run_migrations() -> List[str]:
+    """
+    Kutilayotgan migratsiyalarni tartib bo'yicha qo'llash
+
+    Returns:
+        list: Shu safar qo'llangan versiyalar
+    """
+    applied_now = []
+    # CONCURRENTLY tranzaksiya ichida ishlamaydi - AUTOCOMMIT ulanish
+    with db.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+        _migration_metadata.create_all(conn, checkfirst=True)
+        if not _acquire_lock(conn):
+            logger.info("Another process is running migrations - skipping")
+            return applied_now
         try:
-            # User table indices
-            indices_to_create = [
-                # User lookups
-                "CREATE INDEX IF NOT EXISTS idx_user_telegram_id ON user(telegram_id)",
-                "CREATE INDEX IF NOT EXISTS idx_user_username ON user(username)",
-                "CREATE INDEX IF NOT EXISTS idx_user_email ON user(email)",
-                "CREATE INDEX IF NOT EXISTS idx_user_subscription ON user(subscription_type, subscription_end_date)",
-                
-                # Bot table indices
-                "CREATE INDEX IF NOT EXISTS idx_bot_user_id ON bot(user_id)",
-                "CREATE INDEX IF NOT EXISTS idx_bot_token ON bot(token)",
-                "CREATE INDEX IF NOT EXISTS idx_bot_active ON bot(is_active)",
-                
-                # Chat history indices (most critical for performance)
-                "CREATE INDEX IF NOT EXISTS idx_chat_bot_user ON chat_history(bot_id, user_telegram_id)",
-                "CREATE INDEX IF NOT EXISTS idx_chat_created_desc ON chat_history(created_at DESC)",
-                "CREATE INDEX IF NOT EXISTS idx_chat_bot_created ON chat_history(bot_id, created_at DESC)",
-                
-                # Knowledge base indices
-                "CREATE INDEX IF NOT EXISTS idx_kb_bot_id ON knowledge_base(bot_id)",
-                "CREATE INDEX IF NOT EXISTS idx_kb_content_type ON knowledge_base(content_type)",
-                "CREATE INDEX IF NOT EXISTS idx_kb_bot_type ON knowledge_base(bot_id, content_type)",
-                
-                # Payment indices
-                "CREATE INDEX IF NOT EXISTS idx_payment_user ON payment(user_id)",
-                "CREATE INDEX IF NOT EXISTS idx_payment_status ON payment(status)",
-                "CREATE INDEX IF NOT EXISTS idx_payment_created ON payment(created_at DESC)",
-                
-                # Composite indices for common queries
-                "CREATE INDEX IF NOT EXISTS idx_user_subscription_active ON user(subscription_type, subscription_end_date, is_active)",
-                "CREATE INDEX IF NOT EXISTS idx_chat_recent_history ON chat_history(bot_id, user_telegram_id, created_at DESC)",
-            ]
-            
-            for index_sql in indices_to_create:
-                try:
-                    db.session.execute(text(index_sql))
-                    logger.info(f"Created index: {index_sql.split()[-1]}")
-                except Exception as e:
-                    if "already exists" not in str(e).lower():
-                        logger.error(f"Index creation failed: {e}")
-            
-            db.session.commit()
-            logger.info("Performance indices created successfully")
-            
-        except Exception as e:
-            logger.error(f"Index creation failed: {e}")
-            db.session.rollback()
+            applied = _applied_versions(conn)
+            for version, migration in MIGRATIONS:
+                if version in applied:
+                    continue
+                logger.info(f"Applying migration {version}...")
+                migration(conn)
+                conn.execute(schema_migrations.insert().values(version=version, applied_at=datetime.utcnow()))
+                applied_now.append(version)
+                logger.info(f"Migration {version} applied")
+        finally:
+            _release_lock(conn)
+    return applied_now
+
+def migration_status() -> List[Tuple[str, bool]]:
+    """(versiya, qo'llanganmi) ro'yxati"""
+    with db.engine.connect() as conn:
+        _migration_metadata.create_all(conn, checkfirst=True)
+        conn.commit()
+        applied = _applied_versions(conn)
+    return [(version, version in applied) for version, _ in MIGRATIONS]
 
-def optimize_database_settings():
+def add_performance_indices():
     """
-    Apply database-specific optimizations
+    Add database indices for high-performance queries
+    (indekslar endi modellarda e'lon qilingan - versiyalangan runner orqali)
     """
     with app.app_context():
         try:
-            # PostgreSQL-specific optimizations
-            optimizations = [
-                # Connection settings
-                "SET shared_preload_libraries = 'pg_stat_statements'",
-                
-                # Query optimization
-                "SET random_page_cost = 1.1",  # For SSD storage
-                "SET effective_cache_size = '256MB'",
-                "SET work_mem = '8MB'",
-                
-                # Checkpoint settings for write performance
-                "SET checkpoint_completion_target = 0.9",
-                "SET wal_buffers = '16MB'",
-                
-                # Logging for performance monitoring
-                "SET log_min_duration_statement = 1000",  # Log slow queries
-                "SET log_checkpoints = on",
-            ]
-            
-            for optimization in optimizations:
-                try:
-                    db.session.execute(text(optimization))
-                    logger.info(f"Applied optimization: {optimization.split('=')[0].strip()}")
-                except Exception as e:
-                    logger.warning(f"Optimization skipped: {e}")
-            
-            db.session.commit()
-            logger.info("Database optimizations applied")
-            
+            return run_migrations()
         except Exception as e:
-            logger.error(f"Database optimization failed: {e}")
-            db.session.rollback()
+            logger.error(f"Index migration failed: {e}")
+            raise
 
 def analyze_database_performance():
     """
     Analyze current database performance and suggest improvements
+    (jarayondagi slow-query log + PostgreSQL da pg_stats)
     """
+    from query_monitor import slow_query_log
+
     with app.app_context():
         try:
+            # Eng ko'p vaqt olgan so'rovlar (keyingi indeks shu yerdan topiladi)
+            top_statements = slow_query_log.top(limit=10)
+            for row in top_statements:
+                logger.info(f"Top query: {row['total_ms']}ms total, {row['count']} calls, "
+                            f"max {row['max_ms']}ms: {row['statement'][:200]}")
+
+            if db.engine.dialect.name != 'postgresql':
+                return {'top_statements': top_statements}
+
             # Get table sizes
             result = db.session.execute(text("""
-                SELECT 
+                SELECT
                     schemaname,
                     tablename,
                     attname,
                     n_distinct,
                     correlation
-                FROM pg_stats 
+                FROM pg_stats
                 WHERE schemaname = 'public'
                 ORDER BY tablename, attname
             """))
-            
+
             stats = result.fetchall()
             logger.info(f"Database statistics collected for {len(stats)} columns")
-            
+
             # Check for missing indices on large tables
             result = db.session.execute(text("""
-                SELECT 
+                SELECT
                     t.relname as table_name,
                     t.n_tup_ins as inserts,
                     t.n_tup_upd as updates,
@@ -135,22 +227,27 @@ def analyze_database_performance():
                 FROM pg_stat_user_tables t
                 ORDER BY pg_total_relation_size(t.relid) DESC
             """))
-            
+
             table_stats = result.fetchall()
             for stat in table_stats:
                 logger.info(f"Table {stat[0]}: Size {stat[4]}, Inserts: {stat[1]}")
-            
+
             return {
                 'column_stats': len(stats),
-                'table_stats': len(table_stats)
+                'table_stats': len(table_stats),
+                'top_statements': top_statements
             }
-            
+
         except Exception as e:
             logger.error(f"Performance analysis failed: {e}")
             return {'error': str(e)}
 
 if __name__ == "__main__":
-    # Run migrations
-    add_performance_indices()
-    optimize_database_settings()
-    analyze_database_performance()
\ No newline at end of file
+    logging.basicConfig(level=logging.INFO)
+    with app.app_context():
+        if '--status' in sys.argv:
+            for version, is_applied in migration_status():
+                print(f"{'✅' if is_applied else '⏳'} {version}")
+        else:
+            applied = run_migrations()
+            print(f"🚀 Applied {len(applied)} migration(s): {', '.join(applied) or 'none'}")
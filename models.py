@@ -2,7 +2,8 @@ from typing import Optional, List
 from app import db
 from flask_login import UserMixin
 from datetime import datetime, timedelta
-from sqlalchemy import Text, String
+from sqlalchemy import Text, String, event, inspect
+from sqlalchemy.orm import Session, object_session
 from sqlalchemy.dialects import sqlite, mysql, postgresql
 
 class User(UserMixin, db.Model):
@@ -31,6 +32,11 @@ class User(UserMixin, db.Model):
     bots = db.relationship('Bot', backref='owner', lazy=True, cascade='all, delete-orphan')
     payments = db.relationship('Payment', backref='user', lazy=True)
     
+    # Obuna tekshiruvi (scheduler) uchun
+    __table_args__ = (
+        db.Index('ix_user_subscription', 'subscription_type', 'subscription_end_date'),
+    )
+    
     def __repr__(self):
         return f'<User {self.username}>'
     
@@ -105,6 +111,10 @@ class Bot(db.Model):
     # Relationships
     knowledge_base = db.relationship('KnowledgeBase', backref='bot', lazy=True, cascade='all, delete-orphan')
     
+    __table_args__ = (
+        db.Index('ix_bot_user_id', 'user_id'),
+    )
+    
     def __repr__(self):
         return f'<Bot {self.name}>'
 
@@ -122,6 +132,10 @@ class KnowledgeBase(db.Model):
     source_name = db.Column(db.String(200))  # Custom name for text/image entries
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     
+    __table_args__ = (
+        db.Index('ix_knowledge_base_bot_type', 'bot_id', 'content_type'),
+    )
+    
     def __repr__(self):
         return f'<KnowledgeBase {self.source_name or self.filename}>'
 
@@ -135,6 +149,11 @@ class Payment(db.Model):
     subscription_type = db.Column(db.String(20))  # basic/premium
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     
+    __table_args__ = (
+        db.Index('ix_payment_user_id', 'user_id'),
+        db.Index('ix_payment_status_created', 'status', 'created_at'),
+    )
+    
     def __repr__(self):
         return f'<Payment {self.amount} {self.method}>'
 
@@ -158,6 +177,13 @@ class ChatHistory(db.Model):
     language = db.Column(db.String(2), default='uz')
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     
+    # Hot path: suhbat tarixi (prompt uchun), bot bo'yicha so'nggi xabarlar, retention/rollup oynalari
+    __table_args__ = (
+        db.Index('ix_chat_history_bot_user_created', 'bot_id', 'user_telegram_id', created_at.desc()),
+        db.Index('ix_chat_history_bot_created', 'bot_id', created_at.desc()),
+        db.Index('ix_chat_history_created_at', 'created_at'),
+    )
+    
     def __repr__(self):
         return f'<ChatHistory {self.user_telegram_id}>'
 
@@ -221,3 +247,86 @@ class BotMessage(db.Model):
     
     def __repr__(self):
         return f'<BotMessage {self.id} - {self.message_type}>'
+
+class MessageStatHourly(db.Model):
+    """Soatlik xabarlar soni rollup (bot_id, soat) -> son"""
+    bot_id = db.Column(db.Integer, primary_key=True)  # FK yo'q - bot o'chirilsa ham statistika qoladi
+    hour = db.Column(db.DateTime, primary_key=True)
+    message_count = db.Column(db.Integer, default=0, nullable=False)
+    
+    def __repr__(self):
+        return f'<MessageStatHourly {self.bot_id} {self.hour}>'
+
+class PlanStat(db.Model):
+    """Ta'rif bo'yicha foydalanuvchilar soni rollup"""
+    plan = db.Column(db.String(20), primary_key=True)
+    user_count = db.Column(db.Integer, default=0, nullable=False)
+    active_user_count = db.Column(db.Integer, default=0, nullable=False)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    def __repr__(self):
+        return f'<PlanStat {self.plan} {self.user_count}>'
+
+class PaymentStatDaily(db.Model):
+    """Kunlik to'lovlar rollup (kun, ta'rif, holat) -> son va summa"""
+    day = db.Column(db.Date, primary_key=True)
+    plan = db.Column(db.String(20), primary_key=True)
+    status = db.Column(db.String(20), primary_key=True)
+    payment_count = db.Column(db.Integer, default=0, nullable=False)
+    revenue = db.Column(db.Float, default=0, nullable=False)
+    
+    def __repr__(self):
+        return f'<PaymentStatDaily {self.day} {self.plan} {self.status}>'
+
+# --- Kesh invalidatsiyasi: o'zgarishlar commit qilingandan keyin barcha workerlarda L1/L2 kesh o'chiriladi ---
+
+_USER_CONTEXT_FIELDS = ('language', 'subscription_type', 'subscription_end_date', '_is_active', 'telegram_id')
+
+def _queue_invalidation(target, kind: str, value) -> None:
+    session = object_session(target)
+    if session is not None and value is not None:
+        session.info.setdefault('cache_invalidations', set()).add((kind, value))
+
+def queue_cache_invalidations(session, kind: str, values) -> None:
+    """Bulk query.update() mapper eventlarini chaqirmaydi - o'zgargan ID lar commit dan keyin shu yerdan invalidatsiya qilinadi"""
+    session.info.setdefault('cache_invalidations', set()).update((kind, value) for value in values if value is not None)
+
+@event.listens_for(KnowledgeBase, 'after_insert')
+@event.listens_for(KnowledgeBase, 'after_update')
+@event.listens_for(KnowledgeBase, 'after_delete')
+def _knowledge_base_changed(mapper, connection, target):
+    _queue_invalidation(target, 'kb', target.bot_id)
+
+@event.listens_for(Bot, 'after_update')
+@event.listens_for(Bot, 'after_delete')
+def _bot_changed(mapper, connection, target):
+    _queue_invalidation(target, 'bot', target.id)
+
+@event.listens_for(User, 'after_update')
+def _user_changed(mapper, connection, target):
+    state = inspect(target)
+    if any(state.attrs[field].history.has_changes() for field in _USER_CONTEXT_FIELDS):
+        # Kontekst telegram_id bo'yicha keshlanadi (eski va yangi qiymat)
+        history = state.attrs.telegram_id.history
+        for telegram_id in set(history.deleted or ()) | {target.telegram_id}:
+            if telegram_id and str(telegram_id).isdigit():
+                _queue_invalidation(target, 'user', int(telegram_id))
+
+@event.listens_for(Session, 'after_commit')
+def _invalidate_caches(session):
+    pending = session.info.pop('cache_invalidations', None)
+    if not pending:
+        return
+    from redis_cache import invalidate_knowledge_base, invalidate_user_context
+    from bot_registry import invalidate_bot
+    for kind, value in pending:
+        if kind == 'kb':
+            invalidate_knowledge_base(value)
+        elif kind == 'bot':
+            invalidate_bot(value)
+        else:
+            invalidate_user_context(value)
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_invalidations(session):
+    session.info.pop('cache_invalidations', None)
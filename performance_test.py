@@ -4,6 +4,7 @@ Performance test script for Bot Factory AI
 Tests concurrent bot responses and system load
 """
 import time
+import random
 import asyncio
 import aiohttp
 import concurrent.futures
@@ -169,6 +170,258 @@ def test_database_performance():
             logger.error(f"❌ Database test failed: {e}")
             return False
 
+def test_stats_rollup():
+    """
+    Rollup jadvallarini bir marta yangilash va PlanStat to'ldirilganini tekshirish
+    """
+    import sys
+    import os
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    
+    from app import app, db
+    from models import User, PlanStat
+    from stats_rollup import refresh_stats_rollup, refresh_plan_stats, plan_user_counts
+    
+    with app.app_context():
+        # Xatolar refresh_stats_rollup ichida yutiladi - to'g'ridan-to'g'ri chaqiruv xatoni ko'rsatadi
+        refresh_plan_stats()
+        refresh_stats_rollup()
+        
+        user_count = User.query.count()
+        counts = plan_user_counts()
+        if user_count:
+            assert PlanStat.query.count() > 0, "PlanStat rollup is empty"
+        assert sum(total for total, _ in counts.values()) == user_count
+        logger.info(f"✅ Stats rollup: {len(counts)} plans, {user_count} users")
+        return True
+
+def simulate_long_polling(bot_count: int = 1000, duration: float = 3600.0,
+                          poll_timeout: float = 50.0, sleep_after_poll: float = 0.0,
+                          sleep_when_empty: float = 0.0, messages_per_hour: float = 0.0,
+                          seed: int = 42) -> Dict:
+    """
+    Simulate getUpdates long polling for many bots on a virtual clock.
+    Counts HTTP requests and the latency the polling loop adds to each message
+    (time between a message arriving at Telegram and the bot receiving it).
+    """
+    rng = random.Random(seed)
+    total_requests = 0
+    latencies: List[float] = []
+    
+    for _ in range(bot_count):
+        now = rng.uniform(0, poll_timeout)  # Bots start polling at different times
+        
+        # Poisson message arrivals for this bot
+        arrivals = []
+        if messages_per_hour > 0:
+            t = now + rng.expovariate(messages_per_hour / 3600.0)
+            while t < duration:
+                arrivals.append(t)
+                t += rng.expovariate(messages_per_hour / 3600.0)
+        
+        pending = 0  # Index of the first undelivered message
+        while now < duration:
+            total_requests += 1
+            if pending < len(arrivals) and arrivals[pending] <= now:
+                # Updates already waiting - Telegram answers immediately
+                delivered_at = now
+            elif pending < len(arrivals) and arrivals[pending] <= now + poll_timeout:
+                # Long poll is held open until the message arrives
+                delivered_at = arrivals[pending]
+            else:
+                # Idle poll - returns empty after the timeout
+                now += poll_timeout + sleep_when_empty
+                continue
+            
+            while pending < len(arrivals) and arrivals[pending] <= delivered_at:
+                latencies.append(delivered_at - arrivals[pending])
+                pending += 1
+            now = delivered_at + sleep_after_poll
+    
+    hours = duration / 3600.0
+    return {
+        'bots': bot_count,
+        'requests_total': total_requests,
+        'requests_per_minute': total_requests / (duration / 60.0),
+        'requests_per_bot_per_hour': total_requests / bot_count / hours,
+        'messages': len(latencies),
+        'avg_added_latency': sum(latencies) / len(latencies) if latencies else 0.0,
+        'max_added_latency': max(latencies) if latencies else 0.0
+    }
+
+def benchmark_long_polling(bot_count: int = 1000) -> Dict:
+    """
+    Compare the legacy polling loop (timeout=10 + 1s sleep after every poll)
+    with long polling (timeout=50, no sleep) for idle and busy bots.
+    """
+    scenarios = {
+        'legacy': {'poll_timeout': 10.0, 'sleep_after_poll': 1.0, 'sleep_when_empty': 1.0},
+        'long_poll': {'poll_timeout': 50.0, 'sleep_after_poll': 0.0, 'sleep_when_empty': 0.0},
+    }
+    results = {}
+    for name, params in scenarios.items():
+        results[name] = {
+            'idle': simulate_long_polling(bot_count=bot_count, **params),
+            'busy': simulate_long_polling(bot_count=bot_count, messages_per_hour=120, **params)
+        }
+        idle, busy = results[name]['idle'], results[name]['busy']
+        logger.info(
+            f"{name}: idle {idle['requests_per_minute']:.0f} req/min for {bot_count} bots "
+            f"({idle['requests_per_bot_per_hour']:.1f}/bot/hour), busy added latency "
+            f"avg {busy['avg_added_latency'] * 1000:.0f}ms max {busy['max_added_latency'] * 1000:.0f}ms"
+        )
+    return results
+
+# Recorded getUpdates payloads (anonymised) for the update dispatch benchmark
+RECORDED_UPDATES = [
+    {'update_id': 1, 'message': {'message_id': 10, 'from': {'id': 111, 'first_name': 'Ali', 'username': 'ali'},
+                                 'chat': {'id': 111, 'type': 'private'}, 'date': 1700000000, 'text': '/start'}},
+    {'update_id': 2, 'message': {'message_id': 11, 'from': {'id': 111, 'first_name': 'Ali', 'username': 'ali'},
+                                 'chat': {'id': 111, 'type': 'private'}, 'date': 1700000005,
+                                 'text': 'Salom, narxi qancha?'}},
+    {'update_id': 3, 'message': {'message_id': 12, 'from': {'id': 222, 'first_name': 'Olga'},
+                                 'chat': {'id': 222, 'type': 'private'}, 'date': 1700000010,
+                                 'voice': {'file_id': 'AwACAgIAAxkBAAI', 'file_unique_id': 'AgADYw',
+                                           'duration': 4, 'mime_type': 'audio/ogg'}}},
+    {'update_id': 4, 'callback_query': {'id': '4382', 'from': {'id': 222, 'first_name': 'Olga'}, 'data': 'lang_ru',
+                                        'message': {'message_id': 13, 'chat': {'id': 222, 'type': 'private'}}}},
+    {'update_id': 5, 'message': {'message_id': 14, 'from': {'id': 333, 'first_name': 'John'},
+                                 'chat': {'id': 333, 'type': 'private'}, 'date': 1700000020, 'text': '/language'}},
+]
+
+async def _legacy_process_update(handlers, update_data):
+    """Copy of the previous process_update: classes were defined per call"""
+    class SimpleUpdate:
+        def __init__(self, data):
+            self.data = data
+            self.message = None
+            self.callback_query = None
+            self.effective_user = None
+            self.effective_chat = None
+            if 'message' in data:
+                self.message = SimpleMessage(data['message'])
+                self.effective_user = SimpleUser(data['message']['from'])
+                self.effective_chat = SimpleChat(data['message']['chat'])
+            elif 'callback_query' in data:
+                self.callback_query = SimpleCallbackQuery(data['callback_query'])
+                self.effective_user = SimpleUser(data['callback_query']['from'])
+                self.effective_chat = SimpleChat(data['callback_query']['message']['chat'])
+    
+    class SimpleMessage:
+        def __init__(self, data):
+            self.data = data
+            self.text = data.get('text', '')
+            self.voice = data.get('voice')
+            self.audio = data.get('audio')
+            self.document = data.get('document')
+            self.chat = SimpleChat(data['chat'])
+    
+    class SimpleUser:
+        def __init__(self, data):
+            self.data = data
+            self.id = data['id']
+            self.username = data.get('username', '')
+            self.first_name = data.get('first_name', '')
+    
+    class SimpleChat:
+        def __init__(self, data):
+            self.data = data
+            self.id = data['id']
+    
+    class SimpleCallbackQuery:
+        def __init__(self, data):
+            self.data = data.get('data', '')
+            self.id = data.get('id', '')
+            self.from_user = SimpleUser(data['from'])
+            self.message = data.get('message', {})
+    
+    update = SimpleUpdate(update_data)
+    
+    class SimpleContext:
+        def __init__(self, text=None, bot=None):
+            self.args = []
+            self.bot = bot
+            if text and text.startswith('/'):
+                self.args = text.split()[1:]
+    
+    if update.message and (update.message.voice or update.message.audio):
+        context = SimpleContext(None, None)
+        for handler in handlers.get('voice', []):
+            await handler(update, context)
+    elif update.message and update.message.text:
+        text = update.message.text
+        context = SimpleContext(text, None)
+        if text.startswith('/'):
+            cmd = text.split()[0][1:]
+            if 'start' in handlers and cmd == 'start':
+                for handler in handlers['start']:
+                    await handler(update, context)
+            elif 'help' in handlers and cmd == 'help':
+                for handler in handlers['help']:
+                    await handler(update, context)
+            elif 'language' in handlers and cmd == 'language':
+                for handler in handlers['language']:
+                    await handler(update, context)
+        elif 'message' in handlers:
+            for handler in handlers['message']:
+                await handler(update, context)
+    if update.callback_query and 'callback' in handlers:
+        context = SimpleContext()
+        for handler in handlers['callback']:
+            await handler(update, context)
+
+def benchmark_update_dispatch(rounds: int = 20000) -> Dict:
+    """
+    Microbenchmark: parse and dispatch recorded updates with no-op handlers,
+    legacy per-call nested classes vs module-level slotted models
+    """
+    import sys
+    import os
+    import tracemalloc
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    
+    from telegram_bot import TelegramHTTPBot
+    
+    async def noop(update, context):
+        return None
+    
+    bot = TelegramHTTPBot("0:benchmark")
+    legacy_handlers = {name: [noop] for name in ('start', 'help', 'language', 'message', 'voice', 'callback')}
+    for key in ('/start', '/help', '/language', 'message', 'voice', 'callback'):
+        bot.add_handler((key, noop))
+    
+    def run_legacy():
+        for update in RECORDED_UPDATES:
+            coro = _legacy_process_update(legacy_handlers, update)
+            try:
+                coro.send(None)
+            except StopIteration:
+                pass
+    
+    def run_slotted():
+        for update in RECORDED_UPDATES:
+            coro = bot.process_update(update)
+            try:
+                coro.send(None)
+            except StopIteration:
+                pass
+    
+    results = {}
+    for name, func in (('legacy', run_legacy), ('slotted', run_slotted)):
+        tracemalloc.start()
+        start_time = time.perf_counter()
+        for _ in range(rounds):
+            func()
+        elapsed = time.perf_counter() - start_time
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        
+        per_update_us = elapsed / (rounds * len(RECORDED_UPDATES)) * 1_000_000
+        results[name] = {'per_update_us': per_update_us, 'peak_bytes': peak}
+        logger.info(f"Update dispatch ({name}): {per_update_us:.2f}µs/update, peak {peak / 1024:.0f}KB")
+    
+    return results
+
 async def main():
     """
     Run performance tests
@@ -178,6 +431,11 @@ async def main():
     # Test 1: Database performance
     logger.info("\n📊 Testing Database Performance...")
     db_success = test_database_performance()
+    try:
+        test_stats_rollup()
+    except Exception as e:
+        logger.error(f"❌ Stats rollup test failed: {e}")
+        db_success = False
     
     # Test 2: Light load test (skip webhook test for now)
     logger.info("\n⚡ Simulating concurrent user interactions...")
@@ -210,6 +468,17 @@ async def main():
     except Exception as e:
         logger.error(f"AI performance test failed: {e}")
     
+    # Test 3: getUpdates long polling (simulated, no network)
+    logger.info("\n📡 Simulating getUpdates polling for 1000 idle bots...")
+    benchmark_long_polling(bot_count=1000)
+    
+    # Test 4: update parsing/dispatch microbenchmark
+    logger.info("\n🧩 Benchmarking update dispatch over recorded updates...")
+    try:
+        benchmark_update_dispatch()
+    except Exception as e:
+        logger.error(f"Update dispatch benchmark failed: {e}")
+    
     logger.info("\n🎯 Performance Test Summary:")
     logger.info(f"✅ Database: {'OPTIMIZED' if db_success else 'NEEDS WORK'}")
     logger.info("✅ PostgreSQL with connection pooling: ACTIVE")
@@ -0,0 +1,349 @@
+"""
+Query-count guard, N+1 detector and slow-query log
+Counts SQL statements and DB time per Flask request / bot handler via SQLAlchemy cursor events,
+keeps per-fingerprint totals and captures EXPLAIN plans for slow SELECTs
+"""
+import os
+import re
+import time
+import asyncio
+import logging
+import threading
+import functools
+import contextvars
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Dict, Any, List, Optional
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger(__name__)
+
+# Bitta scope uchun so'rovlar chegarasi (oshsa - ogohlantirish)
+QUERY_BUDGET_REQUEST = int(os.environ.get('QUERY_BUDGET_REQUEST', '30'))
+QUERY_BUDGET_HANDLER = int(os.environ.get('QUERY_BUDGET_HANDLER', '15'))
+# Bir xil fingerprint shuncha marta takrorlansa - N+1 deb belgilanadi
+N_PLUS_ONE_THRESHOLD = int(os.environ.get('N_PLUS_ONE_THRESHOLD', '5'))
+
+# Sekin so'rovlar logi
+SLOW_QUERY_MS = float(os.environ.get('SLOW_QUERY_MS', '200'))
+SLOW_QUERY_EXPLAIN = os.environ.get('SLOW_QUERY_EXPLAIN', '1') == '1'
+SLOW_QUERY_EXPLAIN_INTERVAL = int(os.environ.get('SLOW_QUERY_EXPLAIN_INTERVAL', '600'))  # Bitta fingerprint uchun, soniya
+SLOW_QUERY_EXPLAIN_TIMEOUT_MS = int(os.environ.get('SLOW_QUERY_EXPLAIN_TIMEOUT_MS', '5000'))
+SLOW_QUERY_MAX_FINGERPRINTS = int(os.environ.get('SLOW_QUERY_MAX_FINGERPRINTS', '1000'))
+SLOW_QUERY_TOP_N = int(os.environ.get('SLOW_QUERY_TOP_N', '20'))
+
+_current_scope: contextvars.ContextVar = contextvars.ContextVar('query_scope', default=None)
+# EXPLAIN ishlayotgan oqimdagi so'rovlar o'zi hisobga olinmaydi
+_explaining: contextvars.ContextVar = contextvars.ContextVar('query_monitor_explaining', default=False)
+
+_FINGERPRINT_RULES = [
+    (re.compile(r"'(?:[^']|'')*'"), '?'),                       # satr literallari
+    (re.compile(r'(%\([^)]+\)s|%s|:\w+|\$\d+)'), '?'),           # bind parametrlar
+    (re.compile(r'\b\d+(?:\.\d+)?\b'), '?'),                     # sonlar
+    (re.compile(r'\(\s*\?(?:\s*,\s*\?)+\s*\)'), '(?+)'),         # IN (?, ?, ...) ro'yxatlari
+    (re.compile(r'\s+'), ' '),
+]
+
+@functools.lru_cache(maxsize=2048)
+def fingerprint(statement: str) -> str:
+    """SQL ni normallashtirish: literallar va parametrlar -> ?, IN ro'yxatlari yig'iladi"""
+    normalized = statement.strip()
+    for pattern, replacement in _FINGERPRINT_RULES:
+        normalized = pattern.sub(replacement, normalized)
+    return normalized[:500]
+
+class QueryScope:
+    """Bitta so'rov / handler chaqiruvidagi SQL statistikasi"""
+    __slots__ = ('name', 'budget', 'count', 'db_time', 'statements', 'started')
+
+    def __init__(self, name: str, budget: int):
+        self.name = name
+        self.budget = budget
+        self.count = 0
+        self.db_time = 0.0
+        self.statements = Counter()
+        self.started = time.perf_counter()
+
+    def most_repeated(self):
+        if not self.statements:
+            return None, 0
+        return self.statements.most_common(1)[0]
+
+class QueryStats:
+    """Scope nomi bo'yicha yig'ilgan statistika (admin metrics sahifasi uchun)"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._scopes: Dict[str, Dict[str, Any]] = {}
+
+    def record(self, scope: QueryScope, over_budget: bool, repeated: Optional[str], repeated_count: int):
+        with self._lock:
+            entry = self._scopes.setdefault(scope.name, {
+                'calls': 0, 'queries': 0, 'max_queries': 0, 'db_time_ms': 0.0,
+                'over_budget': 0, 'n_plus_one': 0, 'last_offender': None
+            })
+            entry['calls'] += 1
+            entry['queries'] += scope.count
+            entry['max_queries'] = max(entry['max_queries'], scope.count)
+            entry['db_time_ms'] += scope.db_time * 1000
+            if over_budget:
+                entry['over_budget'] += 1
+            if repeated_count >= N_PLUS_ONE_THRESHOLD:
+                entry['n_plus_one'] += 1
+                entry['last_offender'] = {'statement': repeated, 'count': repeated_count}
+
+    def snapshot(self) -> Dict[str, Dict[str, Any]]:
+        with self._lock:
+            result = {}
+            for name, entry in self._scopes.items():
+                result[name] = dict(entry)
+                result[name]['avg_queries'] = round(entry['queries'] / entry['calls'], 1) if entry['calls'] else 0
+                result[name]['avg_db_time_ms'] = round(entry['db_time_ms'] / entry['calls'], 1) if entry['calls'] else 0
+                result[name]['db_time_ms'] = round(entry['db_time_ms'], 1)
+            return result
+
+    def reset(self):
+        with self._lock:
+            self._scopes.clear()
+
+query_stats = QueryStats()
+
+class SlowQueryLog:
+    """Fingerprint bo'yicha jami vaqt / soni va sekin SELECT lar uchun EXPLAIN namunasi"""
+
+    def __init__(self, max_fingerprints: int = SLOW_QUERY_MAX_FINGERPRINTS):
+        self._lock = threading.Lock()
+        self._entries: Dict[str, Dict[str, Any]] = {}
+        self.max_fingerprints = max_fingerprints
+
+    def record(self, statement_fingerprint: str, elapsed: float) -> bool:
+        """
+        Bajarilgan so'rovni hisobga olish
+
+        Returns:
+            bool: Sekin so'rov va shu fingerprint uchun log / EXPLAIN vaqti keldimi
+        """
+        elapsed_ms = elapsed * 1000
+        slow = elapsed_ms >= SLOW_QUERY_MS
+        with self._lock:
+            entry = self._entries.get(statement_fingerprint)
+            if entry is None:
+                if len(self._entries) >= self.max_fingerprints:
+                    self._evict()
+                entry = self._entries[statement_fingerprint] = {
+                    'count': 0, 'total_ms': 0.0, 'max_ms': 0.0, 'slow_count': 0,
+                    'last_slow_at': None, 'explain': None, 'explain_due': 0.0
+                }
+            entry['count'] += 1
+            entry['total_ms'] += elapsed_ms
+            entry['max_ms'] = max(entry['max_ms'], elapsed_ms)
+            if not slow:
+                return False
+            entry['slow_count'] += 1
+            entry['last_slow_at'] = datetime.utcnow()
+            now = time.monotonic()
+            if now < entry['explain_due']:
+                return False
+            entry['explain_due'] = now + SLOW_QUERY_EXPLAIN_INTERVAL
+            return True
+
+    def _evict(self) -> None:
+        # Eng kam vaqt olgan 10% fingerprintlar chiqariladi (lock ichida chaqiriladi)
+        victims = sorted(self._entries, key=lambda key: self._entries[key]['total_ms'])
+        for key in victims[:max(1, len(victims) // 10)]:
+            del self._entries[key]
+
+    def set_plan(self, statement_fingerprint: str, plan: Optional[str], duration_ms: float = 0.0,
+                 error: Optional[str] = None) -> None:
+        with self._lock:
+            entry = self._entries.get(statement_fingerprint)
+            if entry is not None:
+                entry['explain'] = {
+                    'plan': plan, 'error': error, 'duration_ms': round(duration_ms, 1),
+                    'captured_at': datetime.utcnow().isoformat()
+                }
+
+    def top(self, limit: int = SLOW_QUERY_TOP_N, key: str = 'total_ms') -> List[Dict[str, Any]]:
+        """Eng ko'p vaqt (total_ms) yoki eng ko'p chaqirilgan (count) fingerprintlar"""
+        with self._lock:
+            items = sorted(self._entries.items(), key=lambda item: item[1][key], reverse=True)[:limit]
+            return [self._serialize(statement, entry) for statement, entry in items]
+
+    def slow(self, limit: int = SLOW_QUERY_TOP_N) -> List[Dict[str, Any]]:
+        """Chegaradan oshgan fingerprintlar (EXPLAIN namunasi bilan), eng og'iridan"""
+        with self._lock:
+            items = [(statement, entry) for statement, entry in self._entries.items() if entry['slow_count']]
+            items.sort(key=lambda item: item[1]['max_ms'], reverse=True)
+            return [self._serialize(statement, entry) for statement, entry in items[:limit]]
+
+    @staticmethod
+    def _serialize(statement: str, entry: Dict[str, Any]) -> Dict[str, Any]:
+        return {
+            'statement': statement,
+            'count': entry['count'],
+            'total_ms': round(entry['total_ms'], 1),
+            'avg_ms': round(entry['total_ms'] / entry['count'], 2) if entry['count'] else 0,
+            'max_ms': round(entry['max_ms'], 1),
+            'slow_count': entry['slow_count'],
+            'last_slow_at': entry['last_slow_at'].isoformat() if entry['last_slow_at'] else None,
+            'explain': dict(entry['explain']) if entry['explain'] else None
+        }
+
+    def reset(self):
+        with self._lock:
+            self._entries.clear()
+
+slow_query_log = SlowQueryLog()
+
+_explain_executor: Optional[ThreadPoolExecutor] = None
+_explain_executor_lock = threading.Lock()
+
+def _get_explain_executor() -> ThreadPoolExecutor:
+    global _explain_executor
+    with _explain_executor_lock:
+        if _explain_executor is None:
+            _explain_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='query-explain')
+        return _explain_executor
+
+def _explain_statement(conn, statement: str, parameters) -> str:
+    """Dialektga mos EXPLAIN: PostgreSQL - ANALYZE, BUFFERS; SQLite - QUERY PLAN"""
+    dialect = conn.dialect.name
+    if dialect == 'postgresql':
+        # ANALYZE so'rovni haqiqatan bajaradi - vaqt chegarasi bilan
+        conn.exec_driver_sql(f"SET LOCAL statement_timeout = {SLOW_QUERY_EXPLAIN_TIMEOUT_MS}")
+        rows = conn.exec_driver_sql(f"EXPLAIN (ANALYZE, BUFFERS) {statement}", parameters).fetchall()
+        return '\n'.join(str(row[0]) for row in rows)
+    if dialect == 'sqlite':
+        rows = conn.exec_driver_sql(f"EXPLAIN QUERY PLAN {statement}", parameters).fetchall()
+        return '\n'.join(str(row[-1]) for row in rows)
+    rows = conn.exec_driver_sql(f"EXPLAIN {statement}", parameters).fetchall()
+    return '\n'.join(' | '.join(str(value) for value in row) for row in rows)
+
+def _capture_explain(engine, statement_fingerprint: str, statement: str, parameters) -> None:
+    token = _explaining.set(True)
+    started = time.perf_counter()
+    try:
+        with engine.connect() as conn:
+            try:
+                plan = _explain_statement(conn, statement, parameters or None)
+            finally:
+                conn.rollback()
+        slow_query_log.set_plan(statement_fingerprint, plan, (time.perf_counter() - started) * 1000)
+        logger.info(f"Captured EXPLAIN for slow query: {statement_fingerprint[:200]}")
+    except Exception as e:
+        logger.warning(f"EXPLAIN capture failed: {str(e)}")
+        slow_query_log.set_plan(statement_fingerprint, None, error=str(e))
+    finally:
+        _explaining.reset(token)
+
+def _schedule_explain(engine, statement_fingerprint: str, statement: str, parameters) -> None:
+    # Faqat SELECT - EXPLAIN ANALYZE DML ni qayta bajarib yubormasligi uchun
+    if statement.lstrip()[:6].upper() != 'SELECT':
+        return
+    if isinstance(parameters, dict):
+        parameters = dict(parameters)
+    elif parameters:
+        parameters = tuple(parameters)
+    try:
+        _get_explain_executor().submit(_capture_explain, engine, statement_fingerprint, statement, parameters)
+    except Exception as e:
+        logger.warning(f"EXPLAIN scheduling failed: {str(e)}")
+
+@contextmanager
+def query_scope(name: str, budget: int = QUERY_BUDGET_HANDLER):
+    """So'rovlar sanaladigan scope (ichma-ich scope bo'lsa - ichkisi sanaydi)"""
+    scope = QueryScope(name, budget)
+    token = _current_scope.set(scope)
+    try:
+        yield scope
+    finally:
+        _current_scope.reset(token)
+        finish_scope(scope)
+
+def finish_scope(scope: QueryScope) -> None:
+    repeated, repeated_count = scope.most_repeated()
+    over_budget = scope.count > scope.budget
+    if over_budget or repeated_count >= N_PLUS_ONE_THRESHOLD:
+        logger.warning(
+            f"Query budget exceeded in {scope.name}: {scope.count} queries "
+            f"(budget {scope.budget}), {scope.db_time * 1000:.1f}ms DB time; "
+            f"most repeated x{repeated_count}: {repeated}"
+        )
+    query_stats.record(scope, over_budget, repeated, repeated_count)
+
+def track_queries(name: Optional[str] = None, budget: int = QUERY_BUDGET_HANDLER):
+    """Handler / funksiya uchun dekorator (sync va async)"""
+    def decorator(func):
+        scope_name = name or f"{func.__module__}.{func.__qualname__}"
+
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with query_scope(scope_name, budget):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with query_scope(scope_name, budget):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if not _explaining.get():
+        conn.info['query_monitor_start'] = time.perf_counter()
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if _explaining.get():
+        return
+    started = conn.info.pop('query_monitor_start', None)
+    elapsed = time.perf_counter() - started if started is not None else 0.0
+    statement_fingerprint = fingerprint(statement)
+
+    scope = _current_scope.get()
+    if scope is not None:
+        scope.count += 1
+        scope.db_time += elapsed
+        scope.statements[statement_fingerprint] += 1
+
+    if slow_query_log.record(statement_fingerprint, elapsed):
+        logger.warning(f"Slow query ({elapsed * 1000:.1f}ms): {statement_fingerprint[:300]}")
+        if SLOW_QUERY_EXPLAIN and not executemany:
+            _schedule_explain(conn.engine, statement_fingerprint, statement, parameters)
+
+_installed = False
+
+def install_query_monitor(app=None) -> None:
+    """Engine eventlari va (berilsa) Flask request scope larini ulash"""
+    global _installed
+    if not _installed:
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+        _installed = True
+
+    if app is not None:
+        from flask import g, request
+
+        @app.before_request
+        def _start_request_scope():
+            scope = QueryScope(f"request:{request.endpoint or request.path}", QUERY_BUDGET_REQUEST)
+            g.query_scope_token = _current_scope.set(scope)
+            g.query_scope = scope
+
+        @app.teardown_request
+        def _finish_request_scope(exc=None):
+            scope = g.pop('query_scope', None)
+            token = g.pop('query_scope_token', None)
+            if scope is None:
+                return
+            try:
+                _current_scope.reset(token)
+            except ValueError:
+                _current_scope.set(None)
+            if request.endpoint != 'static':
+                finish_scope(scope)
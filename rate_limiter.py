@@ -0,0 +1,245 @@
+"""
+Rate limiting for message ingest paths
+Atomic Lua token-bucket / sliding-window limits in Redis, with an equivalent in-process fallback
+"""
+import os
+import json
+import math
+import time
+import logging
+import threading
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+from redis_cache import redis_client, cache_key
+
+logger = logging.getLogger(__name__)
+
+def _env_int(name: str, default: int) -> int:
+    return int(os.environ.get(name, str(default)))
+
+# Ta'rif bo'yicha limitlar:
+#   user       - oxirgi foydalanuvchi (chat) uchun token bucket: (sig'im, to'liq to'lish davri soniyada)
+#   bot_minute - bot uchun 1 daqiqalik sliding window
+#   bot_day    - bot uchun 24 soatlik sliding window (Gemini kvotasi)
+# Env: RATE_LIMIT_<PLAN>_USER, RATE_LIMIT_<PLAN>_BOT_MINUTE, RATE_LIMIT_<PLAN>_BOT_DAY (0 - cheklanmagan)
+_DEFAULT_PLAN_LIMITS = {
+    'free': (5, 30, 500),
+    'starter': (10, 60, 2000),
+    'basic': (15, 120, 5000),
+    'premium': (30, 300, 20000),
+}
+PLAN_RATE_LIMITS: Dict[str, Dict[str, int]] = {
+    plan: {
+        'user': _env_int(f'RATE_LIMIT_{plan.upper()}_USER', user),
+        'bot_minute': _env_int(f'RATE_LIMIT_{plan.upper()}_BOT_MINUTE', bot_minute),
+        'bot_day': _env_int(f'RATE_LIMIT_{plan.upper()}_BOT_DAY', bot_day),
+    }
+    for plan, (user, bot_minute, bot_day) in _DEFAULT_PLAN_LIMITS.items()
+}
+USER_REFILL_SECONDS = _env_int('RATE_LIMIT_USER_REFILL_SECONDS', 60)
+# Alohida botlar uchun: {"12": {"bot_minute": 600, "bot_day": 50000, "user": 20}}
+BOT_RATE_LIMIT_OVERRIDES: Dict[str, Dict[str, int]] = json.loads(os.environ.get('RATE_LIMIT_BOT_OVERRIDES', '{}') or '{}')
+UNLIMITED_PLANS = {'admin'}
+
+class Limit(NamedTuple):
+    name: str
+    key: str
+    kind: str       # 'tb' - token bucket, 'sw' - sliding window
+    limit: int      # sig'im / oynadagi maksimal so'rovlar
+    window_ms: int  # to'liq to'lish davri / oyna uzunligi
+
+class RateLimitResult(NamedTuple):
+    allowed: bool
+    limit_name: Optional[str] = None
+    retry_after: float = 0.0  # soniya
+
+# Barcha limitlar bitta skriptda: hammasi ruxsat bersa - barchasidan yechiladi, aks holda hech biridan
+# KEYS: limit kalitlari; ARGV: cost, keyin har limit uchun (kind, limit, window_ms)
+_LUA_SCRIPT = """
+local t = redis.call('TIME')
+local now = tonumber(t[1]) * 1000 + math.floor(tonumber(t[2]) / 1000)
+local cost = tonumber(ARGV[1])
+local states = {}
+local denied = 0
+local retry = 0
+for i = 1, #KEYS do
+  local kind = ARGV[i * 3 - 1]
+  local limit = tonumber(ARGV[i * 3])
+  local window = tonumber(ARGV[i * 3 + 1])
+  if kind == 'tb' then
+    local data = redis.call('HMGET', KEYS[i], 'tokens', 'ts')
+    local tokens = tonumber(data[1]) or limit
+    local ts = tonumber(data[2]) or now
+    local rate = limit / window
+    tokens = math.min(limit, tokens + math.max(0, now - ts) * rate)
+    states[i] = tokens
+    if tokens < cost then
+      if denied == 0 then denied = i end
+      retry = math.max(retry, math.ceil((cost - tokens) / rate))
+    end
+  else
+    local current = math.floor(now / window)
+    local data = redis.call('HMGET', KEYS[i], 'id', 'cur', 'prev')
+    local id = tonumber(data[1]) or current
+    local cur = tonumber(data[2]) or 0
+    local prev = tonumber(data[3]) or 0
+    if id == current - 1 then
+      prev = cur
+      cur = 0
+    elseif id ~= current then
+      prev = 0
+      cur = 0
+    end
+    local elapsed = now - current * window
+    states[i] = {current, cur, prev}
+    if prev * (window - elapsed) / window + cur + cost > limit then
+      if denied == 0 then denied = i end
+      retry = math.max(retry, window - elapsed)
+    end
+  end
+end
+if denied > 0 then
+  return {0, denied, retry}
+end
+for i = 1, #KEYS do
+  local window = tonumber(ARGV[i * 3 + 1])
+  if ARGV[i * 3 - 1] == 'tb' then
+    redis.call('HSET', KEYS[i], 'tokens', tostring(states[i] - cost), 'ts', now)
+    redis.call('PEXPIRE', KEYS[i], window)
+  else
+    local s = states[i]
+    redis.call('HSET', KEYS[i], 'id', s[1], 'cur', s[2] + cost, 'prev', s[3])
+    redis.call('PEXPIRE', KEYS[i], window * 2)
+  end
+end
+return {1, 0, 0}
+"""
+
+class LocalRateLimiter:
+    """Redis bo'lmaganda (yoki xatolikda) - xuddi shu algoritm jarayon ichida, thread-safe"""
+
+    MAX_KEYS = 50000
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._state: Dict[str, Tuple[float, list]] = {}  # key -> (expires_at_ms, state)
+
+    def check(self, limits: List[Limit], cost: int = 1) -> RateLimitResult:
+        now = time.time() * 1000
+        with self._lock:
+            if len(self._state) > self.MAX_KEYS:
+                for key in [key for key, (expires_at, _) in self._state.items() if expires_at <= now]:
+                    del self._state[key]
+
+            states = []
+            denied = None
+            retry = 0.0
+            for limit in limits:
+                expires_at, stored = self._state.get(limit.key, (0, None))
+                if expires_at <= now:
+                    stored = None
+                if limit.kind == 'tb':
+                    rate = limit.limit / limit.window_ms
+                    tokens, ts = stored if stored else (limit.limit, now)
+                    tokens = min(limit.limit, tokens + max(0, now - ts) * rate)
+                    states.append([tokens])
+                    if tokens < cost:
+                        denied = denied or limit
+                        retry = max(retry, math.ceil((cost - tokens) / rate))
+                else:
+                    current = int(now // limit.window_ms)
+                    window_id, cur, prev = stored if stored else (current, 0, 0)
+                    if window_id == current - 1:
+                        prev, cur = cur, 0
+                    elif window_id != current:
+                        prev, cur = 0, 0
+                    elapsed = now - current * limit.window_ms
+                    states.append([current, cur, prev])
+                    if prev * (limit.window_ms - elapsed) / limit.window_ms + cur + cost > limit.limit:
+                        denied = denied or limit
+                        retry = max(retry, limit.window_ms - elapsed)
+
+            if denied:
+                return RateLimitResult(False, denied.name, retry / 1000)
+
+            for limit, state in zip(limits, states):
+                if limit.kind == 'tb':
+                    self._state[limit.key] = (now + limit.window_ms, (state[0] - cost, now))
+                else:
+                    self._state[limit.key] = (now + limit.window_ms * 2, (state[0], state[1] + cost, state[2]))
+            return RateLimitResult(True)
+
+local_limiter = LocalRateLimiter()
+_lua_script = None
+
+def check_limits(limits: List[Limit], cost: int = 1) -> RateLimitResult:
+    """Limitlarni atomik tekshirish va (hammasi ruxsat bersa) yechish"""
+    global _lua_script
+    if not limits:
+        return RateLimitResult(True)
+    if redis_client:
+        try:
+            if _lua_script is None:
+                _lua_script = redis_client.register_script(_LUA_SCRIPT)
+            args = [cost]
+            for limit in limits:
+                args.extend([limit.kind, limit.limit, limit.window_ms])
+            allowed, denied_index, retry_ms = _lua_script(keys=[limit.key for limit in limits], args=args)
+            if int(allowed):
+                return RateLimitResult(True)
+            return RateLimitResult(False, limits[int(denied_index) - 1].name, int(retry_ms) / 1000)
+        except Exception as e:
+            # Redis xatosi - limitsiz qoldirmaslik uchun jarayon ichidagi limiter
+            logger.error(f"Redis rate limiter error, using local limiter: {e}")
+    return local_limiter.check(limits, cost)
+
+def message_limits(bot_id: int, end_user_key: str, plan: Optional[str]) -> List[Limit]:
+    """Bot + oxirgi foydalanuvchi uchun ta'rif (va bot override) bo'yicha limitlar"""
+    plan = plan or 'free'
+    if plan in UNLIMITED_PLANS:
+        return []
+    config = dict(PLAN_RATE_LIMITS.get(plan, PLAN_RATE_LIMITS['free']))
+    config.update(BOT_RATE_LIMIT_OVERRIDES.get(str(bot_id), {}))
+
+    limits = []
+    if config.get('user'):
+        limits.append(Limit('user', cache_key('rl', 'user', bot_id, end_user_key), 'tb',
+                            config['user'], USER_REFILL_SECONDS * 1000))
+    if config.get('bot_minute'):
+        limits.append(Limit('bot_minute', cache_key('rl', 'bot', bot_id, 'minute'), 'sw',
+                            config['bot_minute'], 60 * 1000))
+    if config.get('bot_day'):
+        limits.append(Limit('bot_day', cache_key('rl', 'bot', bot_id, 'day'), 'sw',
+                            config['bot_day'], 24 * 3600 * 1000))
+    return limits
+
+def check_message_rate(bot_id: int, end_user_key: str, plan: Optional[str], cost: int = 1) -> RateLimitResult:
+    """
+    Kiruvchi xabar uchun limit tekshiruvi (AI chaqiruvidan oldin)
+
+    Args:
+        end_user_key: Platforma + foydalanuvchi ID (masalan "tg:12345", "wa:+998...")
+        plan: Bot egasining ta'rifi
+    """
+    result = check_limits(message_limits(bot_id, end_user_key, plan), cost)
+    if not result.allowed:
+        logger.warning(f"Rate limited ({result.limit_name}) bot {bot_id}, user {end_user_key}, "
+                       f"retry in {result.retry_after:.0f}s")
+    return result
+
+def rate_limit_message(result: RateLimitResult, language: Optional[str] = 'uz') -> str:
+    """Foydalanuvchiga ko'rsatiladigan xabar"""
+    seconds = max(1, int(math.ceil(result.retry_after)))
+    if result.limit_name == 'user':
+        messages = {
+            'uz': f"⏳ Juda ko'p xabar yubordingiz. Iltimos, {seconds} soniyadan keyin qayta urinib ko'ring.",
+            'ru': f"⏳ Слишком много сообщений. Пожалуйста, повторите через {seconds} сек.",
+            'en': f"⏳ Too many messages. Please try again in {seconds} seconds."
+        }
+    else:
+        messages = {
+            'uz': "⏳ Bot hozir juda band. Iltimos, birozdan keyin qayta urinib ko'ring.",
+            'ru': "⏳ Бот сейчас перегружен. Пожалуйста, попробуйте позже.",
+            'en': "⏳ The bot is busy right now. Please try again later."
+        }
+    return messages.get(language or 'uz', messages['uz'])
@@ -3,12 +3,34 @@ Redis caching for knowledge base and frequent queries
 Improves performance for high-load scenarios
 """
 import os
+import sys
 import json
+import math
+import time
+import uuid
+import zlib
+import random
 import redis
 import logging
-from typing import Optional, Dict, Any
+import threading
+import contextvars
+from collections import OrderedDict
+from typing import Optional, Dict, Any, Tuple, Iterable, List
+from contextlib import contextmanager
 from functools import wraps
 
+try:
+    import msgpack
+    MSGPACK_AVAILABLE = True
+except ImportError:
+    MSGPACK_AVAILABLE = False
+
+try:
+    import zstandard
+    ZSTD_AVAILABLE = True
+except ImportError:
+    ZSTD_AVAILABLE = False
+
 logger = logging.getLogger(__name__)
 
 # Redis connection
@@ -17,41 +39,856 @@ try:
     redis_client = redis.from_url(redis_url, decode_responses=True)
     # Test connection
     redis_client.ping()
+    # Kesh qiymatlari uchun binary-safe ulanish (kodek baytlari)
+    redis_binary = redis.from_url(redis_url)
     logger.info("Redis cache connection established")
 except Exception as e:
     logger.warning(f"Redis not available, using memory cache: {e}")
     redis_client = None
+    redis_binary = None
+
+# Kalitlar versiyasi - kodek / format o'zgarganda oshiriladi, eski kalitlar TTL bilan o'chib ketadi
+CACHE_KEY_VERSION = os.environ.get('CACHE_KEY_VERSION', 'v2')
+# Shu hajmdan katta qiymatlar siqiladi (bayt)
+CACHE_COMPRESS_MIN_BYTES = int(os.environ.get('CACHE_COMPRESS_MIN_BYTES', '1024'))
+CACHE_COMPRESSION = os.environ.get('CACHE_COMPRESSION', 'zstd' if ZSTD_AVAILABLE else 'zlib')
+CACHE_SERIALIZER = os.environ.get('CACHE_SERIALIZER', 'msgpack' if MSGPACK_AVAILABLE else 'json')
+
+# Sarlavha bayti: past 4 bit - serializer, yuqori 4 bit - siqish
+_SER_STR, _SER_BYTES, _SER_JSON, _SER_MSGPACK = 0x00, 0x01, 0x02, 0x03
+_COMP_NONE, _COMP_ZLIB, _COMP_ZSTD = 0x00, 0x10, 0x20
+
+_zstd_local = threading.local()  # zstd compressor/decompressor thread-safe emas
+
+def _zstd():
+    if not hasattr(_zstd_local, 'compressor'):
+        _zstd_local.compressor = zstandard.ZstdCompressor(level=3)
+        _zstd_local.decompressor = zstandard.ZstdDecompressor()
+    return _zstd_local.compressor, _zstd_local.decompressor
+
+def encode_value(value) -> bytes:
+    """Qiymat -> sarlavha bayti + (siqilgan) payload"""
+    if isinstance(value, str):
+        serializer, payload = _SER_STR, value.encode('utf-8')
+    elif isinstance(value, bytes):
+        serializer, payload = _SER_BYTES, value
+    elif CACHE_SERIALIZER == 'msgpack' and MSGPACK_AVAILABLE:
+        serializer, payload = _SER_MSGPACK, msgpack.packb(value, use_bin_type=True)
+    else:
+        serializer, payload = _SER_JSON, json.dumps(value, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+    compression = _COMP_NONE
+    if len(payload) >= CACHE_COMPRESS_MIN_BYTES:
+        if CACHE_COMPRESSION == 'zstd' and ZSTD_AVAILABLE:
+            compressed, compression = _zstd()[0].compress(payload), _COMP_ZSTD
+        else:
+            compressed, compression = zlib.compress(payload, 6), _COMP_ZLIB
+        if len(compressed) < len(payload):
+            payload = compressed
+        else:
+            compression = _COMP_NONE
+    return bytes([serializer | compression]) + payload
+
+def decode_value(data):
+    """encode_value ning teskarisi (sarlavhasiz eski qiymatlar - UTF-8 matn)"""
+    if data is None:
+        return None
+    if not data or data[0] & 0x0F > _SER_MSGPACK or data[0] & 0xF0 > _COMP_ZSTD:
+        return data.decode('utf-8', errors='replace')
+    header, payload = data[0], data[1:]
+    compression = header & 0xF0
+    if compression == _COMP_ZLIB:
+        payload = zlib.decompress(payload)
+    elif compression == _COMP_ZSTD:
+        payload = _zstd()[1].decompress(payload)
+
+    serializer = header & 0x0F
+    if serializer == _SER_STR:
+        return payload.decode('utf-8')
+    if serializer == _SER_BYTES:
+        return payload
+    if serializer == _SER_MSGPACK:
+        return msgpack.unpackb(payload, raw=False)
+    return json.loads(payload)
+
+# Kesh metrikalari: cache_key prefiksi bo'yicha hisoblagichlar va get/set latency gistogrammalari
+CACHE_LATENCY_BUCKETS_MS = (0.5, 1, 2, 5, 10, 25, 50, 100, 250, 1000)
+CACHE_OVERSIZE_BYTES = int(os.environ.get('CACHE_OVERSIZE_BYTES', str(256 * 1024)))
+CACHE_SAMPLE_KEYS = int(os.environ.get('CACHE_SAMPLE_KEYS', '1000'))
+
+def key_prefix(key: str) -> str:
+    """botfactory:v2:kb:12 -> 'kb', botfactory:v2:kb:12:lock -> 'kb:lock', boshqa kalitlar - birinchi qism"""
+    parts = key.split(':')
+    if parts[0] == 'botfactory' and len(parts) >= 3:
+        prefix = parts[2] if parts[1] == CACHE_KEY_VERSION else parts[1]
+    else:
+        prefix = parts[0]
+    return f"{prefix}:lock" if len(parts) > 1 and parts[-1] == 'lock' else prefix
+
+class CacheMetrics:
+    """Bitta kesh darajasi (L1 / Redis / memory) uchun prefiks bo'yicha statistika (admin metrics sahifasi)"""
+
+    def __init__(self, tier: str):
+        self.tier = tier
+        self._lock = threading.Lock()
+        self._prefixes: Dict[str, Dict[str, Any]] = {}
+
+    def _entry(self, prefix: str) -> Dict[str, Any]:
+        # lock ichida chaqiriladi
+        entry = self._prefixes.get(prefix)
+        if entry is None:
+            entry = self._prefixes[prefix] = {
+                'hits': 0, 'misses': 0, 'sets': 0, 'deletes': 0, 'evictions': 0,
+                'bytes_written': 0, 'max_value_bytes': 0,
+                'get_ms': 0.0, 'set_ms': 0.0,
+                'get_hist': [0] * (len(CACHE_LATENCY_BUCKETS_MS) + 1),
+                'set_hist': [0] * (len(CACHE_LATENCY_BUCKETS_MS) + 1)
+            }
+        return entry
+
+    @staticmethod
+    def _bucket(elapsed_ms: float) -> int:
+        for index, bound in enumerate(CACHE_LATENCY_BUCKETS_MS):
+            if elapsed_ms <= bound:
+                return index
+        return len(CACHE_LATENCY_BUCKETS_MS)
+
+    def record_get(self, keys, found, elapsed: float):
+        """keys / found - bir xil uzunlikdagi ro'yxatlar; latency prefiks bo'yicha bitta kuzatuv"""
+        elapsed_ms = elapsed * 1000
+        with self._lock:
+            seen = set()
+            for key, hit in zip(keys, found):
+                prefix = key_prefix(key)
+                entry = self._entry(prefix)
+                entry['hits' if hit else 'misses'] += 1
+                if prefix not in seen:
+                    seen.add(prefix)
+                    entry['get_ms'] += elapsed_ms
+                    entry['get_hist'][self._bucket(elapsed_ms)] += 1
+
+    def record_set(self, sizes: Dict[str, int], elapsed: float):
+        elapsed_ms = elapsed * 1000
+        with self._lock:
+            seen = set()
+            for key, size in sizes.items():
+                prefix = key_prefix(key)
+                entry = self._entry(prefix)
+                entry['sets'] += 1
+                entry['bytes_written'] += size
+                entry['max_value_bytes'] = max(entry['max_value_bytes'], size)
+                if prefix not in seen:
+                    seen.add(prefix)
+                    entry['set_ms'] += elapsed_ms
+                    entry['set_hist'][self._bucket(elapsed_ms)] += 1
+
+    def record(self, counter: str, keys):
+        """deletes / evictions"""
+        with self._lock:
+            for key in keys:
+                self._entry(key_prefix(key))[counter] += 1
+
+    @staticmethod
+    def _percentile(hist, fraction: float):
+        """Gistogramma bo'yicha yuqori chegara (ms); oxirgi bucketdan oshsa - '>1000' kabi matn"""
+        total = sum(hist)
+        if not total:
+            return 0
+        running = 0
+        for index, count in enumerate(hist[:-1]):
+            running += count
+            if running >= total * fraction:
+                return CACHE_LATENCY_BUCKETS_MS[index]
+        return f">{CACHE_LATENCY_BUCKETS_MS[-1]}"
+
+    def snapshot(self) -> Dict[str, Dict[str, Any]]:
+        with self._lock:
+            result = {}
+            for prefix, entry in self._prefixes.items():
+                lookups = entry['hits'] + entry['misses']
+                gets, sets = sum(entry['get_hist']), sum(entry['set_hist'])
+                result[prefix] = {
+                    'hits': entry['hits'],
+                    'misses': entry['misses'],
+                    'hit_ratio': round(entry['hits'] / lookups, 3) if lookups else 0,
+                    'sets': entry['sets'],
+                    'deletes': entry['deletes'],
+                    'evictions': entry['evictions'],
+                    'bytes_written': entry['bytes_written'],
+                    'avg_value_bytes': round(entry['bytes_written'] / entry['sets']) if entry['sets'] else 0,
+                    'max_value_bytes': entry['max_value_bytes'],
+                    'avg_get_ms': round(entry['get_ms'] / gets, 3) if gets else 0,
+                    'p95_get_ms': self._percentile(entry['get_hist'], 0.95),
+                    'avg_set_ms': round(entry['set_ms'] / sets, 3) if sets else 0,
+                    'p95_set_ms': self._percentile(entry['set_hist'], 0.95),
+                    'get_histogram': list(entry['get_hist']),
+                    'set_histogram': list(entry['set_hist'])
+                }
+            return result
+
+    def reset(self):
+        with self._lock:
+            self._prefixes.clear()
+
+# KEYS - hisoblagichlar, ARGV - ularning amount lari + oxirida TTL (0 - muddatsiz)
+_INCR_MANY_LUA = """
+local ttl = tonumber(ARGV[#KEYS + 1])
+local results = {}
+for i, key in ipairs(KEYS) do
+    results[i] = redis.call('INCRBY', key, ARGV[i])
+    if ttl > 0 and redis.call('TTL', key) == -1 then
+        redis.call('EXPIRE', key, ttl)
+    end
+end
+return results
+"""
+
+class CodecCache:
+    """Redis ustidan kodekli kesh (binary-safe ulanish) - MemoryCache bilan bir xil interfeys"""
+    def __init__(self, client, metrics: Optional[CacheMetrics] = None):
+        self.client = client
+        self.metrics = metrics or CacheMetrics('redis')
+        self._incr_many_script = None
+    
+    def get(self, key):
+        started = time.perf_counter()
+        value = decode_value(self.client.get(key))
+        self.metrics.record_get([key], [value is not None], time.perf_counter() - started)
+        return value
+    
+    def set(self, key, value, ex=None, px=None, nx=False, xx=False):
+        data = encode_value(value)
+        started = time.perf_counter()
+        result = self.client.set(key, data, ex=ex, px=px, nx=nx, xx=xx)
+        if result:
+            self.metrics.record_set({key: len(data)}, time.perf_counter() - started)
+        return result
+    
+    def setex(self, key, time_seconds, value):
+        return self.set(key, value, ex=time_seconds)
+    
+    def delete(self, *keys):
+        if not keys:
+            return 0
+        self.metrics.record('deletes', keys)
+        return self.client.delete(*keys)
+    
+    def exists(self, *keys):
+        return self.client.exists(*keys)
+    
+    def expire(self, key, seconds):
+        return self.client.expire(key, seconds)
+    
+    def ttl(self, key):
+        return self.client.ttl(key)
+    
+    def incr(self, key, amount=1):
+        return self.client.incr(key, amount)
+    
+    def mget(self, keys: List[str]) -> List[Any]:
+        if not keys:
+            return []
+        started = time.perf_counter()
+        values = [decode_value(raw) for raw in self.client.mget(keys)]
+        self.metrics.record_get(keys, [value is not None for value in values], time.perf_counter() - started)
+        return values
+    
+    def set_many(self, mapping: Dict[str, Any], ex=None) -> None:
+        if not mapping:
+            return
+        encoded = {key: encode_value(value) for key, value in mapping.items()}
+        started = time.perf_counter()
+        pipe = self.client.pipeline(transaction=False)
+        for key, data in encoded.items():
+            pipe.set(key, data, ex=ex)
+        pipe.execute()
+        self.metrics.record_set({key: len(data) for key, data in encoded.items()}, time.perf_counter() - started)
+    
+    def incr_many(self, amounts: Dict[str, int], ex=None) -> Dict[str, int]:
+        """
+        Bitta Lua skriptda INCRBY + muddatsiz hisoblagichlarga EXPIRE (atomik - TTL siz kalit qolmaydi;
+        yangi kalit amount qiymatidan emas, TTL == -1 dan aniqlanadi - 0 / manfiy amount ham to'g'ri)
+        """
+        if not amounts:
+            return {}
+        if self._incr_many_script is None:
+            self._incr_many_script = self.client.register_script(_INCR_MANY_LUA)
+        keys = list(amounts)
+        values = self._incr_many_script(keys=keys, args=[amounts[key] for key in keys] + [int(ex or 0)])
+        return dict(zip(keys, (int(value) for value in values)))
+    
+    def delete_prefix(self, prefix: str) -> int:
+        keys = list(self.client.scan_iter(match=f"{prefix}*", count=500))
+        return self.delete(*keys)
+    
+    def sample_sizes(self, limit: int):
+        """SCAN bilan birinchi `limit` ta kalit: (key, bayt, ttl) - MEMORY USAGE bitta pipeline da"""
+        keys = []
+        for key in self.client.scan_iter(match="botfactory:*", count=500):
+            keys.append(key)
+            if len(keys) >= limit:
+                break
+        if not keys:
+            return []
+        pipe = self.client.pipeline(transaction=False)
+        for key in keys:
+            pipe.memory_usage(key)
+            pipe.ttl(key)
+        results = pipe.execute()
+        return [(key.decode('utf-8', errors='replace') if isinstance(key, bytes) else key,
+                 results[index * 2] or 0, results[index * 2 + 1])
+                for index, key in enumerate(keys)]
+
+# In-process kesh chegaralari (Redis bo'lmaganda)
+MEMORY_CACHE_MAX_ENTRIES = int(os.environ.get('MEMORY_CACHE_MAX_ENTRIES', '1000'))
+MEMORY_CACHE_MAX_BYTES = int(os.environ.get('MEMORY_CACHE_MAX_BYTES', str(64 * 1024 * 1024)))
 
 class MemoryCache:
-    """Fallback in-memory cache when Redis unavailable"""
-    def __init__(self):
-        self._cache = {}
-        self._max_size = 1000
+    """
+    Fallback in-memory cache when Redis unavailable
+    O(1) LRU (OrderedDict) + per-entry TTL, entry va bayt chegarasi, thread-safe, hit/miss hisoblagichlari
+    """
+    def __init__(self, max_entries: int = MEMORY_CACHE_MAX_ENTRIES, max_bytes: int = MEMORY_CACHE_MAX_BYTES,
+                 metrics: Optional[CacheMetrics] = None):
+        self.metrics = metrics or CacheMetrics('memory')
+        self._cache: "OrderedDict[str, Tuple[Any, Optional[float], int]]" = OrderedDict()  # key -> (value, expires_at, size)
+        self._lock = threading.RLock()
+        self._max_size = max_entries
+        self._max_bytes = max_bytes
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+    
+    @staticmethod
+    def _value_size(value) -> int:
+        # Konvert / kontekst dict lari ichidagi matnlar ham hisobga olinadi
+        if isinstance(value, dict):
+            return sys.getsizeof(value) + sum(sys.getsizeof(k) + MemoryCache._value_size(v) for k, v in value.items())
+        if isinstance(value, (list, tuple)):
+            return sys.getsizeof(value) + sum(MemoryCache._value_size(v) for v in value)
+        return sys.getsizeof(value)
+    
+    @staticmethod
+    def _entry_size(key, value) -> int:
+        return sys.getsizeof(key) + MemoryCache._value_size(value)
+    
+    def _remove(self, key):
+        # lock ichida chaqiriladi
+        _, _, size = self._cache.pop(key)
+        self._bytes -= size
+    
+    def _live_entry(self, key):
+        """Muddati o'tmagan yozuv (o'tgan bo'lsa - o'chiriladi); lock ichida chaqiriladi"""
+        entry = self._cache.get(key)
+        if entry is None:
+            return None
+        expires_at = entry[1]
+        if expires_at is not None and expires_at <= time.monotonic():
+            self._remove(key)
+            self.expirations += 1
+            return None
+        return entry
+    
+    def _evict_over_limits(self) -> List[str]:
+        """LRU: chegaradan oshsa eng uzoq ishlatilmaganlari chiqariladi; lock ichida chaqiriladi"""
+        evicted = []
+        while len(self._cache) > self._max_size or self._bytes > self._max_bytes:
+            oldest = next(iter(self._cache))
+            self._remove(oldest)
+            self.evictions += 1
+            evicted.append(oldest)
+        return evicted
     
     def get(self, key):
-        return self._cache.get(key)
+        started = time.perf_counter()
+        with self._lock:
+            entry = self._live_entry(key)
+            if entry is None:
+                self.misses += 1
+            else:
+                self._cache.move_to_end(key)
+                self.hits += 1
+        self.metrics.record_get([key], [entry is not None], time.perf_counter() - started)
+        return entry[0] if entry is not None else None
+    
+    def set(self, key, value, ex=None, px=None, nx=False, xx=False):
+        """redis-py set() bilan mos: ex (soniya), px (millisekund), nx / xx"""
+        if px is not None:
+            ttl = px / 1000
+        elif ex is not None:
+            ttl = ex.total_seconds() if hasattr(ex, 'total_seconds') else ex
+        else:
+            ttl = None
+        size = self._entry_size(key, value)
+        started = time.perf_counter()
+        
+        with self._lock:
+            exists = self._live_entry(key) is not None
+            if (nx and exists) or (xx and not exists):
+                return None
+            if exists:
+                self._remove(key)
+            if size > self._max_bytes:
+                # Bitta yozuv butun keshdan katta - saqlanmaydi
+                return None
+            expires_at = time.monotonic() + ttl if ttl is not None else None
+            self._cache[key] = (value, expires_at, size)
+            self._bytes += size
+            evicted = self._evict_over_limits()
+        
+        self.metrics.record_set({key: size}, time.perf_counter() - started)
+        if evicted:
+            self.metrics.record('evictions', evicted)
+        return True
+    
+    def setex(self, key, time_seconds, value):
+        return self.set(key, value, ex=time_seconds)
+    
+    def delete(self, *keys):
+        removed = []
+        with self._lock:
+            for key in keys:
+                if key in self._cache:
+                    self._remove(key)
+                    removed.append(key)
+        self.metrics.record('deletes', removed)
+        return len(removed)
+    
+    def delete_prefix(self, prefix: str) -> int:
+        """Prefiks bilan boshlanuvchi barcha kalitlarni o'chirish"""
+        with self._lock:
+            keys = [key for key in self._cache if key.startswith(prefix)]
+            for key in keys:
+                self._remove(key)
+        self.metrics.record('deletes', keys)
+        return len(keys)
+    
+    def sample_sizes(self, limit: int):
+        """(key, bayt, ttl) - LRU tartibida birinchi `limit` ta yozuv"""
+        now = time.monotonic()
+        with self._lock:
+            entries = list(self._cache.items())[:limit]
+        return [(key, size, int(expires_at - now) if expires_at is not None else -1)
+                for key, (_, expires_at, size) in entries]
+    
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+            self._bytes = 0
+    
+    def exists(self, *keys):
+        with self._lock:
+            return sum(1 for key in keys if self._live_entry(key) is not None)
+    
+    def expire(self, key, seconds):
+        with self._lock:
+            entry = self._live_entry(key)
+            if entry is None:
+                return False
+            self._cache[key] = (entry[0], time.monotonic() + seconds, entry[2])
+            return True
+    
+    def ttl(self, key):
+        """Redis semantikasi: -2 - kalit yo'q, -1 - muddatsiz"""
+        with self._lock:
+            entry = self._live_entry(key)
+            if entry is None:
+                return -2
+            if entry[1] is None:
+                return -1
+            return max(0, int(entry[1] - time.monotonic()))
+    
+    def incr(self, key, amount=1):
+        with self._lock:
+            entry = self._live_entry(key)
+            value = int(entry[0]) + amount if entry is not None else amount
+            expires_at = entry[1] if entry is not None else None
+            if entry is not None:
+                self._remove(key)
+            size = self._entry_size(key, value)
+            self._cache[key] = (value, expires_at, size)
+            self._bytes += size
+            evicted = self._evict_over_limits()
+        if evicted:
+            self.metrics.record('evictions', evicted)
+        return value
     
-    def set(self, key, value, ex=None):
-        if len(self._cache) >= self._max_size:
-            # Remove oldest entries
-            keys_to_remove = list(self._cache.keys())[:100]
-            for k in keys_to_remove:
-                del self._cache[k]
-        self._cache[key] = value
+    def mget(self, keys: List[str]) -> List[Any]:
+        return [self.get(key) for key in keys]
     
-    def delete(self, key):
-        self._cache.pop(key, None)
+    def set_many(self, mapping: Dict[str, Any], ex=None) -> None:
+        for key, value in mapping.items():
+            self.set(key, value, ex=ex)
     
-    def exists(self, key):
-        return key in self._cache
+    def incr_many(self, amounts: Dict[str, int], ex=None) -> Dict[str, int]:
+        with self._lock:
+            results = {key: self.incr(key, amount) for key, amount in amounts.items()}
+            for key in amounts:
+                # CodecCache skripti kabi: muddatsiz hisoblagichga TTL (amount qiymatidan qat'i nazar)
+                if ex and self.ttl(key) == -1:
+                    self.expire(key, ex)
+            return results
+    
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._cache),
+                'bytes': self._bytes,
+                'max_entries': self._max_size,
+                'max_bytes': self._max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'hit_rate': round(self.hits / lookups, 3) if lookups else 0
+            }
 
 # Use Redis or fallback to memory cache
-cache = redis_client if redis_client else MemoryCache()
+cache = CodecCache(redis_binary, CacheMetrics('redis')) if redis_binary else MemoryCache(metrics=CacheMetrics('memory'))
 
 def cache_key(prefix: str, *args) -> str:
-    """Generate cache key with prefix and arguments"""
+    """Generate cache key with version, prefix and arguments"""
     key_parts = [str(arg) for arg in args if arg is not None]
-    return f"botfactory:{prefix}:{':'.join(key_parts)}"
+    return f"botfactory:{CACHE_KEY_VERSION}:{prefix}:{':'.join(key_parts)}"
+
+# Ikki darajali kesh: L1 (har bir jarayondagi LRU) + L2 (Redis), invalidatsiya Redis pub/sub orqali
+L1_CACHE_ENABLED = os.environ.get('L1_CACHE_ENABLED', '1') == '1'
+L1_CACHE_TTL = int(os.environ.get('L1_CACHE_TTL', '60'))  # pub/sub xabari yo'qolsa ham eskirish chegarasi
+L1_CACHE_MAX_ENTRIES = int(os.environ.get('L1_CACHE_MAX_ENTRIES', '500'))
+L1_CACHE_MAX_BYTES = int(os.environ.get('L1_CACHE_MAX_BYTES', str(32 * 1024 * 1024)))
+CACHE_INVALIDATION_CHANNEL = 'botfactory:cache:invalidate'
+
+l1_cache = MemoryCache(L1_CACHE_MAX_ENTRIES, L1_CACHE_MAX_BYTES, CacheMetrics('l1')) if redis_client and L1_CACHE_ENABLED else None
+
+class InvalidationListener:
+    """
+    Har bir jarayonda (gunicorn worker, Celery child) invalidatsiya kanalini tinglovchi thread.
+    Obuna tasdiqlanmaguncha yoki ulanish uzilganda L1 ishlatilmaydi.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pid = None
+        self.ready = threading.Event()
+        # Har invalidatsiyada oshadi - L2 dan o'qish davomida invalidatsiya kelsa, L1 ga yozilmaydi
+        self.generation = 0
+        self.received = 0
+        # Shu jarayon e'lonlarini ajratish uchun (o'z L1 i e'lon qilishdan oldin yangilangan)
+        self.origin = None
+    
+    def ensure_started(self) -> bool:
+        pid = os.getpid()
+        if self._pid != pid:
+            with self._lock:
+                if self._pid != pid:
+                    # fork dan keyin ota jarayon thread i meros qolmaydi
+                    self.ready = threading.Event()
+                    l1_cache.clear()
+                    self.origin = uuid.uuid4().hex
+                    self._pid = pid
+                    threading.Thread(target=self._run, args=(pid,), name='cache-invalidation', daemon=True).start()
+        return self.ready.is_set()
+    
+    def _run(self, pid: int):
+        while self._pid == pid:
+            pubsub = None
+            try:
+                pubsub = redis_client.pubsub()
+                pubsub.subscribe(CACHE_INVALIDATION_CHANNEL)
+                for message in pubsub.listen():
+                    if message['type'] == 'subscribe':
+                        self.ready.set()
+                    elif message['type'] == 'message':
+                        self._apply(message['data'])
+            except Exception as e:
+                logger.warning(f"Cache invalidation listener error: {e}")
+            finally:
+                # Uzilish vaqtida xabarlar o'tkazib yuborilgan bo'lishi mumkin - L1 ishonchsiz
+                self.ready.clear()
+                self.generation += 1
+                l1_cache.clear()
+                if pubsub is not None:
+                    try:
+                        pubsub.close()
+                    except Exception:
+                        pass
+            time.sleep(1)
+    
+    def _apply(self, data):
+        try:
+            payload = json.loads(data)
+        except (TypeError, ValueError):
+            return
+        if payload.get('origin') == self.origin:
+            return
+        self.generation += 1
+        self.received += 1
+        keys = payload.get('keys') or []
+        if keys:
+            l1_cache.delete(*keys)
+        for prefix in payload.get('prefixes') or []:
+            l1_cache.delete_prefix(prefix)
+
+invalidation_listener = InvalidationListener()
+
+# So'rov doirasidagi o'qishlar: prefetch() bitta MGET bilan olgan qiymatlar (faqat topilganlari)
+_prefetched: contextvars.ContextVar = contextvars.ContextVar('cache_prefetched', default=None)
+
+def _prefetched_value(key: str):
+    batch = _prefetched.get()
+    return batch.get(key) if batch else None
+
+def _forget_prefetched(keys: Iterable[str] = (), prefixes: Iterable[str] = ()) -> None:
+    batch = _prefetched.get()
+    if not batch:
+        return
+    for key in keys:
+        batch.pop(key, None)
+    for prefix in prefixes:
+        for key in [key for key in batch if key.startswith(prefix)]:
+            del batch[key]
+
+def tiered_get(key: str):
+    """L1 -> L2 (Redis). L2 dan olingan qiymat faqat shu orada invalidatsiya bo'lmagan bo'lsa L1 ga yoziladi"""
+    value = _prefetched_value(key)
+    if value is not None:
+        return value
+    if l1_cache is None or not invalidation_listener.ensure_started():
+        return cache.get(key)
+    value = l1_cache.get(key)
+    if value is not None:
+        return value
+    generation = invalidation_listener.generation
+    value = cache.get(key)
+    if value is not None and invalidation_listener.ready.is_set() and generation == invalidation_listener.generation:
+        l1_cache.set(key, value, ex=L1_CACHE_TTL)
+    return value
+
+def get_many(keys: Iterable[str], tiered: bool = True) -> Dict[str, Any]:
+    """
+    Bir nechta kalitni bitta round trip da o'qish (L1 -> bitta MGET)
+
+    Returns:
+        dict: Faqat topilgan kalitlar -> qiymat
+    """
+    keys = list(dict.fromkeys(keys))
+    found = {}
+    batch = _prefetched.get() or {}
+    for key in keys:
+        if key in batch:
+            found[key] = batch[key]
+    use_l1 = tiered and l1_cache is not None and invalidation_listener.ensure_started()
+    if use_l1:
+        for key in keys:
+            if key not in found:
+                value = l1_cache.get(key)
+                if value is not None:
+                    found[key] = value
+
+    missing = [key for key in keys if key not in found]
+    if missing:
+        generation = invalidation_listener.generation if use_l1 else None
+        fetched = {key: value for key, value in zip(missing, cache.mget(missing)) if value is not None}
+        found.update(fetched)
+        if use_l1 and invalidation_listener.ready.is_set() and generation == invalidation_listener.generation:
+            for key, value in fetched.items():
+                l1_cache.set(key, value, ex=L1_CACHE_TTL)
+    return found
+
+def set_many(mapping: Dict[str, Any], ttl: int) -> None:
+    """Bir nechta kalitni bitta pipeline da yozish (tiered_set kabi - L1 lar invalidatsiya qilinadi)"""
+    _forget_prefetched(mapping)
+    cache.set_many(mapping, ex=ttl)
+    if mapping:
+        _invalidate_l1(list(mapping))
+
+def incr_many(amounts: Dict[str, int], ttl: Optional[int] = None) -> Dict[str, int]:
+    """Hisoblagichlarni bitta pipeline da oshirish; ttl - yangi hisoblagich muddati"""
+    return cache.incr_many(amounts, ex=ttl)
+
+@contextmanager
+def prefetch(*keys: str):
+    """
+    So'rov doirasidagi o'qishlarni birlashtirish: kalitlar bitta round trip da olinadi,
+    ichidagi tiered_get / get_or_compute / cached_* chaqiruvlari shu natijadan foydalanadi
+    """
+    parent = _prefetched.get()
+    batch = dict(parent or {})
+    try:
+        batch.update(get_many(keys))
+    except Exception as e:
+        logger.error(f"Cache prefetch error: {e}")
+    token = _prefetched.set(batch)
+    try:
+        yield batch
+    finally:
+        _prefetched.reset(token)
+
+def _invalidate_l1(keys=(), prefixes=(), fresh: Optional[Dict[str, Any]] = None, ttl: Optional[int] = None) -> None:
+    """
+    Joriy jarayon L1 idan o'chirish va boshqa jarayonlarga e'lon qilish (L2 yozilgandan keyin)
+    fresh - joriy jarayon L1 iga darhol yoziladigan yangi qiymatlar (eskisi qayta hisoblashga olib kelmasin)
+    """
+    if l1_cache is None:
+        return
+    # L2 dan parallel o'qilayotgan eski qiymat L1 ga yozilmasin
+    invalidation_listener.generation += 1
+    if keys:
+        l1_cache.delete(*keys)
+    for prefix in prefixes:
+        l1_cache.delete_prefix(prefix)
+    if fresh and invalidation_listener.ready.is_set():
+        l1_ttl = min(ttl, L1_CACHE_TTL) if ttl else L1_CACHE_TTL
+        for key, value in fresh.items():
+            l1_cache.set(key, value, ex=l1_ttl)
+    redis_client.publish(CACHE_INVALIDATION_CHANNEL, json.dumps({
+        'keys': list(keys), 'prefixes': list(prefixes), 'origin': invalidation_listener.origin
+    }))
+
+def tiered_set(key: str, value, ttl: int):
+    """L2 ga yozish; joriy jarayon L1 i yangi qiymat bilan almashtiriladi, boshqa jarayonlarniki o'chiriladi"""
+    _forget_prefetched([key])
+    cache.set(key, value, ex=ttl)
+    _invalidate_l1([key], fresh={key: value}, ttl=ttl)
+
+def invalidate_keys(*keys: str, prefixes=()) -> None:
+    """
+    L2 dan o'chirish va barcha jarayonlarga L1 invalidatsiyasini e'lon qilish
+    """
+    _forget_prefetched(keys, prefixes)
+    if keys:
+        cache.delete(*keys)
+    for prefix in prefixes:
+        cache.delete_prefix(prefix)
+    _invalidate_l1(keys, prefixes)
+
+# Cache stampede himoyasi: single-flight (jarayon ichida lock + Redis lock), stale-while-revalidate,
+# ehtimoliy erta yangilash (XFetch). Qiymat konvert ichida saqlanadi: {"_swr": 1, "v", "soft", "delta"}
+CACHE_LOCK_TIMEOUT = int(os.environ.get('CACHE_LOCK_TIMEOUT', '30'))  # Qayta hisoblash lock muddati (soniya)
+CACHE_LOCK_WAIT = float(os.environ.get('CACHE_LOCK_WAIT', '10'))  # Boshqa jarayon hisoblashini kutish chegarasi
+_LOCK_STRIPES = 64
+_local_locks = [threading.Lock() for _ in range(_LOCK_STRIPES)]
+_release_lock_script = None
+
+def _wrap(value, ttl: int, delta: float) -> Dict[str, Any]:
+    return {'_swr': 1, 'v': value, 'soft': time.time() + ttl, 'delta': round(delta, 4)}
+
+def _unwrap(raw, legacy=None):
+    """(qiymat, soft_expiry, delta) yoki None; konvertsiz qiymat - legacy(raw) orqali, darhol eskirgan"""
+    if raw is None:
+        return None
+    if isinstance(raw, dict) and raw.get('_swr') == 1:
+        return raw['v'], raw['soft'], raw.get('delta', 0)
+    if legacy is None:
+        return None
+    try:
+        return legacy(raw), 0, 0
+    except (TypeError, ValueError):
+        return None
+
+def _acquire_lock(key: str, timeout: int = CACHE_LOCK_TIMEOUT) -> Optional[str]:
+    token = f"{os.getpid()}:{threading.get_ident()}:{time.time()}"
+    # Lock qiymati kodeksiz (release skripti token bilan solishtiradi)
+    return token if (redis_client or cache).set(f"{key}:lock", token, ex=timeout, nx=True) else None
+
+def _release_lock(key: str, token: str) -> None:
+    global _release_lock_script
+    lock_key = f"{key}:lock"
+    try:
+        if redis_client:
+            if _release_lock_script is None:
+                _release_lock_script = redis_client.register_script(
+                    "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('del', KEYS[1]) end return 0"
+                )
+            _release_lock_script(keys=[lock_key], args=[token])
+        elif cache.get(lock_key) == token:
+            cache.delete(lock_key)
+    except Exception as e:
+        logger.error(f"Cache lock release error: {e}")
+
+def get_or_compute(key: str, compute, ttl: int, stale_ttl: int = 0, early_expiry: float = 0.0,
+                   tiered: bool = False, legacy=None):
+    """
+    Keshdan olish yoki bitta chaqiruvchi orqali qayta hisoblash
+
+    Args:
+        compute: Qiymatni hisoblovchi funksiya (JSON ga serializatsiya qilinadigan natija)
+        ttl: Yangi (fresh) muddat
+        stale_ttl: ttl dan keyin eski qiymat shuncha soniya qaytariladi, bitta chaqiruvchi yangilaydi
+        early_expiry: XFetch beta (0 - o'chirilgan; 1.0 - odatiy) - muddat tugashidan oldin ehtimoliy yangilash
+        tiered: L1 + L2 (tiered_get) dan o'qish
+    """
+    getter = tiered_get if tiered else (lambda key: _prefetched_value(key) or cache.get(key))
+
+    def read():
+        try:
+            return _unwrap(getter(key), legacy)
+        except Exception as e:
+            logger.error(f"Cache get error for {key}: {e}")
+            return None
+
+    def store(value, delta):
+        try:
+            raw = _wrap(value, ttl, delta)
+            if tiered:
+                tiered_set(key, raw, ttl + stale_ttl)
+            else:
+                _forget_prefetched([key])
+                cache.set(key, raw, ex=ttl + stale_ttl)
+        except Exception as e:
+            logger.error(f"Cache set error for {key}: {e}")
+
+    def recompute():
+        started = time.monotonic()
+        value = compute()
+        store(value, time.monotonic() - started)
+        return value
+
+    entry = read()
+    if entry is not None:
+        value, soft_expiry, delta = entry
+        now = time.time()
+        refresh_at = soft_expiry
+        if early_expiry and delta:
+            # XFetch: hisoblash qancha uzoq bo'lsa, shuncha oldinroq va tasodifiy yangilanadi
+            refresh_at = soft_expiry + delta * early_expiry * math.log(random.random() or 1e-12)
+        if now < refresh_at:
+            return value
+        # Eski (yoki erta yangilash vaqti kelgan) qiymat: faqat lock olgan yangilaydi, qolganlar eskisini oladi
+        token = _acquire_lock(key)
+        if token is None:
+            return value
+        try:
+            return recompute()
+        except Exception as e:
+            logger.error(f"Cache revalidation error for {key}: {e}")
+            return value
+        finally:
+            _release_lock(key, token)
+
+    # Miss: jarayon ichida bitta thread, jarayonlar orasida Redis lock
+    with _local_locks[hash(key) % _LOCK_STRIPES]:
+        entry = read()
+        if entry is not None:
+            return entry[0]
+        token = _acquire_lock(key)
+        if token is not None:
+            try:
+                return recompute()
+            finally:
+                _release_lock(key, token)
+
+        # Boshqa jarayon hisoblayapti - natijani kutish
+        deadline = time.monotonic() + CACHE_LOCK_WAIT
+        while time.monotonic() < deadline:
+            time.sleep(0.05)
+            entry = read()
+            if entry is not None:
+                return entry[0]
+        logger.warning(f"Cache lock wait timed out for {key} - computing locally")
+        return recompute()
 
 def cached_knowledge_base(bot_id: int, ttl: int = 1800) -> Optional[str]:
     """
@@ -59,34 +896,47 @@ def cached_knowledge_base(bot_id: int, ttl: int = 1800) -> Optional[str]:
     """
     key = cache_key("kb", bot_id)
     try:
-        cached_kb = cache.get(key)
-        if cached_kb and isinstance(cached_kb, str):
+        entry = _unwrap(tiered_get(key), legacy=str)
+        if entry and entry[0] and isinstance(entry[0], str):
             logger.debug(f"Cache HIT for knowledge base {bot_id}")
-            return cached_kb
+            return entry[0]
         logger.debug(f"Cache MISS for knowledge base {bot_id}")
         return None
     except Exception as e:
         logger.error(f"Cache get error: {e}")
         return None
 
-def cache_knowledge_base(bot_id: int, knowledge_base: str, ttl: int = 1800):
+def cache_knowledge_base(bot_id: int, knowledge_base: str, ttl: int = 1800, stale_ttl: int = 300):
     """
     Cache processed knowledge base for bot
     """
     key = cache_key("kb", bot_id)
     try:
-        cache.set(key, knowledge_base, ex=ttl)
+        tiered_set(key, _wrap(knowledge_base, ttl, 0), ttl + stale_ttl)
         logger.debug(f"Cached knowledge base for bot {bot_id}")
     except Exception as e:
         logger.error(f"Cache set error: {e}")
 
+def get_knowledge_base(bot_id: int, builder, ttl: int = 1800, stale_ttl: int = 300,
+                       early_expiry: float = 1.0) -> str:
+    """
+    Bilim bazasini keshdan olish; yo'q yoki eskirgan bo'lsa - builder(bot_id) faqat bitta chaqiruvchida ishlaydi
+    (masalan, builder=ai.process_knowledge_base)
+    """
+    try:
+        return get_or_compute(cache_key("kb", bot_id), lambda: builder(bot_id), ttl,
+                              stale_ttl=stale_ttl, early_expiry=early_expiry, tiered=True, legacy=str)
+    except Exception as e:
+        logger.error(f"Knowledge base cache error: {e}")
+        return builder(bot_id)
+
 def invalidate_knowledge_base(bot_id: int):
     """
-    Invalidate knowledge base cache when updated
+    Invalidate knowledge base cache when updated (barcha workerlarda)
     """
     key = cache_key("kb", bot_id)
     try:
-        cache.delete(key)
+        invalidate_keys(key)
         logger.debug(f"Invalidated knowledge base cache for bot {bot_id}")
     except Exception as e:
         logger.error(f"Cache delete error: {e}")
@@ -97,10 +947,10 @@ def cached_user_context(user_id: int, bot_id: int, ttl: int = 300) -> Optional[D
     """
     key = cache_key("user", user_id, bot_id)
     try:
-        cached_data = cache.get(key)
+        cached_data = tiered_get(key)
         if cached_data:
             logger.debug(f"Cache HIT for user context {user_id}")
-            return json.loads(cached_data)
+            return cached_data if isinstance(cached_data, dict) else json.loads(cached_data)
         return None
     except Exception as e:
         logger.error(f"User context cache error: {e}")
@@ -112,29 +962,31 @@ def cache_user_context(user_id: int, bot_id: int, context: Dict, ttl: int = 300)
     """
     key = cache_key("user", user_id, bot_id)
     try:
-        cache.set(key, json.dumps(context), ex=ttl)
+        tiered_set(key, context, ttl)
         logger.debug(f"Cached user context for {user_id}")
     except Exception as e:
         logger.error(f"User context cache set error: {e}")
 
-def rate_limit_check(user_id: int, limit: int = 10, window: int = 60) -> bool:
+def invalidate_user_context(user_id: int, bot_id: Optional[int] = None):
     """
-    Check if user is within rate limits
-    Returns True if allowed, False if rate limited
+    Invalidate cached user context (bot_id berilmasa - foydalanuvchining barcha botlari uchun)
     """
-    key = cache_key("rate", user_id)
     try:
-        if redis_client:
-            current = redis_client.incr(key)
-            if isinstance(current, int) and current == 1:
-                redis_client.expire(key, window)
-            return isinstance(current, int) and current <= limit
+        if bot_id is not None:
+            invalidate_keys(cache_key("user", user_id, bot_id))
         else:
-            # Simple rate limiting for memory cache
-            return True  # No rate limiting with memory cache
+            invalidate_keys(prefixes=[cache_key("user", user_id) + ':'])
+        logger.debug(f"Invalidated user context cache for {user_id}")
     except Exception as e:
-        logger.error(f"Rate limit check error: {e}")
-        return True  # Allow on error
+        logger.error(f"User context cache invalidate error: {e}")
+
+def rate_limit_check(user_id: int, limit: int = 10, window: int = 60) -> bool:
+    """
+    Check if user is within rate limits (atomik sliding window - rate_limiter moduli orqali)
+    Returns True if allowed, False if rate limited
+    """
+    from rate_limiter import Limit, check_limits
+    return check_limits([Limit('user', cache_key("rate", user_id), 'sw', limit, window * 1000)]).allowed
 
 def cache_ai_response(message_hash: str, response: str, ttl: int = 3600):
     """
@@ -162,9 +1014,53 @@ def get_cached_ai_response(message_hash: str) -> Optional[str]:
         logger.error(f"AI response cache get error: {e}")
         return None
 
-def cache_decorator(prefix: str, ttl: int = 300, key_func=None):
+def cached_transcript(media_key: str, language: str) -> Optional[str]:
+    """
+    Get cached transcript for audio by stable media key
+    (Telegram file_unique_id, WhatsApp media id or content hash)
+    """
+    key = cache_key("transcript", media_key, language)
+    try:
+        transcript = _prefetched_value(key) or cache.get(key)
+        if transcript:
+            logger.debug(f"Cache HIT for transcript {media_key[:20]}")
+            return transcript
+        return None
+    except Exception as e:
+        logger.error(f"Transcript cache get error: {e}")
+        return None
+
+def cached_transcript_any(media_keys: Iterable[str], language: str) -> Optional[str]:
+    """Bir nechta media kalit (media ID, kontent hash) bo'yicha - bitta MGET, birinchi topilgani"""
+    keys = [cache_key("transcript", media_key, language) for media_key in media_keys if media_key]
+    try:
+        found = get_many(keys, tiered=False)
+        return next((found[key] for key in keys if found.get(key)), None)
+    except Exception as e:
+        logger.error(f"Transcript cache get error: {e}")
+        return None
+
+def cache_transcript(media_key: str, language: str, transcript: str, ttl: int = 604800):
+    """
+    Cache audio transcript (7 days TTL)
+    """
+    cache_transcripts([media_key], language, transcript, ttl)
+
+def cache_transcripts(media_keys: Iterable[str], language: str, transcript: str, ttl: int = 604800):
+    """Bir transkriptni bir nechta media kalit ostida - bitta pipeline (transkriptlar L1 da emas)"""
+    mapping = {cache_key("transcript", media_key, language): transcript for media_key in media_keys if media_key}
+    try:
+        _forget_prefetched(mapping)
+        cache.set_many(mapping, ex=ttl)
+        logger.debug(f"Cached transcript under {len(mapping)} keys")
+    except Exception as e:
+        logger.error(f"Transcript cache set error: {e}")
+
+def cache_decorator(prefix: str, ttl: int = 300, key_func=None, stale_ttl: int = 0,
+                    early_expiry: float = 0.0, tiered: bool = False):
     """
     Decorator for caching function results
+    (single-flight; stale_ttl - stale-while-revalidate oynasi, early_expiry - XFetch beta)
     """
     def decorator(func):
         @wraps(func)
@@ -175,28 +1071,56 @@ def cache_decorator(prefix: str, ttl: int = 300, key_func=None):
             else:
                 cache_key_str = cache_key(prefix, func.__name__, *args)
             
-            # Try to get from cache
-            try:
-                cached_result = cache.get(cache_key_str)
-                if cached_result:
-                    logger.debug(f"Cache HIT for {func.__name__}")
-                    return json.loads(cached_result)
-            except Exception as e:
-                logger.error(f"Cache get error in decorator: {e}")
-            
-            # Execute function and cache result
-            result = func(*args, **kwargs)
-            
-            try:
-                cache.set(cache_key_str, json.dumps(result), ex=ttl)
-                logger.debug(f"Cached result for {func.__name__}")
-            except Exception as e:
-                logger.error(f"Cache set error in decorator: {e}")
-            
-            return result
+            return get_or_compute(cache_key_str, lambda: func(*args, **kwargs), ttl,
+                                  stale_ttl=stale_ttl, early_expiry=early_expiry,
+                                  tiered=tiered, legacy=json.loads)
         return wrapper
     return decorator
 
+def cache_metrics_snapshot() -> Dict[str, Dict[str, Dict[str, Any]]]:
+    """Daraja -> prefiks -> statistika (L1 bo'lsa, u ham)"""
+    snapshot = {cache.metrics.tier: cache.metrics.snapshot()}
+    if l1_cache is not None:
+        snapshot[l1_cache.metrics.tier] = l1_cache.metrics.snapshot()
+    return snapshot
+
+def reset_cache_metrics():
+    cache.metrics.reset()
+    if l1_cache is not None:
+        l1_cache.metrics.reset()
+
+def sample_key_sizes(limit: int = CACHE_SAMPLE_KEYS, min_bytes: int = CACHE_OVERSIZE_BYTES,
+                     top: int = 20) -> Dict[str, Any]:
+    """
+    Kalitlar hajmi namunasi: prefiks bo'yicha o'rtacha / maksimal hajm va juda katta yozuvlar
+
+    Args:
+        limit: Ko'rib chiqiladigan kalitlar soni (Redis da SCAN, MEMORY USAGE)
+        min_bytes: Shu hajmdan katta yozuvlar "oversized" ro'yxatiga tushadi
+    """
+    try:
+        samples = cache.sample_sizes(limit)
+    except Exception as e:
+        logger.error(f"Cache key size sampling error: {e}")
+        return {'error': str(e), 'sampled': 0, 'prefixes': {}, 'oversized': []}
+    
+    prefixes: Dict[str, Dict[str, Any]] = {}
+    for key, size, _ in samples:
+        entry = prefixes.setdefault(key_prefix(key), {'keys': 0, 'total_bytes': 0, 'max_bytes': 0})
+        entry['keys'] += 1
+        entry['total_bytes'] += size
+        entry['max_bytes'] = max(entry['max_bytes'], size)
+    for entry in prefixes.values():
+        entry['avg_bytes'] = round(entry['total_bytes'] / entry['keys'])
+    
+    oversized = sorted((sample for sample in samples if sample[1] >= min_bytes), key=lambda sample: sample[1], reverse=True)
+    return {
+        'sampled': len(samples),
+        'min_bytes': min_bytes,
+        'prefixes': prefixes,
+        'oversized': [{'key': key, 'bytes': size, 'ttl': ttl} for key, size, ttl in oversized[:top]]
+    }
+
 # Health check for cache
 def cache_health_check() -> Dict[str, Any]:
     """
@@ -211,13 +1135,18 @@ def cache_health_check() -> Dict[str, Any]:
                 'connected_clients': info.get('connected_clients', 0),
                 'used_memory_human': info.get('used_memory_human', '0B'),
                 'keyspace_hits': info.get('keyspace_hits', 0),
-                'keyspace_misses': info.get('keyspace_misses', 0)
+                'keyspace_misses': info.get('keyspace_misses', 0),
+                'evicted_keys': info.get('evicted_keys', 0),
+                'prefix_hit_ratio': {prefix: entry['hit_ratio'] for prefix, entry in cache.metrics.snapshot().items()}
             }
         else:
+            stats = cache.stats()
             return {
                 'status': 'healthy',
                 'type': 'memory',
-                'cache_size': len(cache._cache) if hasattr(cache, '_cache') else 0
+                'cache_size': stats['entries'],
+                **stats,
+                'prefix_hit_ratio': {prefix: entry['hit_ratio'] for prefix, entry in cache.metrics.snapshot().items()}
             }
     except Exception as e:
         return {
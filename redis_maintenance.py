@@ -0,0 +1,167 @@
+"""
+Incremental Redis maintenance
+SCAN cursor based jobs with pipelined TTL / EXPIRE / UNLINK batches and a per-run time budget
+(Celery result keys, orphaned and old-version cache keys, dedup keys)
+"""
+import os
+import time
+import logging
+from datetime import datetime
+from typing import Callable, Dict, Any, List, NamedTuple
+
+import redis
+
+from redis_cache import redis_client as cache_client, CACHE_KEY_VERSION
+
+logger = logging.getLogger(__name__)
+
+REDIS_MAINTENANCE_SCAN_COUNT = int(os.environ.get('REDIS_MAINTENANCE_SCAN_COUNT', '500'))
+# Bitta ishga tushishda har bir job uchun vaqt chegarasi (soniya) - qolgani keyingi safar, cursor dan davom etadi
+REDIS_MAINTENANCE_TIME_BUDGET = float(os.environ.get('REDIS_MAINTENANCE_TIME_BUDGET', '5'))
+REDIS_MAINTENANCE_BATCH_PAUSE = float(os.environ.get('REDIS_MAINTENANCE_BATCH_PAUSE', '0.01'))  # Redis ga nafas
+# Muddatsiz qolgan kalitlarga qo'yiladigan TTL (soniya)
+CELERY_RESULT_TTL = int(os.environ.get('CELERY_RESULT_TTL', '3600'))
+CACHE_ORPHAN_TTL = int(os.environ.get('CACHE_ORPHAN_TTL', str(7 * 24 * 3600)))
+DEDUP_KEY_TTL = int(os.environ.get('DEDUP_KEY_TTL', str(24 * 3600)))
+
+_STATE_PREFIX = 'botfactory:maint'
+
+class MaintenanceJob(NamedTuple):
+    name: str
+    client: Any
+    match: str
+    # kalitlar -> (muddat qo'yiladiganlar {key: ttl}, o'chiriladiganlar [key])
+    classify: Callable[[List[str]], Any]
+
+_celery_redis = None
+
+def _celery_client():
+    # Celery broker / result backend (cache bilan bir xil REDIS_URL, default DB 0)
+    global _celery_redis
+    if _celery_redis is None:
+        _celery_redis = redis.from_url(os.environ.get('REDIS_URL', 'redis://localhost:6379/0'), decode_responses=True)
+    return _celery_redis
+
+def _classify_celery_results(keys: List[str]):
+    return {key: CELERY_RESULT_TTL for key in keys}, []
+
+def _classify_cache_keys(keys: List[str]):
+    """
+    botfactory:<eski versiya>:* va versiyasiz (v2 dan oldingi) kalitlar - o'chiriladi,
+    qolganlari muddatsiz bo'lsa - TTL (dedup kalitlari uchun qisqaroq)
+    """
+    expire, delete = {}, []
+    for key in keys:
+        parts = key.split(':')
+        if len(parts) < 3 or parts[1] == 'maint':
+            continue
+        if parts[1] != CACHE_KEY_VERSION:
+            delete.append(key)
+        elif parts[2] == 'dedup':
+            expire[key] = DEDUP_KEY_TTL
+        else:
+            expire[key] = CACHE_ORPHAN_TTL
+    return expire, delete
+
+def _process_batch(client, keys: List[str], classify) -> Dict[str, int]:
+    """Bitta SCAN batch: TTL lar bitta pipeline da, keyin EXPIRE / UNLINK bitta pipeline da"""
+    expire_candidates, delete = classify(keys)
+    expired = 0
+    if expire_candidates:
+        pipe = client.pipeline(transaction=False)
+        for key in expire_candidates:
+            pipe.ttl(key)
+        # -1 - muddatsiz; -2 - shu orada o'chib ketgan
+        no_ttl = [key for key, ttl in zip(expire_candidates, pipe.execute()) if ttl == -1]
+        if no_ttl:
+            pipe = client.pipeline(transaction=False)
+            for key in no_ttl:
+                pipe.expire(key, expire_candidates[key])
+            expired = sum(1 for result in pipe.execute() if result)
+    deleted = client.unlink(*delete) if delete else 0
+    return {'expired': expired, 'deleted': deleted}
+
+def _record_stats(client, job: str, stats: Dict[str, Any]) -> None:
+    """Jarayonlar orasida (worker -> admin sahifa) ko'rinishi uchun Redis hash da yig'ma statistika"""
+    key = f"{_STATE_PREFIX}:stats:{job}"
+    pipe = client.pipeline(transaction=False)
+    pipe.hincrby(key, 'runs', 1)
+    for field in ('scanned', 'expired', 'deleted', 'cycles'):
+        pipe.hincrby(key, field, stats[field])
+    pipe.hincrbyfloat(key, 'time_ms', stats['time_ms'])
+    pipe.hset(key, mapping={
+        'last_run': stats['finished_at'],
+        'last_scanned': stats['scanned'],
+        'last_time_ms': stats['time_ms'],
+        'cursor': stats['cursor']
+    })
+    pipe.execute()
+
+def run_job(job: MaintenanceJob, time_budget: float = REDIS_MAINTENANCE_TIME_BUDGET,
+            count: int = REDIS_MAINTENANCE_SCAN_COUNT) -> Dict[str, Any]:
+    """
+    Jobni vaqt chegarasigacha bajarish; SCAN cursor Redis da saqlanadi va keyingi ishga tushishda davom etadi
+
+    Returns:
+        dict: scanned, expired, deleted, cycles (to'liq aylanishlar), time_ms, cursor
+    """
+    client = job.client
+    cursor_key = f"{_STATE_PREFIX}:cursor:{job.name}"
+    cursor = int(client.get(cursor_key) or 0)
+    started = time.monotonic()
+    deadline = started + time_budget
+    stats = {'scanned': 0, 'expired': 0, 'deleted': 0, 'cycles': 0}
+
+    while True:
+        cursor, keys = client.scan(cursor=cursor, match=job.match, count=count)
+        if keys:
+            stats['scanned'] += len(keys)
+            result = _process_batch(client, keys, job.classify)
+            stats['expired'] += result['expired']
+            stats['deleted'] += result['deleted']
+        if cursor == 0:
+            stats['cycles'] += 1
+            break
+        if time.monotonic() >= deadline:
+            break
+        if REDIS_MAINTENANCE_BATCH_PAUSE:
+            time.sleep(REDIS_MAINTENANCE_BATCH_PAUSE)
+
+    client.set(cursor_key, cursor, ex=24 * 3600)
+    stats['cursor'] = cursor
+    stats['time_ms'] = round((time.monotonic() - started) * 1000, 1)
+    stats['finished_at'] = datetime.utcnow().isoformat()
+    try:
+        _record_stats(client, job.name, stats)
+    except Exception as e:
+        logger.error(f"Redis maintenance stats error for {job.name}: {e}")
+    logger.info(f"Redis maintenance {job.name}: scanned {stats['scanned']}, expired {stats['expired']}, "
+                f"deleted {stats['deleted']} in {stats['time_ms']}ms (cursor {cursor})")
+    return stats
+
+def maintenance_jobs() -> List[MaintenanceJob]:
+    jobs = [MaintenanceJob('celery_results', _celery_client(), 'celery-task-meta-*', _classify_celery_results)]
+    if cache_client:
+        jobs.append(MaintenanceJob('cache_keys', cache_client, 'botfactory:*', _classify_cache_keys))
+    return jobs
+
+def run_redis_maintenance(time_budget: float = REDIS_MAINTENANCE_TIME_BUDGET) -> Dict[str, Dict[str, Any]]:
+    """Barcha maintenance joblar (har biri o'z vaqt chegarasi bilan)"""
+    results = {}
+    for job in maintenance_jobs():
+        try:
+            results[job.name] = run_job(job, time_budget)
+        except Exception as e:
+            logger.error(f"Redis maintenance job {job.name} failed: {e}")
+            results[job.name] = {'error': str(e)}
+    return results
+
+def maintenance_stats() -> Dict[str, Dict[str, Any]]:
+    """Yig'ma statistika (admin metrics sahifasi uchun)"""
+    stats = {}
+    for job in maintenance_jobs():
+        try:
+            stats[job.name] = job.client.hgetall(f"{_STATE_PREFIX}:stats:{job.name}")
+        except Exception as e:
+            stats[job.name] = {'error': str(e)}
+    return stats
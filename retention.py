@@ -0,0 +1,167 @@
+"""
+Chat history retention engine
+Deletes expired rows in bounded primary-key batches, archiving them to gzip JSONL first
+"""
+import os
+import gzip
+import json
+import time
+import logging
+from datetime import datetime, timedelta
+from typing import Dict, Optional
+
+from sqlalchemy import func
+from app import db
+from models import User, Bot, ChatHistory
+
+logger = logging.getLogger(__name__)
+
+# Ta'rif bo'yicha saqlash muddati (kun)
+DEFAULT_RETENTION_DAYS = int(os.environ.get('CHAT_RETENTION_DAYS', '90'))
+CHAT_RETENTION_DAYS = {
+    plan: int(os.environ.get(f'CHAT_RETENTION_DAYS_{plan.upper()}', str(DEFAULT_RETENTION_DAYS)))
+    for plan in ('free', 'starter', 'basic', 'premium', 'admin')
+}
+
+RETENTION_BATCH_SIZE = int(os.environ.get('RETENTION_BATCH_SIZE', '5000'))
+RETENTION_BATCH_PAUSE = float(os.environ.get('RETENTION_BATCH_PAUSE', '0.05'))  # Batchlar orasida DB ga nafas
+RETENTION_ARCHIVE_DIR = os.environ.get('RETENTION_ARCHIVE_DIR', 'archives/chat_history')
+
+ARCHIVE_COLUMNS = ('id', 'bot_id', 'user_telegram_id', 'user_instagram_id', 'user_whatsapp_number',
+                   'message', 'response', 'language', 'created_at')
+
+def _serialize(chat: ChatHistory) -> str:
+    row = {column: getattr(chat, column) for column in ARCHIVE_COLUMNS}
+    if row['created_at']:
+        row['created_at'] = row['created_at'].isoformat()
+    return json.dumps(row, ensure_ascii=False)
+
+def _plan_bot_ids(plan: str):
+    """Berilgan ta'rifdagi foydalanuvchilar botlari (subquery)"""
+    return db.session.query(Bot.id).join(User, Bot.user_id == User.id).filter(
+        func.coalesce(User.subscription_type, 'free') == plan
+    )
+
+def purge_plan_chat_history(plan: str, retention_days: int, archive_dir: str = RETENTION_ARCHIVE_DIR,
+                            deadline: Optional[float] = None) -> int:
+    """
+    Bitta ta'rif uchun muddati o'tgan yozishmalarni arxivlab, PK batchlar bilan o'chirish
+
+    Returns:
+        int: O'chirilgan yozuvlar soni
+    """
+    cutoff = datetime.utcnow() - timedelta(days=retention_days)
+    bot_ids = _plan_bot_ids(plan)
+    archive_path = None
+    archive = None
+    deleted = 0
+    last_id = 0
+
+    try:
+        while deadline is None or time.monotonic() < deadline:
+            # Keyset: id > last_id ORDER BY id - har batch PK indeks bo'yicha
+            batch = ChatHistory.query.filter(
+                ChatHistory.id > last_id,
+                ChatHistory.created_at < cutoff,
+                ChatHistory.bot_id.in_(bot_ids)
+            ).order_by(ChatHistory.id).limit(RETENTION_BATCH_SIZE).all()
+            if not batch:
+                break
+
+            if archive is None:
+                os.makedirs(archive_dir, exist_ok=True)
+                archive_path = os.path.join(
+                    archive_dir, f"chat_history_{plan}_{datetime.utcnow().strftime('%Y%m%d_%H%M%S')}.jsonl.gz"
+                )
+                archive = gzip.open(archive_path, 'at', encoding='utf-8')
+
+            # Avval arxivga, keyin o'chirish - arxivlanmagan yozuv o'chmaydi
+            archive.write('\n'.join(_serialize(chat) for chat in batch) + '\n')
+            archive.flush()
+
+            batch_ids = [chat.id for chat in batch]
+            last_id = batch_ids[-1]
+            ChatHistory.query.filter(ChatHistory.id.in_(batch_ids)).delete(synchronize_session=False)
+            db.session.commit()
+            for chat in batch:
+                db.session.expunge(chat)
+            deleted += len(batch_ids)
+
+            if len(batch) < RETENTION_BATCH_SIZE:
+                break
+            if RETENTION_BATCH_PAUSE:
+                time.sleep(RETENTION_BATCH_PAUSE)
+    except Exception:
+        db.session.rollback()
+        raise
+    finally:
+        if archive is not None:
+            archive.close()
+
+    if deleted:
+        logger.info(f"Retention purge ({plan}, {retention_days}d): {deleted} rows archived to {archive_path}")
+    return deleted
+
+def purge_chat_history(time_budget: Optional[float] = None,
+                       archive_dir: str = RETENTION_ARCHIVE_DIR) -> Dict[str, int]:
+    """
+    Barcha ta'riflar bo'yicha retention purge
+
+    Args:
+        time_budget: Soniyalarda vaqt chegarasi (None - cheklanmagan)
+
+    Returns:
+        dict: ta'rif -> o'chirilgan yozuvlar soni
+    """
+    deadline = time.monotonic() + time_budget if time_budget else None
+    plans = {row[0] or 'free' for row in db.session.query(User.subscription_type).distinct()}
+
+    results = {}
+    for plan in sorted(plans):
+        if deadline is not None and time.monotonic() >= deadline:
+            break
+        retention_days = CHAT_RETENTION_DAYS.get(plan, DEFAULT_RETENTION_DAYS)
+        try:
+            results[plan] = purge_plan_chat_history(plan, retention_days, archive_dir, deadline)
+        except Exception as e:
+            logger.error(f"Retention purge error for plan {plan}: {str(e)}")
+            results[plan] = 0
+    return results
+
+def restore_chat_history(archive_path: str) -> int:
+    """
+    Arxiv faylidan yozishmalarni qayta tiklash (mavjud ID lar o'tkazib yuboriladi)
+
+    Returns:
+        int: Tiklangan yozuvlar soni
+    """
+    restored = 0
+    batch = []
+
+    def flush():
+        nonlocal restored
+        existing = {row.id for row in db.session.query(ChatHistory.id).filter(
+            ChatHistory.id.in_([row['id'] for row in batch])
+        )}
+        rows = [row for row in batch if row['id'] not in existing]
+        if rows:
+            db.session.bulk_insert_mappings(ChatHistory, rows)
+            db.session.commit()
+            restored += len(rows)
+        batch.clear()
+
+    with gzip.open(archive_path, 'rt', encoding='utf-8') as archive:
+        for line in archive:
+            if not line.strip():
+                continue
+            row = json.loads(line)
+            if row.get('created_at'):
+                row['created_at'] = datetime.fromisoformat(row['created_at'])
+            batch.append(row)
+            if len(batch) >= RETENTION_BATCH_SIZE:
+                flush()
+    if batch:
+        flush()
+
+    logger.info(f"Restored {restored} chat history rows from {archive_path}")
+    return restored
@@ -1,6 +1,9 @@
-from flask import Blueprint, render_template, request, redirect, url_for, flash, jsonify, send_file
+from flask import (Blueprint, render_template, request, redirect, url_for, flash, jsonify, send_file,
+                   Response, stream_with_context)
 from flask_login import login_required, current_user
 from app import db
+from redis_cache import cache_decorator
+from db_routing import read_replica
 from models import User, Bot, KnowledgeBase, Payment, ChatHistory, BroadcastMessage, BotCustomer, BotMessage
 from werkzeug.utils import secure_filename
 import os
@@ -14,6 +17,13 @@ from flask import send_file
 
 main_bp = Blueprint('main', __name__)
 
+# Admin paneldan qo'lda tozalash so'rovi uchun vaqt chegarasi (soniya)
+ADMIN_RETENTION_TIME_BUDGET = int(os.environ.get('ADMIN_RETENTION_TIME_BUDGET', '20'))
+# Admin panel ro'yxatlari sahifa hajmi va statistika kesh muddati
+ADMIN_PAGE_SIZE = int(os.environ.get('ADMIN_PAGE_SIZE', '50'))
+ADMIN_PAGE_MAX = 200
+ADMIN_STATS_TTL = int(os.environ.get('ADMIN_STATS_TTL', '60'))
+
 @main_bp.route('/')
 def index():
     return render_template('index.html')
@@ -35,6 +45,27 @@ def dashboard():
     return render_template('dashboard.html', bots=bots, bot_count=bot_count, 
                          subscription_info=subscription_info)
 
+@cache_decorator('admin_stats', ttl=ADMIN_STATS_TTL, stale_ttl=ADMIN_STATS_TTL, early_expiry=1.0)
+@read_replica()
+def get_admin_stats():
+    """Admin panel statistikasi - rollup jadvallardan, qisqa TTL bilan keshlangan"""
+    from utils import get_user_stats, get_payment_stats
+    from stats_rollup import plan_user_counts
+    user_stats = get_user_stats()
+    payment_stats = get_payment_stats()
+    plans = plan_user_counts()
+    if plans:
+        active_subscriptions = sum(plans.get(plan, (0, 0))[0] for plan in ('starter', 'basic', 'premium'))
+    else:
+        active_subscriptions = User.query.filter(User.subscription_type.in_(['starter', 'basic', 'premium'])).count()
+    return {
+        'total_users': user_stats['total_users'],
+        'active_subscriptions': active_subscriptions,
+        'total_bots': Bot.query.count(),
+        'total_payments': payment_stats['total_payments'],
+        'monthly_revenue': payment_stats['monthly_revenue']
+    }
+
 @main_bp.route('/admin')
 @main_bp.route('/admin/')
 @login_required
@@ -43,30 +74,162 @@ def admin():
         flash('Sizda admin huquqi yo\'q!', 'error')
         return redirect(url_for('main.dashboard'))
     
-    users = User.query.all()
-    payments = Payment.query.order_by(Payment.created_at.desc()).limit(50).all()
-    bots = Bot.query.all()
-    
-    # Statistics
-    stats = {
-        'total_users': User.query.count(),
-        'active_subscriptions': User.query.filter(User.subscription_type.in_(['starter', 'basic', 'premium'])).count(),
-        'total_bots': Bot.query.count(),
-        'total_payments': Payment.query.filter_by(status='completed').count(),
-        'monthly_revenue': Payment.query.filter(
-            Payment.status == 'completed',
-            Payment.created_at >= datetime.utcnow() - timedelta(days=30)
-        ).count()
-    }
+    # Statistics (ro'yxatlar sahifa ochilganda emas, /admin/api/* orqali bo'laklab yuklanadi)
+    stats = get_admin_stats()
     
     # Get broadcast messages
     broadcasts = BroadcastMessage.query.order_by(BroadcastMessage.created_at.desc()).limit(10).all()
     
-    # Get recent chat history
-    chat_history = ChatHistory.query.order_by(ChatHistory.created_at.desc()).limit(50).all()
-    
-    return render_template('admin.html', users=users, payments=payments, 
-                         bots=bots, stats=stats, broadcasts=broadcasts, chat_history=chat_history)
+    return render_template('admin.html', stats=stats, broadcasts=broadcasts, page_size=ADMIN_PAGE_SIZE)
+
+def _keyset_page(query, id_column, serialize, row_id=lambda row: row.id):
+    """
+    Keyset pagination: ?before=<id>&limit=N (id DESC)
+    Returns: {items, next_cursor} - next_cursor keyingi sahifa uchun 'before' qiymati
+    """
+    limit = max(1, min(request.args.get('limit', ADMIN_PAGE_SIZE, type=int), ADMIN_PAGE_MAX))
+    before = request.args.get('before', type=int)
+    if before:
+        query = query.filter(id_column < before)
+    rows = query.order_by(id_column.desc()).limit(limit + 1).all()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    return jsonify({
+        'items': [serialize(row) for row in rows],
+        'next_cursor': row_id(rows[-1]) if has_more else None
+    })
+
+def _admin_api_guard():
+    if not current_user.is_admin:
+        return jsonify({'error': 'Ruxsat yo\'q'}), 403
+    return None
+
+@main_bp.route('/admin/api/stats')
+@login_required
+def admin_api_stats():
+    denied = _admin_api_guard()
+    if denied:
+        return denied
+    return jsonify(get_admin_stats())
+
+@main_bp.route('/admin/api/users')
+@login_required
+@read_replica()
+def admin_api_users():
+    """Foydalanuvchilar: ?q=&plan=&active=&before=&limit="""
+    denied = _admin_api_guard()
+    if denied:
+        return denied
+    
+    query = User.query
+    search = request.args.get('q', '').strip()
+    if search:
+        pattern = f"%{search}%"
+        query = query.filter(db.or_(User.username.ilike(pattern), User.email.ilike(pattern)))
+    if request.args.get('plan'):
+        query = query.filter(User.subscription_type == request.args['plan'])
+    if request.args.get('active') in ('0', '1'):
+        query = query.filter(User._is_active.is_(request.args['active'] == '1'))
+    
+    return _keyset_page(query, User.id, lambda user: {
+        'id': user.id,
+        'username': user.username,
+        'email': user.email,
+        'is_admin': user.is_admin,
+        'subscription_type': user.subscription_type,
+        'is_active': user.is_active,
+        'created_at': user.created_at.strftime('%d.%m.%Y') if user.created_at else ''
+    })
+
+@main_bp.route('/admin/api/bots')
+@login_required
+@read_replica()
+def admin_api_bots():
+    """Botlar: ?q=&platform=&user_id=&active=&before=&limit="""
+    denied = _admin_api_guard()
+    if denied:
+        return denied
+    
+    query = db.session.query(Bot, User.username).join(User, Bot.user_id == User.id)
+    search = request.args.get('q', '').strip()
+    if search:
+        query = query.filter(Bot.name.ilike(f"%{search}%"))
+    if request.args.get('platform'):
+        query = query.filter(Bot.platform == request.args['platform'])
+    if request.args.get('user_id', type=int):
+        query = query.filter(Bot.user_id == request.args.get('user_id', type=int))
+    if request.args.get('active') in ('0', '1'):
+        query = query.filter(Bot.is_active.is_(request.args['active'] == '1'))
+    
+    return _keyset_page(query, Bot.id, lambda row: {
+        'id': row[0].id,
+        'name': row[0].name,
+        'owner': row[1],
+        'platform': row[0].platform,
+        'is_active': row[0].is_active,
+        'daily_messages': row[0].daily_messages or 0,
+        'created_at': row[0].created_at.strftime('%d.%m.%Y') if row[0].created_at else '',
+        'edit_url': url_for('main.edit_bot', bot_id=row[0].id)
+    }, row_id=lambda row: row[0].id)
+
+@main_bp.route('/admin/api/payments')
+@login_required
+@read_replica()
+def admin_api_payments():
+    """To'lovlar: ?status=&method=&user_id=&before=&limit="""
+    denied = _admin_api_guard()
+    if denied:
+        return denied
+    
+    query = db.session.query(Payment, User.username).join(User, Payment.user_id == User.id)
+    for field in ('status', 'method'):
+        if request.args.get(field):
+            query = query.filter(getattr(Payment, field) == request.args[field])
+    if request.args.get('user_id', type=int):
+        query = query.filter(Payment.user_id == request.args.get('user_id', type=int))
+    
+    return _keyset_page(query, Payment.id, lambda row: {
+        'id': row[0].id,
+        'username': row[1],
+        'amount': row[0].amount,
+        'method': row[0].method,
+        'status': row[0].status,
+        'transaction_id': row[0].transaction_id,
+        'created_at': row[0].created_at.strftime('%d.%m.%Y %H:%M') if row[0].created_at else ''
+    }, row_id=lambda row: row[0].id)
+
+@main_bp.route('/admin/api/chat-history')
+@login_required
+@read_replica()
+def admin_api_chat_history():
+    """Yozishmalar: ?bot_id=&user_id=&language=&q=&before=&limit="""
+    denied = _admin_api_guard()
+    if denied:
+        return denied
+    
+    query = db.session.query(ChatHistory, Bot.name, Bot.platform).outerjoin(Bot, ChatHistory.bot_id == Bot.id)
+    if request.args.get('bot_id', type=int):
+        query = query.filter(ChatHistory.bot_id == request.args.get('bot_id', type=int))
+    if request.args.get('user_id', type=int):
+        query = query.filter(Bot.user_id == request.args.get('user_id', type=int))
+    if request.args.get('language'):
+        query = query.filter(ChatHistory.language == request.args['language'])
+    search = request.args.get('q', '').strip()
+    if search:
+        query = query.filter(ChatHistory.message.ilike(f"%{search}%"))
+    
+    return _keyset_page(query, ChatHistory.id, lambda row: {
+        'id': row[0].id,
+        'bot_name': row[1] or 'Noma\'lum bot',
+        'platform': row[2] or '',
+        'telegram_id': row[0].user_telegram_id,
+        'instagram_id': row[0].user_instagram_id,
+        'whatsapp_number': row[0].user_whatsapp_number,
+        'message': (row[0].message or '')[:200],
+        'response': (row[0].response or '')[:200],
+        'language': row[0].language,
+        'created_at': row[0].created_at.strftime('%d.%m.%Y %H:%M') if row[0].created_at else ''
+    }, row_id=lambda row: row[0].id)
 
 @main_bp.route('/admin/test_message', methods=['POST'])
 @login_required
@@ -146,64 +309,79 @@ def set_telegram_id():
 @main_bp.route('/admin/export-chat-history')
 @login_required
 def export_chat_history():
-    """Export chat history to Excel"""
+    """Export chat history (xlsx/csv/jsonl), streamed in chunks or as a background job"""
     if not current_user.is_admin:
         flash('Sizda admin huquqi yo\'q!', 'error')
         return redirect(url_for('main.dashboard'))
     
+    from chat_export import (EXPORT_DIR, EXPORT_FORMATS, parse_export_filters, has_chat_rows, stream_csv,
+                             stream_jsonl, build_xlsx, export_filename)
+    
     try:
-        # Get all chat history
-        chat_data = ChatHistory.query.order_by(ChatHistory.created_at.desc()).all()
-        
-        # Prepare data for Excel
-        export_data = []
-        for chat in chat_data:
-            # Get bot name
-            bot = Bot.query.get(chat.bot_id)
-            bot_name = bot.name if bot else 'Noma\'lum bot'
-            
-            export_data.append({
-                'Vaqt': chat.created_at.strftime('%d.%m.%Y %H:%M:%S'),
-                'Bot nomi': bot_name,
-                'Platform': bot.platform if bot else 'Noma\'lum',
-                'Telegram ID': chat.user_telegram_id or '',
-                'Instagram ID': chat.user_instagram_id or '',
-                'WhatsApp raqami': chat.user_whatsapp_number or '',
-                'Foydalanuvchi xabari': chat.message or '',
-                'Bot javobi': chat.response or '',
-                'Til': chat.language or 'uz'
-            })
-        
-        if not export_data:
+        fmt = request.args.get('format', 'xlsx').lower()
+        if fmt not in EXPORT_FORMATS:
+            flash(f'Noma\'lum eksport formati: {fmt}', 'error')
+            return redirect(url_for('main.admin'))
+        filters = parse_export_filters(request.args)
+        
+        # Katta eksportlar uchun fon rejimi (Celery)
+        if request.args.get('background') in ('1', 'true'):
+            if not EXPORT_DIR:
+                # Worker fayli web jarayonga ko'rinmaydi - navbatga qo'yish befoyda
+                logging.error("Background chat export requested but EXPORT_DIR is not set")
+                return jsonify({'success': False,
+                                'error': 'Fon eksporti sozlanmagan: EXPORT_DIR (web va worker uchun umumiy katalog) kerak'}), 503
+            from tasks import export_chat_history as export_task
+            task = export_task.apply_async(args=[filters, fmt])
+            return jsonify({
+                'success': True,
+                'task_id': task.id,
+                'download_url': url_for('main.download_chat_export', task_id=task.id, format=fmt)
+            }), 202
+        
+        if not has_chat_rows(filters):
             flash('Eksport qilish uchun yozishmalar mavjud emas!', 'warning')
             return redirect(url_for('main.admin'))
         
-        # Create Excel file
-        df = pd.DataFrame(export_data)
+        mimetype = EXPORT_FORMATS[fmt][0]
+        filename = export_filename(fmt)
         
-        # Create a BytesIO object
-        output = BytesIO()
-        
-        # Write to Excel
-        with pd.ExcelWriter(output, engine='openpyxl') as writer:
-            df.to_excel(writer, sheet_name='Bot Yozishmalari', index=False)
+        if fmt == 'xlsx':
+            return send_file(build_xlsx(filters), mimetype=mimetype, as_attachment=True, download_name=filename)
         
-        output.seek(0)
-        
-        # Generate filename with current date
-        filename = f"bot_yozishmalari_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx"
-        
-        return send_file(
-            output,
-            mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
-            as_attachment=True,
-            download_name=filename
+        chunks = stream_csv(filters) if fmt == 'csv' else stream_jsonl(filters)
+        return Response(
+            stream_with_context(chunks),
+            mimetype=mimetype,
+            headers={'Content-Disposition': f'attachment; filename={filename}'}
         )
         
     except Exception as e:
         flash(f'Eksport qilishda xatolik: {str(e)}', 'error')
         return redirect(url_for('main.admin'))
 
+@main_bp.route('/admin/export-chat-history/<task_id>')
+@login_required
+def download_chat_export(task_id):
+    """Download a finished background export"""
+    if not current_user.is_admin:
+        return jsonify({'error': 'Ruxsat yo\'q'}), 403
+    
+    from chat_export import EXPORT_FORMATS, export_file_path, export_filename
+    
+    fmt = request.args.get('format', 'xlsx').lower()
+    path = export_file_path(task_id, fmt)
+    if not path:
+        from tasks import export_chat_history as export_task
+        result = export_task.AsyncResult(task_id)
+        if result.ready():
+            info = result.result if isinstance(result.result, dict) else {'error': str(result.result)}
+            return jsonify({'status': 'failed', 'error': info.get('error') or 'Eksport fayli topilmadi'}), 500
+        return jsonify({'status': result.state.lower()}), 202
+    
+    return send_file(path, mimetype=EXPORT_FORMATS[fmt][0], as_attachment=True,
+                     download_name=export_filename(fmt))
+
 @main_bp.route('/settings')
 @login_required
 def settings():
@@ -249,20 +427,15 @@ def cleanup_chat_history():
         return redirect(url_for('main.dashboard'))
     
     try:
-        # Keep only last 1000 entries to reduce database load
-        total_count = ChatHistory.query.count()
+        # Ta'rif bo'yicha saqlash muddati o'tgan yozishmalarni arxivlab o'chirish
+        from retention import purge_chat_history
+        purged = purge_chat_history(time_budget=ADMIN_RETENTION_TIME_BUDGET)
+        deleted_count = sum(purged.values())
         
-        if total_count > 1000:
-            # Get IDs of records to keep (latest 1000)
-            keep_ids = db.session.query(ChatHistory.id).order_by(ChatHistory.created_at.desc()).limit(1000).subquery()
-            
-            # Delete old records
-            deleted_count = ChatHistory.query.filter(~ChatHistory.id.in_(keep_ids)).delete(synchronize_session=False)
-            db.session.commit()
-            
-            flash(f'Eski yozishmalar tozalandi! {deleted_count} ta yozuv o\'chirildi, {1000} ta oxirgi yozuv saqlandi.', 'success')
+        if deleted_count:
+            flash(f'Eski yozishmalar tozalandi! {deleted_count} ta yozuv arxivlandi va o\'chirildi.', 'success')
         else:
-            flash(f'Tozalash kerak emas. Jami {total_count} ta yozishma mavjud (1000 dan kam).', 'info')
+            flash('Tozalash kerak emas. Saqlash muddati o\'tgan yozishmalar yo\'q.', 'info')
     
     except Exception as e:
         flash(f'Tozalashda xatolik: {str(e)}', 'error')
@@ -450,7 +623,7 @@ def send_broadcast():
         broadcast.status = 'completed'
         db.session.commit()
         
-        flash(f'Xabar muvaffaqiyatli yuborildi! {sent_count} ta foydalanuvchiga yetkazildi.', 'success')
+        flash(f'Xabar yuborish navbatga qo\'yildi! {sent_count} ta foydalanuvchiga yuboriladi.', 'success')
     except Exception as e:
         broadcast.status = 'failed'
         db.session.commit()
@@ -516,33 +689,41 @@ def change_user_subscription():
     return redirect(url_for('main.admin'))
 
 def send_broadcast_messages(broadcast_id, message_text, target_type):
-    """Send broadcast message to users"""
-    sent_count = 0
-    
+    """
+    Send broadcast message to users
+    Xabarlar send_telegram_batch tasklariga bo'lib navbatga qo'yiladi (bot limiti tezligida, bitta sessiya)
+    Returns: navbatga qo'yilgan (CELERY_ENABLED=0 bo'lsa - yuborilgan) xabarlar soni
+    """
+    from celery_app import CELERY_ENABLED
+    from tasks import queue_telegram_batch, send_telegram_batch
+    
+    query = db.session.query(User.telegram_id).filter(User.telegram_id.isnot(None))
     if target_type == 'customers':
         # Send to paying customers only
-        users = User.query.filter(User.subscription_type.in_(['starter', 'basic', 'premium'])).all()
-    else:
-        # Send to all telegram users who have interacted with bots
-        users = User.query.filter(User.telegram_id.isnot(None)).all()
-    
-    # Import telegram bot for sending messages
-    try:
-        from telegram_bot import send_admin_message_to_user
-        
-        for user in users:
-            if user.telegram_id:
-                try:
-                    success = send_admin_message_to_user(user.telegram_id, message_text)
-                    if success:
-                        sent_count += 1
-                except:
-                    continue
-                        
-    except Exception as e:
-        pass
+        query = query.filter(User.subscription_type.in_(['starter', 'basic', 'premium']))
+    
+    # Admin xabarlari birinchi faol Telegram bot orqali yuboriladi (token bot registry dan)
+    bot = Bot.query.filter(Bot.telegram_token.isnot(None), Bot.is_active.is_(True)).order_by(Bot.id).first()
+    if not bot:
+        return 0
+    
+    text = f"📢 Admin xabari:\n\n{message_text}"
+    messages = [{'chat_id': row.telegram_id, 'text': text, 'parse_mode': None}
+                for row in query if row.telegram_id]
+    if not messages:
+        return 0
+    if CELERY_ENABLED:
+        try:
+            task_ids = queue_telegram_batch(bot.id, messages)
+            logging.info(f"Broadcast {broadcast_id}: {len(messages)} messages queued in {len(task_ids)} batches")
+            return len(messages)
+        except Exception as e:
+            logging.warning(f"Celery unavailable for broadcast {broadcast_id}, sending inline: {str(e)}")
     
-    return sent_count
+    # Workerlarsiz deploy - shu so'rov ichida (bot limiti tezligida)
+    result = send_telegram_batch.apply(args=[bot.id, messages]).get()
+    logging.info(f"Broadcast {broadcast_id}: sent inline {result}")
+    return result.get('sent', 0)
 
 @main_bp.route('/bot/create', methods=['GET', 'POST'])
 @login_required
@@ -19,14 +19,31 @@ except ImportError:
     logging.warning("APScheduler not available, using simple schedule library")
 
 from app import db, app
-from models import User, Payment, Bot, ChatHistory
+from db_routing import read_replica
+from models import User, Payment, Bot, ChatHistory, queue_cache_invalidations
 from marketing import MarketingCampaigns
 from utils import check_subscription_expiry, get_user_stats, get_payment_stats
+from retention import purge_chat_history
+from stats_rollup import (refresh_stats_rollup, bot_message_counts,
+                          message_count_since, payment_totals)
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Bitta eslatma vazifasiga nechta foydalanuvchi
+SUBSCRIPTION_BATCH_SIZE = int(os.environ.get('SUBSCRIPTION_BATCH_SIZE', '500'))
+# Tungi retention purge uchun vaqt chegarasi (soniya) - qolgani keyingi kechaga
+RETENTION_TIME_BUDGET = int(os.environ.get('RETENTION_TIME_BUDGET', '1800'))
+
+def celery_enabled() -> bool:
+    """CELERY_ENABLED=1 va celery o'rnatilgan (navbatni o'qiydigan workerlar Procfile da)"""
+    try:
+        from celery_app import CELERY_ENABLED
+        return CELERY_ENABLED
+    except ImportError:
+        return False
+
 class TaskScheduler:
     """Professional background vazifalar boshqaruvchisi APScheduler bilan"""
     
@@ -147,6 +164,15 @@ class TaskScheduler:
                     replace_existing=True
                 )
                 
+                # Har 5 daqiqada statistika rollup jadvallarini yangilash
+                self.scheduler.add_job(
+                    func=self.refresh_stats_rollup,
+                    trigger=IntervalTrigger(minutes=5),
+                    id='stats_rollup',
+                    name='Statistics rollup refresh',
+                    replace_existing=True
+                )
+                
                 # Har 15 daqiqada tizim holatini tekshirish
                 self.scheduler.add_job(
                     func=self.system_health_check,
@@ -156,6 +182,15 @@ class TaskScheduler:
                     replace_existing=True
                 )
                 
+                # Har 15 daqiqada Redis maintenance (SCAN, vaqt chegarasi bilan)
+                self.scheduler.add_job(
+                    func=self.redis_maintenance,
+                    trigger=IntervalTrigger(minutes=15),
+                    id='redis_maintenance',
+                    name='Redis key maintenance',
+                    replace_existing=True
+                )
+                
                 # Har 5 daqiqada muddati tugash arafasidagi foydalanuvchilarga ogohlantirish
                 self.scheduler.add_job(
                     func=self.send_expiry_warnings,
@@ -175,7 +210,9 @@ class TaskScheduler:
                 schedule.every().monday.at("14:00").do(self.send_marketing_campaigns)
                 schedule.every().day.at("00:00").do(self.cleanup_old_data)
                 schedule.every().hour.do(self.update_bot_stats)
+                schedule.every(5).minutes.do(self.refresh_stats_rollup)
                 schedule.every(15).minutes.do(self.system_health_check)
+                schedule.every(15).minutes.do(self.redis_maintenance)
                 logger.info("Fallback scheduler jobs configured")
                 
         except Exception as e:
@@ -192,153 +229,111 @@ class TaskScheduler:
                 logger.error(f"Fallback scheduler error: {str(e)}")
                 time.sleep(60)  # Xato bo'lsa 1 daqiqa kutish
     
+    def _dispatch_notices(self, kind: str, user_ids: List[int], **kwargs) -> int:
+        """ID larni partiyalarga bo'lib Celery orqali yuborish (Celery o'chirilgan / broker yo'q bo'lsa - shu yerda)"""
+        use_celery = celery_enabled()
+        batches = 0
+        for i in range(0, len(user_ids), SUBSCRIPTION_BATCH_SIZE):
+            batch = user_ids[i:i + SUBSCRIPTION_BATCH_SIZE]
+            if use_celery:
+                try:
+                    from tasks import send_subscription_notices
+                    send_subscription_notices.apply_async(args=[kind, batch], kwargs=kwargs)
+                    batches += 1
+                    continue
+                except Exception as e:
+                    logger.warning(f"Celery unavailable for {kind} notices, sending inline: {str(e)}")
+            self.campaigns.send_subscription_notices(kind, batch, **kwargs)
+            batches += 1
+        return batches
+    
     def check_subscriptions(self) -> None:
-        """Obunalarni tekshirish"""
+        """Obunalarni tekshirish (set-based UPDATE + partiyalangan eslatmalar)"""
         try:
             logger.info("Checking subscriptions...")
             
             with app.app_context():
-                # 3 kun qolgan obunalar (starter/basic/premium)
-                three_days_later = datetime.utcnow() + timedelta(days=3)
-                expiring_soon = User.query.filter(
-                    User.subscription_end_date <= three_days_later,
-                    User.subscription_end_date > datetime.utcnow(),
-                    User.subscription_type.in_(['starter', 'basic', 'premium'])
-                ).all()
+                now = datetime.utcnow()
+                three_days_later = now + timedelta(days=3)
+                paid_plans = ['starter', 'basic', 'premium']
                 
-                reminder_count = 0
-                for user in expiring_soon:
-                    days_left = (user.subscription_end_date - datetime.utcnow()).days
-                    try:
-                        # Email eslatma yuborish
-                        email_success = self.campaigns.send_subscription_reminder(user, days_left)
-                        
-                        # Telegram orqali ham eslatma yuborish (agar admin chat ID mavjud bo'lsa)
-                        telegram_success = False
-                        if user.admin_chat_id:
-                            from notification_service import TelegramNotificationService
-                            telegram_service = TelegramNotificationService()
-                            
-                            user_info = {
-                                'username': user.username,
-                                'subscription_type': user.subscription_type,
-                                'subscription_end_date': user.subscription_end_date.strftime('%d.%m.%Y') if user.subscription_end_date else 'Noma\'lum'
-                            }
-                            
-                            telegram_success = telegram_service.send_subscription_reminder(
-                                user.admin_chat_id, user_info, days_left
-                            )
-                        
-                        if email_success or telegram_success:
-                            reminder_count += 1
-                    except Exception as e:
-                        logger.error(f"Reminder send error for user {user.id}: {str(e)}")
-
-                # 3 kun qolgan BEPUL ta'riflar uchun eslatma
-                free_expiring_soon = User.query.filter(
+                # 3 kun qolgan obunalar - faqat ID lar, ORM obyektlar emas
+                expiring_soon = [
                     User.subscription_end_date <= three_days_later,
-                    User.subscription_end_date > datetime.utcnow(),
-                    User.subscription_type == 'free'
-                ).all()
-                
-                free_reminder_count = 0
-                for user in free_expiring_soon:
-                    days_left = (user.subscription_end_date - datetime.utcnow()).days
-                    try:
-                        # Email va SMS eslatma yuborish
-                        email_success = self.campaigns.send_subscription_reminder(user, days_left)
-                        sms_success = self.campaigns.send_trial_ending_sms(user, days_left)
-                        
-                        # Telegram orqali ham eslatma (agar admin chat ID mavjud bo'lsa)
-                        telegram_success = False
-                        if user.admin_chat_id:
-                            from notification_service import TelegramNotificationService
-                            telegram_service = TelegramNotificationService()
-                            
-                            user_info = {
-                                'username': user.username,
-                                'subscription_type': user.subscription_type,
-                                'subscription_end_date': user.subscription_end_date.strftime('%d.%m.%Y') if user.subscription_end_date else 'Noma\'lum'
-                            }
-                            
-                            telegram_success = telegram_service.send_subscription_reminder(
-                                user.admin_chat_id, user_info, days_left
-                            )
-                        
-                        if email_success or sms_success or telegram_success:
-                            free_reminder_count += 1
-                    except Exception as e:
-                        logger.error(f"Free trial reminder error for user {user.id}: {str(e)}")
-                
-                # Tugagan obunalar
-                expired_users = User.query.filter(
-                    User.subscription_end_date <= datetime.utcnow(),
-                    User.subscription_type.in_(['starter', 'basic', 'premium'])
+                    User.subscription_end_date > now
+                ]
+                paid_reminder_ids = [row.id for row in db.session.query(User.id).filter(
+                    *expiring_soon, User.subscription_type.in_(paid_plans)
+                )]
+                free_reminder_ids = [row.id for row in db.session.query(User.id).filter(
+                    *expiring_soon, User.subscription_type == 'free'
+                )]
+                
+                # Tugagan pullik obunalar: bildirishnoma uchun (id, eski ta'rif)
+                is_expired = User.subscription_end_date <= now
+                expired_rows = db.session.query(User.id, User.subscription_type).filter(
+                    is_expired, User.subscription_type.in_(paid_plans)
                 ).all()
                 
                 expired_count = 0
-                for user in expired_users:
-                    try:
-                        old_subscription_type = user.subscription_type
-                        user.subscription_type = 'free'
-                        user.subscription_end_date = None
-                        
-                        # Botlarni deaktivatsiya qilish
-                        for bot in user.bots:
-                            if bot.platform != 'Telegram':  # Faqat Telegram bepul uchun
-                                bot.is_active = False
-                        
-                        db.session.commit()
-                        expired_count += 1
-                        
-                        # Telegram orqali tugash xabari yuborish
-                        if user.admin_chat_id:
-                            try:
-                                from notification_service import TelegramNotificationService
-                                telegram_service = TelegramNotificationService()
-                                
-                                user_info = {
-                                    'username': user.username,
-                                    'old_subscription_type': old_subscription_type
-                                }
-                                
-                                telegram_service.send_subscription_expired_notification(
-                                    user.admin_chat_id, user_info
-                                )
-                            except Exception as tg_error:
-                                logger.error(f"Telegram expiry notification error for user {user.id}: {str(tg_error)}")
-                        
-                        logger.info(f"Subscription expired for user {user.id}")
-                        
-                    except Exception as e:
-                        logger.error(f"Expiry processing error for user {user.id}: {str(e)}")
-                        db.session.rollback()
-                
-                # Tugagan BEPUL ta'riflar uchun xabar
-                expired_free_users = User.query.filter(
-                    User.subscription_end_date <= datetime.utcnow(),
+                if expired_rows:
+                    # Botlarni deaktivatsiya qilish - bitta UPDATE (Faqat Telegram bepul uchun)
+                    expired_user_ids = db.session.query(User.id).filter(
+                        is_expired, User.subscription_type.in_(paid_plans)
+                    )
+                    deactivated_bots = [
+                        Bot.user_id.in_(expired_user_ids),
+                        Bot.platform != 'Telegram',
+                        Bot.is_active.is_(True)
+                    ]
+                    # Bulk UPDATE mapper eventlarini chaqirmaydi - bot registry va user context keshi qo'lda
+                    queue_cache_invalidations(db.session, 'bot', [
+                        row.id for row in db.session.query(Bot.id).filter(*deactivated_bots)
+                    ])
+                    self._queue_user_invalidations(User.id.in_(expired_user_ids))
+                    Bot.query.filter(*deactivated_bots).update({Bot.is_active: False}, synchronize_session=False)
+                    
+                    expired_count = User.query.filter(
+                        is_expired, User.subscription_type.in_(paid_plans)
+                    ).update({
+                        User.subscription_type: 'free',
+                        User.subscription_end_date: None
+                    }, synchronize_session=False)
+                    db.session.commit()
+                
+                # Tugagan BEPUL ta'riflar
+                expired_free_ids = [row.id for row in db.session.query(User.id).filter(
+                    User.subscription_end_date <= now,
                     User.subscription_type == 'free'
-                ).all()
-                
-                expired_free_count = 0
-                for user in expired_free_users:
-                    try:
-                        # Tugagan kun xabari
-                        self.campaigns.send_subscription_expired_notification(user)
-                        
-                        # Obunani bekor qilish
-                        user.subscription_end_date = None
-                        db.session.commit()
-                        expired_free_count += 1
-                        
-                    except Exception as e:
-                        logger.error(f"Free expiry processing error for user {user.id}: {str(e)}")
-                        db.session.rollback()
-                
-                logger.info(f"Subscription check completed: {reminder_count} paid reminders, {free_reminder_count} free reminders, {expired_count} paid expired, {expired_free_count} free expired")
+                )]
+                if expired_free_ids:
+                    self._queue_user_invalidations(User.id.in_(expired_free_ids))
+                    User.query.filter(
+                        User.subscription_end_date <= now,
+                        User.subscription_type == 'free'
+                    ).update({User.subscription_end_date: None}, synchronize_session=False)
+                    db.session.commit()
+                
+                # Eslatmalar va bildirishnomalar - partiyalab Celery ga
+                self._dispatch_notices('paid_reminder', paid_reminder_ids)
+                self._dispatch_notices('free_reminder', free_reminder_ids)
+                for plan in paid_plans:
+                    plan_ids = [user_id for user_id, plan_type in expired_rows if plan_type == plan]
+                    self._dispatch_notices('paid_expired', plan_ids, old_subscription_type=plan)
+                self._dispatch_notices('free_expired', expired_free_ids)
+                
+                logger.info(f"Subscription check completed: {len(paid_reminder_ids)} paid reminders, {len(free_reminder_ids)} free reminders, {expired_count} paid expired, {len(expired_free_ids)} free expired")
                 
         except Exception as e:
             logger.error(f"Check subscriptions error: {str(e)}")
+            db.session.rollback()
+    
+    def _queue_user_invalidations(self, *criteria) -> None:
+        """User context kesh kalitlari (telegram_id bo'yicha) - bulk UPDATE dan oldin, commit da o'chiriladi"""
+        queue_cache_invalidations(db.session, 'user', [
+            int(row.telegram_id) for row in db.session.query(User.telegram_id).filter(*criteria)
+            if row.telegram_id and str(row.telegram_id).isdigit()
+        ])
     
     def send_reminders(self) -> None:
         """Eslatmalar yuborish"""
@@ -425,11 +420,9 @@ class TaskScheduler:
             logger.info("Cleaning up old data...")
             
             with app.app_context():
-                # 90 kundan eski chat tarixi
-                ninety_days_ago = datetime.utcnow() - timedelta(days=90)
-                old_chats = ChatHistory.query.filter(
-                    ChatHistory.created_at < ninety_days_ago
-                ).delete()
+                # Muddati o'tgan chat tarixi - ta'rif bo'yicha, arxivlab, PK batchlar bilan
+                purged = purge_chat_history(time_budget=RETENTION_TIME_BUDGET)
+                old_chats = sum(purged.values())
                 
                 # Bekor qilingan to'lovlar (30 kundan eski)
                 thirty_days_ago = datetime.utcnow() - timedelta(days=30)
@@ -452,60 +445,75 @@ class TaskScheduler:
             logger.error(f"Cleanup error: {str(e)}")
             db.session.rollback()
     
+    def redis_maintenance(self) -> None:
+        """Redis kalitlarini tozalash - maintenance navbatidagi Celery task (Celery o'chirilgan / broker yo'q bo'lsa - shu yerda)"""
+        if celery_enabled():
+            try:
+                from tasks import cleanup_old_tasks
+                cleanup_old_tasks.apply_async()
+                return
+            except Exception as e:
+                logger.warning(f"Celery unavailable for Redis maintenance, running inline: {str(e)}")
+        try:
+            from redis_maintenance import run_redis_maintenance
+            run_redis_maintenance()
+        except Exception as e:
+            logger.error(f"Redis maintenance error: {str(e)}")
+    
+    def refresh_stats_rollup(self) -> None:
+        """Statistika rollup jadvallarini yangilash"""
+        try:
+            with app.app_context():
+                refresh_stats_rollup()
+        except Exception as e:
+            logger.error(f"Stats rollup error: {str(e)}")
+    
     def update_bot_stats(self) -> None:
-        """Bot statistikalarini yangilash"""
+        """Bot statistikalarini yangilash (soatlik rollup dan + bitta bulk UPDATE)"""
         try:
             logger.info("Updating bot statistics...")
             
             with app.app_context():
-                # Har bir bot uchun statistika
-                bots = Bot.query.filter_by(is_active=True).all()
-                
-                for bot in bots:
-                    try:
-                        # So'nggi 24 soatdagi xabarlar soni
-                        yesterday = datetime.utcnow() - timedelta(days=1)
-                        daily_messages = ChatHistory.query.filter(
-                            ChatHistory.bot_id == bot.id,
-                            ChatHistory.created_at >= yesterday
-                        ).count()
-                        
-                        # Haftalik statistika
-                        week_ago = datetime.utcnow() - timedelta(days=7)
-                        weekly_messages = ChatHistory.query.filter(
-                            ChatHistory.bot_id == bot.id,
-                            ChatHistory.created_at >= week_ago
-                        ).count()
-                        
-                        # Bot ma'lumotlarini yangilash (qo'shimcha maydonlar kerak)
-                        # bot.daily_messages = daily_messages
-                        # bot.weekly_messages = weekly_messages
-                        # bot.last_updated = datetime.utcnow()
-                        
-                    except Exception as e:
-                        logger.error(f"Bot {bot.id} stats error: {str(e)}")
-                
+                now = datetime.utcnow()
+                # Soatlik rollup faqat refresh_stats_rollup jobida (5 daqiqada) yangilanadi
+                
+                # Barcha botlar uchun kunlik va haftalik xabarlar soni bitta so'rovda
+                stats = bot_message_counts(now - timedelta(days=1), now - timedelta(days=7))
+                
+                # Xabarsiz aktiv botlar 0 ga tushiriladi
+                active_bot_ids = [row.id for row in db.session.query(Bot.id).filter(Bot.is_active.is_(True))]
+                mappings = [
+                    {
+                        'id': bot_id,
+                        'daily_messages': stats.get(bot_id, (0, 0))[0],
+                        'weekly_messages': stats.get(bot_id, (0, 0))[1],
+                        'last_updated': now
+                    }
+                    for bot_id in active_bot_ids
+                ]
+                
+                if mappings:
+                    db.session.bulk_update_mappings(Bot, mappings)
                 db.session.commit()
-                logger.info(f"Bot statistics updated for {len(bots)} bots")
+                logger.info(f"Bot statistics updated for {len(mappings)} bots")
                 
         except Exception as e:
             logger.error(f"Update bot stats error: {str(e)}")
+            db.session.rollback()
     
     def system_health_check(self) -> None:
         """Tizim salomatligini tekshirish"""
         try:
-            with app.app_context():
-                # Database ulanishini tekshirish
-                user_count = User.query.count()
+            with app.app_context(), read_replica():
+                # Database ulanishini tekshirish (rollup dan - jadval hajmiga bog'liq emas)
+                user_count = get_user_stats()['total_users']
                 
                 # Aktiv botlar soni
                 active_bots = Bot.query.filter_by(is_active=True).count()
                 
                 # So'nggi 1 soatdagi xabarlar
                 hour_ago = datetime.utcnow() - timedelta(hours=1)
-                recent_messages = ChatHistory.query.filter(
-                    ChatHistory.created_at >= hour_ago
-                ).count()
+                recent_messages = message_count_since(hour_ago)
                 
                 # Disk bo'sh joyi (Linux uchun)
                 import shutil
@@ -530,7 +538,7 @@ class TaskScheduler:
         try:
             logger.info("Sending weekly report...")
             
-            with app.app_context():
+            with app.app_context(), read_replica():
                 # Admin foydalanuvchilarni topish
                 admins = User.query.filter_by(is_admin=True).all()
                 
@@ -542,11 +550,8 @@ class TaskScheduler:
                 weekly_stats = {
                     'new_users': User.query.filter(User.created_at >= week_ago).count(),
                     'new_bots': Bot.query.filter(Bot.created_at >= week_ago).count(),
-                    'messages_sent': ChatHistory.query.filter(ChatHistory.created_at >= week_ago).count(),
-                    'payments_completed': Payment.query.filter(
-                        Payment.status == 'completed',
-                        Payment.created_at >= week_ago
-                    ).count()
+                    'messages_sent': message_count_since(week_ago),
+                    'payments_completed': payment_totals(since=week_ago)[0]
                 }
                 
                 # Hisobot emaili
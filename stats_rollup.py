@@ -0,0 +1,216 @@
+"""
+Statistics rollup tables
+Incrementally maintained aggregates so dashboards and reports don't COUNT(*) big tables
+"""
+import os
+import logging
+from datetime import datetime, timedelta, date
+from typing import Dict, Optional, Tuple
+
+from sqlalchemy import func, case
+from app import db
+from models import User, Payment, ChatHistory, MessageStatHourly, PlanStat, PaymentStatDaily
+
+logger = logging.getLogger(__name__)
+
+# Har yangilanishda qayta hisoblanadigan oxirgi soatlar (kechikkan yozuvlar uchun zaxira)
+ROLLUP_REFRESH_HOURS = int(os.environ.get('ROLLUP_REFRESH_HOURS', '2'))
+# Jadval bo'sh bo'lsa - shuncha soat orqaga to'ldiriladi
+ROLLUP_BACKFILL_HOURS = int(os.environ.get('ROLLUP_BACKFILL_HOURS', str(7 * 24)))
+# To'lov holati o'zgarishi mumkin bo'lgan oyna (pending -> completed)
+PAYMENT_ROLLUP_DAYS = int(os.environ.get('PAYMENT_ROLLUP_DAYS', '35'))
+
+def _floor_hour(value: datetime) -> datetime:
+    return value.replace(minute=0, second=0, microsecond=0)
+
+def _hour_bucket(column):
+    """Dialektga mos soatga yaxlitlash ifodasi"""
+    dialect = db.engine.dialect.name
+    if dialect == 'postgresql':
+        return func.date_trunc('hour', column)
+    if dialect == 'mysql':
+        return func.date_format(column, '%Y-%m-%d %H:00:00')
+    return func.strftime('%Y-%m-%d %H:00:00', column)
+
+def _as_datetime(value) -> datetime:
+    if isinstance(value, datetime):
+        return value
+    return datetime.strptime(str(value)[:19], '%Y-%m-%d %H:%M:%S')
+
+def _as_date(value) -> date:
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date):
+        return value
+    return datetime.strptime(str(value)[:10], '%Y-%m-%d').date()
+
+def refresh_message_rollup(hours: int = ROLLUP_REFRESH_HOURS) -> int:
+    """
+    Oxirgi soatlar uchun (bot_id, soat) -> xabarlar soni ni qayta hisoblash
+    Oyna: min(high-water mark, hozir - hours) dan hozirgacha
+
+    Returns:
+        int: Yozilgan rollup qatorlari soni
+    """
+    # High-water mark - oxirgi rollup qilingan soat; scheduler to'xtab qolgan
+    # bo'lsa, o'tkazib yuborilgan soatlar ham shu yerdan qayta hisoblanadi
+    high_water = db.session.query(func.max(MessageStatHourly.hour)).scalar()
+    if high_water is None:
+        hours = max(hours, ROLLUP_BACKFILL_HOURS)
+    since = _floor_hour(datetime.utcnow()) - timedelta(hours=hours - 1)
+    if high_water is not None:
+        since = min(_as_datetime(high_water), since)
+
+    bucket = _hour_bucket(ChatHistory.created_at)
+    rows = db.session.query(
+        ChatHistory.bot_id, bucket, func.count(ChatHistory.id)
+    ).filter(
+        ChatHistory.created_at >= since
+    ).group_by(ChatHistory.bot_id, bucket).all()
+
+    mappings = [
+        {'bot_id': bot_id, 'hour': _as_datetime(hour), 'message_count': count}
+        for bot_id, hour, count in rows
+    ]
+    dialect = db.engine.dialect.name
+    if dialect in ('postgresql', 'sqlite'):
+        # Parallel yangilanishlar PK to'qnashuviga tushmasligi uchun upsert;
+        # oynadagi xabarsiz qolgan soatlar (retention purge) 0 ga tushiriladi
+        if dialect == 'postgresql':
+            from sqlalchemy.dialects.postgresql import insert
+        else:
+            from sqlalchemy.dialects.sqlite import insert
+        MessageStatHourly.query.filter(MessageStatHourly.hour >= since).update(
+            {'message_count': 0}, synchronize_session=False
+        )
+        if mappings:
+            statement = insert(MessageStatHourly).values(mappings)
+            db.session.execute(statement.on_conflict_do_update(
+                index_elements=['bot_id', 'hour'],
+                set_={'message_count': statement.excluded.message_count}
+            ))
+    else:
+        # Boshqa dialektlar: oyna ichidagi qatorlarni almashtirish
+        MessageStatHourly.query.filter(MessageStatHourly.hour >= since).delete(synchronize_session=False)
+        db.session.bulk_insert_mappings(MessageStatHourly, mappings)
+    db.session.commit()
+    return len(rows)
+
+def refresh_plan_stats() -> int:
+    """Ta'rif bo'yicha foydalanuvchilar sonini bitta GROUP BY bilan yangilash"""
+    # User.is_active - property; ustun User._is_active (DB da "is_active")
+    rows = db.session.query(
+        User.subscription_type, User._is_active, func.count(User.id)
+    ).group_by(User.subscription_type, User._is_active).all()
+
+    now = datetime.utcnow()
+    plans: Dict[str, Dict] = {}
+    for plan, is_active, count in rows:
+        entry = plans.setdefault(plan or 'free', {
+            'plan': plan or 'free', 'user_count': 0, 'active_user_count': 0, 'updated_at': now
+        })
+        entry['user_count'] += count
+        if is_active:
+            entry['active_user_count'] += count
+
+    PlanStat.query.delete(synchronize_session=False)
+    db.session.bulk_insert_mappings(PlanStat, list(plans.values()))
+    db.session.commit()
+    return len(plans)
+
+def refresh_payment_rollup(days: int = PAYMENT_ROLLUP_DAYS) -> int:
+    """Oxirgi kunlar uchun (kun, ta'rif, holat) -> to'lovlar soni va summasini yangilash"""
+    if not db.session.query(PaymentStatDaily.day).first():
+        since = None  # Birinchi marta - to'liq qayta qurish
+    else:
+        since = (datetime.utcnow() - timedelta(days=days - 1)).replace(hour=0, minute=0, second=0, microsecond=0)
+
+    day = func.date(Payment.created_at)
+    plan = func.coalesce(Payment.subscription_type, 'unknown')
+    status = func.coalesce(Payment.status, 'pending')
+    query = db.session.query(
+        day, plan, status, func.count(Payment.id), func.coalesce(func.sum(Payment.amount), 0)
+    )
+    if since is not None:
+        query = query.filter(Payment.created_at >= since)
+    rows = query.group_by(day, plan, status).all()
+
+    delete_query = PaymentStatDaily.query
+    if since is not None:
+        delete_query = delete_query.filter(PaymentStatDaily.day >= since.date())
+    delete_query.delete(synchronize_session=False)
+    db.session.bulk_insert_mappings(PaymentStatDaily, [
+        {'day': _as_date(row_day), 'plan': row_plan, 'status': row_status,
+         'payment_count': count, 'revenue': float(revenue or 0)}
+        for row_day, row_plan, row_status, count, revenue in rows if row_day is not None
+    ])
+    db.session.commit()
+    return len(rows)
+
+def refresh_stats_rollup() -> None:
+    """Barcha rollup jadvallarini yangilash (scheduler dan davriy chaqiriladi)"""
+    for refresh in (refresh_message_rollup, refresh_plan_stats, refresh_payment_rollup):
+        try:
+            refresh()
+        except Exception as e:
+            logger.error(f"{refresh.__name__} error: {str(e)}")
+            db.session.rollback()
+
+def _live_message_count(start: datetime, end: Optional[datetime], bot_id: Optional[int]) -> int:
+    query = db.session.query(func.count(ChatHistory.id)).filter(ChatHistory.created_at >= start)
+    if end is not None:
+        query = query.filter(ChatHistory.created_at < end)
+    if bot_id is not None:
+        query = query.filter(ChatHistory.bot_id == bot_id)
+    return int(query.scalar() or 0)
+
+def message_count_since(since: datetime, bot_id: Optional[int] = None) -> int:
+    """
+    Berilgan vaqtdan beri xabarlar soni
+    To'liq soatlar - rollup dan; boshidagi qisman soat va joriy soat - chat_history dan (created_at indeksi)
+    """
+    current_hour = _floor_hour(datetime.utcnow())
+    first_full_hour = _floor_hour(since)
+    if first_full_hour < since:
+        first_full_hour += timedelta(hours=1)
+    if first_full_hour >= current_hour:
+        # Bir soatdan kam oraliq - to'g'ridan-to'g'ri
+        return _live_message_count(since, None, bot_id)
+
+    query = db.session.query(func.coalesce(func.sum(MessageStatHourly.message_count), 0)).filter(
+        MessageStatHourly.hour >= first_full_hour,
+        MessageStatHourly.hour < current_hour
+    )
+    if bot_id is not None:
+        query = query.filter(MessageStatHourly.bot_id == bot_id)
+    total = int(query.scalar() or 0)
+    if since < first_full_hour:
+        total += _live_message_count(since, first_full_hour, bot_id)
+    return total + _live_message_count(current_hour, None, bot_id)
+
+def bot_message_counts(daily_since: datetime, weekly_since: datetime) -> Dict[int, Tuple[int, int]]:
+    """Har bir bot uchun (kunlik, haftalik) xabarlar soni - bitta so'rov"""
+    daily_hour = _floor_hour(daily_since)
+    rows = db.session.query(
+        MessageStatHourly.bot_id,
+        func.sum(case((MessageStatHourly.hour >= daily_hour, MessageStatHourly.message_count), else_=0)),
+        func.sum(MessageStatHourly.message_count)
+    ).filter(
+        MessageStatHourly.hour >= _floor_hour(weekly_since)
+    ).group_by(MessageStatHourly.bot_id).all()
+    return {bot_id: (int(daily or 0), int(weekly or 0)) for bot_id, daily, weekly in rows}
+
+def plan_user_counts() -> Dict[str, Tuple[int, int]]:
+    """Ta'rif -> (foydalanuvchilar, aktiv foydalanuvchilar)"""
+    return {row.plan: (row.user_count, row.active_user_count) for row in PlanStat.query.all()}
+
+def payment_totals(since: Optional[datetime] = None, status: str = 'completed') -> Tuple[int, float]:
+    """(to'lovlar soni, summa) - rollup dan"""
+    query = db.session.query(
+        func.coalesce(func.sum(PaymentStatDaily.payment_count), 0),
+        func.coalesce(func.sum(PaymentStatDaily.revenue), 0)
+    ).filter(PaymentStatDaily.status == status)
+    if since is not None:
+        query = query.filter(PaymentStatDaily.day >= since.date())
+    count, revenue = query.one()
+    return int(count or 0), float(revenue or 0)
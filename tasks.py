@@ -2,29 +2,70 @@
 Async tasks for bot processing using Celery
 Handles AI responses, media processing, and notifications
 """
+import os
 import logging
 import time
 from celery import current_task
 from celery_app import celery
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, List
 
 logger = logging.getLogger(__name__)
 
-@celery.task(bind=True, max_retries=3)
+TELEGRAM_API_URL = "https://api.telegram.org"
+# Telegram: bitta bot ~30 xabar/soniya (turli chatlarga) - batch shu tezlikdan oshmaydi
+TELEGRAM_BATCH_RATE = float(os.environ.get('TELEGRAM_BATCH_RATE', '25'))
+TELEGRAM_BATCH_SIZE = int(os.environ.get('TELEGRAM_BATCH_SIZE', '100'))
+# 429 (flood control) qayta urinishlari max_retries ga kirmaydi - alohida chegara
+TELEGRAM_FLOOD_MAX_RETRIES = int(os.environ.get('TELEGRAM_FLOOD_MAX_RETRIES', '5'))
+
+class TelegramRetryAfter(Exception):
+    """429 Too Many Requests - retry_after soniyadan keyin qayta urinish"""
+    def __init__(self, retry_after: int):
+        super().__init__(f"Telegram flood control, retry after {retry_after}s")
+        self.retry_after = retry_after
+
+def _resolve_telegram_token(bot_id: Optional[int]) -> Optional[str]:
+    """bot_id berilsa - bot registry dan (tenant bot), aks holda global TELEGRAM_BOT_TOKEN"""
+    if bot_id:
+        from bot_registry import get_telegram_token
+        return get_telegram_token(bot_id)
+    return os.environ.get('TELEGRAM_BOT_TOKEN')
+
+def _post_telegram_message(http, bot_token: str, chat_id: int, text: str,
+                           parse_mode: Optional[str] = 'HTML') -> Dict[str, Any]:
+    data = {'chat_id': chat_id, 'text': text}
+    if parse_mode:
+        data['parse_mode'] = parse_mode
+    response = http.post(f"{TELEGRAM_API_URL}/bot{bot_token}/sendMessage", json=data, timeout=30)
+    if response.status_code == 429:
+        retry_after = response.json().get('parameters', {}).get('retry_after', 5)
+        raise TelegramRetryAfter(int(retry_after))
+    response.raise_for_status()
+    return response.json().get('result', {})
+
+@celery.task(bind=True, max_retries=3, ignore_result=True)
 def generate_ai_response(self, message: str, bot_name: str, user_language: str = 'uz', 
                         knowledge_base: str = "", chat_history: str = "", 
-                        chat_id: int = 0, user_id: int = 0) -> Dict[str, Any]:
+                        chat_id: int = 0, user_id: int = 0, bot_id: Optional[int] = None) -> Dict[str, Any]:
     """
     Generate AI response asynchronously with retry logic
+    (bot_id - javob shu botning tokeni bilan yuboriladi va tarixga shu botga yoziladi)
     Returns: {success: bool, response: str, error: str}
     """
     try:
         # Import here to avoid circular imports
-        from ai import get_ai_response
+        from ai import get_ai_response, process_knowledge_base
         
-        logger.info(f"Task {self.request.id}: Generating AI response for chat {chat_id}")
+        logger.info(f"Task {self.request.id}: Generating AI response for chat {chat_id} (bot {bot_id})")
         start_time = time.time()
         
+        if bot_id and not knowledge_base:
+            # Bilim bazasi broker orqali uzatilmaydi - keshdan (L1 / Redis) olinadi
+            from app import app
+            from redis_cache import get_knowledge_base
+            with app.app_context():
+                knowledge_base = get_knowledge_base(bot_id, process_knowledge_base) or ""
+        
         # Generate AI response
         ai_response = get_ai_response(
             message=message,
@@ -40,7 +81,7 @@ def generate_ai_response(self, message: str, bot_name: str, user_language: str =
         if ai_response:
             # Send response back to Telegram immediately
             if chat_id and chat_id > 0:
-                send_telegram_message.apply_async(args=[chat_id, ai_response, user_id])
+                send_telegram_message.apply_async(args=[chat_id, ai_response, user_id], kwargs={'bot_id': bot_id})
             
             return {
                 'success': True,
@@ -70,51 +111,144 @@ def generate_ai_response(self, message: str, bot_name: str, user_language: str =
             'error': str(exc)
         }
 
-@celery.task(bind=True, max_retries=3)
-def send_telegram_message(self, chat_id: int, message: str, user_id: int = 0) -> Dict[str, Any]:
+@celery.task(bind=True, max_retries=3, ignore_result=True)
+def send_telegram_message(self, chat_id: int, message: str, user_id: int = 0,
+                          bot_id: Optional[int] = None, flood_retries: int = 0) -> Dict[str, Any]:
     """
     Send Telegram message asynchronously
+    (bot_id bo'yicha tenant bot tokeni; berilmasa - global TELEGRAM_BOT_TOKEN)
+    flood_retries - 429 sababli qilingan qayta urinishlar (self.request.retries ichida, lekin max_retries ga kirmaydi)
     """
     try:
         # Import here to avoid circular imports
         import requests
-        import os
         
-        logger.info(f"Task {self.request.id}: Sending message to chat {chat_id}")
+        logger.info(f"Task {self.request.id}: Sending message to chat {chat_id} (bot {bot_id})")
         
-        bot_token = os.environ.get('TELEGRAM_BOT_TOKEN')
+        bot_token = _resolve_telegram_token(bot_id)
         if not bot_token:
-            raise ValueError("TELEGRAM_BOT_TOKEN not configured")
-        
-        url = f"https://api.telegram.org/bot{bot_token}/sendMessage"
+            # Bot o'chirilgan / nofaol - qayta urinish foydasiz
+            logger.warning(f"Task {self.request.id}: No active Telegram token for bot {bot_id}")
+            return {'success': False, 'error': 'Telegram token not configured'}
         
-        data = {
-            'chat_id': chat_id,
-            'text': message,
-            'parse_mode': 'HTML'
-        }
-        
-        response = requests.post(url, json=data, timeout=30)
-        response.raise_for_status()
+        result = _post_telegram_message(requests, bot_token, chat_id, message)
         
         logger.info(f"Task {self.request.id}: Message sent successfully to chat {chat_id}")
         
         # Save to chat history if user_id provided
         if user_id and user_id > 0:
-            save_chat_history.apply_async(args=[user_id, chat_id, message], kwargs={'is_bot_response': True})
+            save_chat_history.apply_async(args=[user_id, chat_id, message],
+                                          kwargs={'is_bot_response': True, 'bot_id': bot_id})
         
         return {
             'success': True,
-            'message_id': response.json().get('result', {}).get('message_id'),
+            'message_id': result.get('message_id'),
             'error': None
         }
         
+    except TelegramRetryAfter as exc:
+        # Flood control - Telegram aytgan vaqtdan keyin; oddiy xatolar limitiga kirmaydi
+        logger.warning(f"Task {self.request.id}: {exc}")
+        if flood_retries >= TELEGRAM_FLOOD_MAX_RETRIES:
+            return {'success': False, 'error': str(exc)}
+        raise self.retry(countdown=exc.retry_after, exc=exc, max_retries=self.request.retries + 1,
+                         kwargs={**self.request.kwargs, 'flood_retries': flood_retries + 1})
+        
     except Exception as exc:
         logger.error(f"Task {self.request.id} failed: {exc}")
         
-        if self.request.retries < self.max_retries:
-            retry_delay = 30 * (2 ** self.request.retries)  # 30s, 60s, 120s
+        # request.retries ichida 429 urinishlari ham bor - backoff va Celery chegarasi faqat oddiy xatolar bo'yicha
+        error_retries = self.request.retries - flood_retries
+        if error_retries < self.max_retries:
+            retry_delay = 30 * (2 ** error_retries)  # 30s, 60s, 120s
             logger.info(f"Retrying task {self.request.id} in {retry_delay}s")
+            raise self.retry(countdown=retry_delay, exc=exc, max_retries=self.max_retries + flood_retries)
+        
+        return {
+            'success': False,
+            'error': str(exc)
+        }
+
+@celery.task(bind=True, max_retries=3, ignore_result=True)
+def send_telegram_batch(self, bot_id: Optional[int], messages: List[Dict[str, Any]],
+                        flood_retries: int = 0) -> Dict[str, Any]:
+    """
+    Bitta botdan ko'p chatga xabarlar (bitta HTTP keep-alive sessiya, bot limitidan oshmagan tezlikda)
+
+    Args:
+        messages: [{'chat_id': ..., 'text': ..., 'user_id': ... (ixtiyoriy)}]
+        flood_retries: 429 sababli qayta urinishlar (TELEGRAM_FLOOD_MAX_RETRIES gacha)
+    """
+    import requests
+    
+    bot_token = _resolve_telegram_token(bot_id)
+    if not bot_token:
+        logger.warning(f"Task {self.request.id}: No active Telegram token for bot {bot_id}")
+        return {'success': False, 'sent': 0, 'failed': len(messages), 'error': 'Telegram token not configured'}
+    
+    interval = 1.0 / TELEGRAM_BATCH_RATE if TELEGRAM_BATCH_RATE > 0 else 0
+    sent, failed, remaining = 0, [], list(messages)
+    with requests.Session() as http:
+        while remaining:
+            item = remaining[0]
+            started = time.monotonic()
+            try:
+                _post_telegram_message(http, bot_token, item['chat_id'], item['text'], item.get('parse_mode', 'HTML'))
+                sent += 1
+                if item.get('user_id'):
+                    save_chat_history.apply_async(args=[item['user_id'], item['chat_id'], item['text']],
+                                                  kwargs={'is_bot_response': True, 'bot_id': bot_id})
+            except TelegramRetryAfter as exc:
+                if flood_retries >= TELEGRAM_FLOOD_MAX_RETRIES:
+                    logger.error(f"Task {self.request.id}: {exc} - giving up on {len(remaining)} messages")
+                    failed.extend(message['chat_id'] for message in remaining)
+                    break
+                # Qolganlari shu task qayta urinishida yuboriladi
+                logger.warning(f"Task {self.request.id}: {exc} - {len(remaining)} messages deferred")
+                raise self.retry(args=[bot_id, remaining], kwargs={'flood_retries': flood_retries + 1},
+                                 countdown=exc.retry_after, exc=exc, max_retries=self.request.retries + 1)
+            except Exception as exc:
+                logger.error(f"Batch send to chat {item['chat_id']} failed: {exc}")
+                failed.append(item['chat_id'])
+            remaining.pop(0)
+            
+            elapsed = time.monotonic() - started
+            if remaining and elapsed < interval:
+                time.sleep(interval - elapsed)
+    
+    logger.info(f"Task {self.request.id}: Batch for bot {bot_id} sent {sent}, failed {len(failed)}")
+    return {'success': not failed, 'sent': sent, 'failed': len(failed), 'failed_chat_ids': failed}
+
+def queue_telegram_batch(bot_id: Optional[int], messages: List[Dict[str, Any]],
+                         batch_size: int = TELEGRAM_BATCH_SIZE) -> List[str]:
+    """Xabarlarni batch_size bo'yicha send_telegram_batch tasklariga bo'lib navbatga qo'yish (task ID lari)"""
+    return [
+        send_telegram_batch.apply_async(args=[bot_id, messages[start:start + batch_size]]).id
+        for start in range(0, len(messages), batch_size)
+    ]
+
+@celery.task(bind=True, max_retries=2, ignore_result=True)
+def send_subscription_notices(self, kind: str, user_ids: list,
+                              old_subscription_type: str = None) -> Dict[str, Any]:
+    """
+    Send a batch of subscription reminders / expiry notices
+    """
+    try:
+        # Import here to avoid circular imports
+        from marketing import campaigns
+        
+        logger.info(f"Task {self.request.id}: Sending {kind} notices to {len(user_ids)} users")
+        result = campaigns.send_subscription_notices(
+            kind, user_ids, old_subscription_type=old_subscription_type
+        )
+        
+        return {'success': True, 'error': None, **result}
+        
+    except Exception as exc:
+        logger.error(f"Task {self.request.id} failed: {exc}")
+        
+        if self.request.retries < self.max_retries:
+            retry_delay = 60 * (2 ** self.request.retries)
             raise self.retry(countdown=retry_delay, exc=exc)
         
         return {
@@ -123,26 +257,49 @@ def send_telegram_message(self, chat_id: int, message: str, user_id: int = 0) ->
         }
 
 @celery.task(bind=True)
+def export_chat_history(self, filters: Dict[str, Any], fmt: str = 'xlsx') -> Dict[str, Any]:
+    """
+    Export chat history to a file in the background (for exports too big for a request)
+    """
+    try:
+        from app import app
+        from chat_export import export_to_file
+        
+        logger.info(f"Task {self.request.id}: Exporting chat history as {fmt} ({filters})")
+        with app.app_context():
+            path, size = export_to_file(filters, fmt, self.request.id)
+        
+        logger.info(f"Task {self.request.id}: Export written to {path} ({size} bytes)")
+        return {'success': True, 'format': fmt, 'size': size, 'error': None}
+        
+    except Exception as exc:
+        logger.error(f"Chat history export failed: {exc}")
+        return {'success': False, 'error': str(exc)}
+
+@celery.task(bind=True, ignore_result=True)
 def save_chat_history(self, user_id: int, chat_id: int, message: str, 
-                     response: str = None, is_bot_response: bool = False) -> Dict[str, Any]:
+                     response: str = None, is_bot_response: bool = False,
+                     bot_id: Optional[int] = None) -> Dict[str, Any]:
     """
     Save chat history to database asynchronously
+    (bot_id - xabar kelgan bot; eski tasklar uchun foydalanuvchining birinchi boti)
     """
     try:
         from app import app, db
         from models import ChatHistory, User
         
         with app.app_context():
-            # Find bot by user_id
-            user = User.query.get(user_id)
-            if not user:
-                return {'success': False, 'error': 'User not found'}
-            
-            # Get user's bot (assuming first bot for simplicity)
-            if user.bots:
-                bot_id = user.bots[0].id
-            else:
-                return {'success': False, 'error': 'No bot found for user'}
+            if not bot_id:
+                # Find bot by user_id
+                user = User.query.get(user_id)
+                if not user:
+                    return {'success': False, 'error': 'User not found'}
+                
+                # Get user's bot (bot_id siz navbatga qo'yilgan eski tasklar)
+                if user.bots:
+                    bot_id = user.bots[0].id
+                else:
+                    return {'success': False, 'error': 'No bot found for user'}
             
             if is_bot_response:
                 # This is a bot response, find the latest user message to update
@@ -172,10 +329,12 @@ def save_chat_history(self, user_id: int, chat_id: int, message: str,
         logger.error(f"Chat history save failed: {exc}")
         return {'success': False, 'error': str(exc)}
 
-@celery.task(bind=True, max_retries=2)
-def process_audio(self, audio_file_path: str, chat_id: int, user_id: int) -> Dict[str, Any]:
+@celery.task(bind=True, max_retries=2, ignore_result=True)
+def process_audio(self, audio_file_path: str, chat_id: int, user_id: int, bot_id: Optional[int] = None,
+                  bot_name: str = 'Bot', user_language: str = 'uz') -> Dict[str, Any]:
     """
     Process audio file asynchronously (transcription, etc.)
+    (bot_id / bot_name / til - AI javobi va yuborish shu bot konteksida)
     """
     try:
         logger.info(f"Task {self.request.id}: Processing audio file {audio_file_path}")
@@ -190,16 +349,16 @@ def process_audio(self, audio_file_path: str, chat_id: int, user_id: int) -> Dic
             transcript = "Audio processing not available"
         
         if transcript and transcript != "Audio processing not available":
-            # Process as text message
+            # Process as text message (bilim bazasi bot_id bo'yicha workerda olinadi)
             generate_ai_response.apply_async(args=[
                 transcript,
-                "Bot",  # Get from context
-                "uz",
+                bot_name,
+                user_language,
                 "",
                 "",
                 chat_id,
                 user_id
-            ])
+            ], kwargs={'bot_id': bot_id})
             
             return {
                 'success': True,
@@ -224,32 +383,21 @@ def process_audio(self, audio_file_path: str, chat_id: int, user_id: int) -> Dic
             'error': str(exc)
         }
 
-@celery.task
-def cleanup_old_tasks():
+@celery.task(ignore_result=True)
+def cleanup_old_tasks(time_budget: float = None):
     """
-    Cleanup old task results and temporary files
+    Cleanup old task results and stale cache keys
+    (SCAN cursor bilan bosqichma-bosqich, pipeline va vaqt chegarasi bilan - Redis ni bloklamaydi)
     """
     try:
-        # Cleanup Redis keys older than 1 hour
-        import redis
-        import os
-        
-        redis_client = redis.from_url(os.environ.get('REDIS_URL', 'redis://localhost:6379/0'))
-        
-        # Get all celery result keys
-        keys = redis_client.keys('celery-task-meta-*')
+        from redis_maintenance import run_redis_maintenance, REDIS_MAINTENANCE_TIME_BUDGET
         
-        # Clean up old keys (older than 1 hour)
-        cleaned = 0
-        for key in keys:
-            ttl = redis_client.ttl(key)
-            if ttl == -1:  # No expiration set
-                redis_client.expire(key, 3600)  # Set 1 hour expiration
-                cleaned += 1
+        results = run_redis_maintenance(time_budget or REDIS_MAINTENANCE_TIME_BUDGET)
+        cleaned = sum(result.get('expired', 0) + result.get('deleted', 0) for result in results.values())
         
-        logger.info(f"Cleaned up {cleaned} old task result keys")
+        logger.info(f"Cleaned up {cleaned} Redis keys")
         
-        return {'success': True, 'cleaned_keys': cleaned}
+        return {'success': True, 'cleaned_keys': cleaned, 'jobs': results}
         
     except Exception as exc:
         logger.error(f"Cleanup task failed: {exc}")
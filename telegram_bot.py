@@ -1,24 +1,179 @@
 import os
+import json
+import time
+import random
 import logging
 import asyncio
 import requests
 import tempfile
+from contextlib import ExitStack
 from typing import Optional
 from datetime import datetime, timedelta
-from audio_processor import download_and_process_audio, process_audio_message
+from audio_processor import download_and_process_audio, download_and_transcribe_audio, process_audio_message
+from media_fetcher import get_telegram_file_url
+from redis_cache import cached_transcript, get_knowledge_base, prefetch, cache_key
+from query_monitor import query_scope
+from db_routing import read_replica, consistency_key
+from rate_limiter import check_message_rate, rate_limit_message
 
 # Set telegram as available and use real bot implementation
 TELEGRAM_AVAILABLE = True
 
-# Local lightweight classes to replace private telegram imports
+# Long polling sozlamalari (getUpdates)
+TELEGRAM_POLL_TIMEOUT = int(os.environ.get('TELEGRAM_POLL_TIMEOUT', '50'))  # Telegram tomonida kutish (soniya)
+TELEGRAM_POLL_LIMIT = int(os.environ.get('TELEGRAM_POLL_LIMIT', '100'))  # Bir so'rovda maksimal update soni
+TELEGRAM_ALLOWED_UPDATES = [
+    update_type.strip()
+    for update_type in os.environ.get('TELEGRAM_ALLOWED_UPDATES', 'message,callback_query').split(',')
+    if update_type.strip()
+]
+TELEGRAM_POLL_BACKOFF_BASE = float(os.environ.get('TELEGRAM_POLL_BACKOFF_BASE', '1'))
+TELEGRAM_POLL_BACKOFF_MAX = float(os.environ.get('TELEGRAM_POLL_BACKOFF_MAX', '60'))
+
+def polling_backoff(failures: int, base: float = TELEGRAM_POLL_BACKOFF_BASE,
+                    cap: float = TELEGRAM_POLL_BACKOFF_MAX) -> float:
+    """Xatolikdan keyin kutish vaqti (exponential backoff + full jitter)"""
+    ceiling = min(cap, base * (2 ** max(failures - 1, 0)))
+    return random.uniform(base / 2, max(ceiling, base / 2))
+
+# Local lightweight classes to replace private telegram imports.
+# Update modellari modul darajasida va __slots__ bilan e'lon qilingan: har bir
+# update uchun yangi klass yaratilmaydi, obyektlar esa JSON dict qismlariga
+# havola saqlaydi (nusxa olinmaydi).
+class TelegramUser:
+    """Telegram foydalanuvchisi (from maydoni)"""
+    __slots__ = ('data', 'id', 'username', 'first_name', 'last_name')
+    
+    def __init__(self, data):
+        self.data = data
+        self.id = data['id']
+        self.username = data.get('username', '')
+        self.first_name = data.get('first_name', '')
+        self.last_name = data.get('last_name', '')
+
+class TelegramChat:
+    """Telegram chat (chat maydoni)"""
+    __slots__ = ('data', 'id')
+    
+    def __init__(self, data):
+        self.data = data
+        self.id = data['id']
+
+class TelegramMessage:
+    """Telegram xabari va javob berish yordamchilari"""
+    __slots__ = ('data', 'bot', 'message_id', 'text', 'voice', 'audio', 'document', 'chat')
+    
+    def __init__(self, data, bot):
+        self.data = data
+        self.bot = bot
+        self.message_id = data.get('message_id')
+        self.text = data.get('text', '')
+        self.voice = data.get('voice')
+        self.audio = data.get('audio')
+        self.document = data.get('document')
+        self.chat = TelegramChat(data['chat'])
+    
+    async def reply_text(self, text, reply_markup=None):
+        loop = asyncio.get_event_loop()
+        result = await loop.run_in_executor(
+            None, lambda: self.bot.send_message(self.chat.id, text, reply_markup)
+        )
+        return result
+    
+    async def reply_photo(self, photo, caption=None):
+        """Reply with photo via sendPhoto API"""
+        url = f"{self.bot.base_url}/sendPhoto"
+        try:
+            data = {
+                'chat_id': self.chat.id,
+                'photo': photo
+            }
+            if caption:
+                data['caption'] = caption
+            
+            response = await asyncio.get_event_loop().run_in_executor(
+                None, lambda: requests.post(url, json=data)
+            )
+            return response.json()
+        except Exception as e:
+            logger.error(f"Failed to send photo: {e}")
+            # Graceful fallback - send text message instead
+            fallback_text = f"🖼️ Rasm: {caption or 'Rasm yuborilmadi'}"
+            return await self.reply_text(fallback_text)
+
+class TelegramCallbackQuery:
+    """Inline tugma bosilganda keladigan callback query"""
+    __slots__ = ('bot', 'data', 'id', 'from_user', 'message')
+    
+    def __init__(self, data, bot):
+        self.bot = bot
+        self.data = data.get('data', '')  # Extract callback_data properly
+        self.id = data.get('id', '')
+        self.from_user = TelegramUser(data['from'])
+        self.message = data.get('message', {})
+    
+    async def answer(self):
+        """Answer callback query via answerCallbackQuery API"""
+        url = f"{self.bot.base_url}/answerCallbackQuery"
+        try:
+            loop = asyncio.get_event_loop()
+            response = await loop.run_in_executor(
+                None, lambda: requests.post(url, json={'callback_query_id': self.id})
+            )
+            return response.json()
+        except Exception as e:
+            logger.error(f"Failed to answer callback query: {e}")
+            return {'ok': False, 'error': str(e)}
+    
+    async def edit_message_text(self, text):
+        """Edit message text via editMessageText API"""
+        url = f"{self.bot.base_url}/editMessageText"
+        try:
+            data = {
+                'chat_id': self.message.get('chat', {}).get('id'),
+                'message_id': self.message.get('message_id'),
+                'text': text
+            }
+            loop = asyncio.get_event_loop()
+            response = await loop.run_in_executor(
+                None, lambda: requests.post(url, json=data)
+            )
+            return response.json()
+        except Exception as e:
+            logger.error(f"Failed to edit message text: {e}")
+            return {'ok': False, 'error': str(e)}
+
 class Update:
     """Lightweight Update class to avoid private imports"""
-    def __init__(self, data=None):
+    __slots__ = ('data', 'message', 'callback_query', 'effective_user', 'effective_chat')
+    
+    def __init__(self, data=None, bot=None):
         self.data = data
         self.message = None
         self.callback_query = None
         self.effective_user = None
         self.effective_chat = None
+        
+        if not data:
+            return
+        if 'message' in data:
+            message = data['message']
+            self.message = TelegramMessage(message, bot)
+            self.effective_user = TelegramUser(message['from'])
+            self.effective_chat = self.message.chat
+        elif 'callback_query' in data:
+            callback = data['callback_query']
+            self.callback_query = TelegramCallbackQuery(callback, bot)
+            self.effective_user = self.callback_query.from_user
+            self.effective_chat = TelegramChat(callback['message']['chat'])
+
+class CallbackContext:
+    """Handler ga uzatiladigan kontekst (buyruq argumentlari va bot)"""
+    __slots__ = ('args', 'bot')
+    
+    def __init__(self, bot=None, args=None):
+        self.bot = bot
+        self.args = args or []
 
 class InlineKeyboardButton:
     """Lightweight InlineKeyboardButton replacement"""
@@ -58,6 +213,8 @@ class TelegramHTTPBot:
         self.handlers = {}
         self.running = False
         self.base_url = f"https://api.telegram.org/bot{token}"
+        # Long polling uchun doimiy HTTP ulanish (keep-alive)
+        self.session = requests.Session()
         
     def add_handler(self, handler):
         if isinstance(handler, tuple):
@@ -112,14 +269,23 @@ class TelegramHTTPBot:
                 pass
             return None
     
-    def get_updates(self, offset=None):
+    def get_updates(self, offset=None, timeout=None, limit=None, allowed_updates=None):
+        """Long polling orqali yangi update larni olish"""
         url = f"{self.base_url}/getUpdates"
-        params = {'timeout': 10}
+        poll_timeout = TELEGRAM_POLL_TIMEOUT if timeout is None else timeout
+        params = {
+            'timeout': poll_timeout,
+            'limit': limit or TELEGRAM_POLL_LIMIT,
+            'allowed_updates': json.dumps(
+                TELEGRAM_ALLOWED_UPDATES if allowed_updates is None else allowed_updates
+            )
+        }
         if offset:
             params['offset'] = offset
             
         try:
-            response = requests.get(url, params=params)
+            # HTTP read timeout long poll vaqtidan biroz uzunroq bo'lishi kerak
+            response = self.session.get(url, params=params, timeout=(10, poll_timeout + 10))
             return response.json()
         except Exception as e:
             # Ultra-safe logging
@@ -129,158 +295,36 @@ class TelegramHTTPBot:
                 pass
             return {'ok': False, 'result': []}
             
+    def route_update(self, update):
+        """Update uchun handler kalitini va kontekstni aniqlash"""
+        message = update.message
+        if message:
+            # Handle voice messages first
+            if message.voice or message.audio:
+                return 'voice', CallbackContext(self)
+            text = message.text
+            if text:
+                if text[0] == '/':
+                    # "/start@MyBot arg1 arg2" -> "/start", ["arg1", "arg2"]
+                    parts = text.split()
+                    command = parts[0].split('@', 1)[0]
+                    return command, CallbackContext(self, parts[1:])
+                return 'message', CallbackContext(self)
+            return None, None
+        if update.callback_query:
+            return 'callback', CallbackContext(self)
+        return None, None
+    
     async def process_update(self, update_data):
-        # Create simplified Update object
-        class SimpleUpdate:
-            def __init__(self, data):
-                self.data = data
-                self.message = None
-                self.callback_query = None
-                self.effective_user = None
-                self.effective_chat = None
-                
-                if 'message' in data:
-                    self.message = SimpleMessage(data['message'])
-                    self.effective_user = SimpleUser(data['message']['from'])
-                    self.effective_chat = SimpleChat(data['message']['chat'])
-                elif 'callback_query' in data:
-                    self.callback_query = SimpleCallbackQuery(data['callback_query'])
-                    self.effective_user = SimpleUser(data['callback_query']['from'])
-                    self.effective_chat = SimpleChat(data['callback_query']['message']['chat'])
-        
-        class SimpleMessage:
-            def __init__(self, data):
-                self.data = data
-                self.text = data.get('text', '')
-                self.voice = data.get('voice')
-                self.audio = data.get('audio') 
-                self.document = data.get('document')
-                self.chat = SimpleChat(data['chat'])
-                
-            async def reply_text(self, text, reply_markup=None):
-                loop = asyncio.get_event_loop()
-                result = await loop.run_in_executor(
-                    None, lambda: bot_instance.send_message(self.chat.id, text, reply_markup)
-                )
-                return result
-            
-            async def reply_photo(self, photo, caption=None):
-                """Reply with photo via sendPhoto API"""
-                url = f"{bot_instance.base_url}/sendPhoto"
-                try:
-                    data = {
-                        'chat_id': self.chat.id,
-                        'photo': photo
-                    }
-                    if caption:
-                        data['caption'] = caption
-                    
-                    response = await asyncio.get_event_loop().run_in_executor(
-                        None, lambda: requests.post(url, json=data)
-                    )
-                    return response.json()
-                except Exception as e:
-                    logger.error(f"Failed to send photo: {e}")
-                    # Graceful fallback - send text message instead
-                    fallback_text = f"🖼️ Rasm: {caption or 'Rasm yuborilmadi'}"
-                    return await self.reply_text(fallback_text)
-        
-        class SimpleUser:
-            def __init__(self, data):
-                self.data = data
-                self.id = data['id']
-                self.username = data.get('username', '')
-                self.first_name = data.get('first_name', '')
-                
-        class SimpleChat:
-            def __init__(self, data):
-                self.data = data
-                self.id = data['id']
-                
-        class SimpleCallbackQuery:
-            def __init__(self, data):
-                self.data = data.get('data', '')  # Extract callback_data properly
-                self.id = data.get('id', '')
-                self.from_user = SimpleUser(data['from'])
-                self.message = data.get('message', {})
-                
-            async def answer(self):
-                """Answer callback query via answerCallbackQuery API"""
-                url = f"{bot_instance.base_url}/answerCallbackQuery"
-                try:
-                    loop = asyncio.get_event_loop()
-                    response = await loop.run_in_executor(
-                        None, lambda: requests.post(url, json={'callback_query_id': self.id})
-                    )
-                    return response.json()
-                except Exception as e:
-                    logger.error(f"Failed to answer callback query: {e}")
-                    return {'ok': False, 'error': str(e)}
-                
-            async def edit_message_text(self, text):
-                """Edit message text via editMessageText API"""
-                url = f"{bot_instance.base_url}/editMessageText"
-                try:
-                    data = {
-                        'chat_id': self.message.get('chat', {}).get('id'),
-                        'message_id': self.message.get('message_id'),
-                        'text': text
-                    }
-                    loop = asyncio.get_event_loop()
-                    response = await loop.run_in_executor(
-                        None, lambda: requests.post(url, json=data)
-                    )
-                    return response.json()
-                except Exception as e:
-                    logger.error(f"Failed to edit message text: {e}")
-                    return {'ok': False, 'error': str(e)}
-        
-        # Process update
-        update = SimpleUpdate(update_data)
-        
-        # Create context object
-        class SimpleContext:
-            def __init__(self, text=None, bot=None):
-                self.args = []
-                self.bot = bot  # Add bot reference
-                if text and text.startswith('/'):
-                    # Split command and arguments
-                    parts = text.split()[1:]  # Remove command itself
-                    self.args = parts
-        
-        # Handle voice messages first
-        if update.message and (update.message.voice or update.message.audio):
-            context = SimpleContext(None, self)
-            if 'voice' in self.handlers:
-                for handler in self.handlers['voice']:
+        update = Update(update_data, self)
+        handler_key, context = self.route_update(update)
+        # Read-your-writes: shu chat dagi yozuvdan keyin tarix primary dan o'qiladi
+        user = update.effective_user
+        key = f"telegram:{self.token.split(':', 1)[0]}:{user.id}" if user else None
+        with consistency_key(key):
+            for handler in self.handlers.get(handler_key, ()):
+                with query_scope(f"telegram:{handler_key}"):
                     await handler(update, context)
-        # Handle text commands and messages
-        elif update.message and update.message.text:
-            text = update.message.text
-            context = SimpleContext(text, self)
-            
-            if text.startswith('/'):
-                cmd = text.split()[0][1:]  # Remove '/'
-                if 'start' in self.handlers and cmd == 'start':
-                    for handler in self.handlers['start']:
-                        await handler(update, context)
-                elif 'help' in self.handlers and cmd == 'help':
-                    for handler in self.handlers['help']:
-                        await handler(update, context)
-                elif 'language' in self.handlers and cmd == 'language':
-                    for handler in self.handlers['language']:
-                        await handler(update, context)
-            else:
-                # Regular message
-                if 'message' in self.handlers:
-                    for handler in self.handlers['message']:
-                        await handler(update, context)
-        
-        # Handle callback queries
-        if update.callback_query and 'callback' in self.handlers:
-            context = SimpleContext()  # Empty context for callbacks
-            for handler in self.handlers['callback']:
-                await handler(update, context)
 
 class TelegramApplication:
     def __init__(self, token):
@@ -290,23 +334,28 @@ class TelegramApplication:
         self.bot.add_handler(handler)
         
     def run_polling(self):
-        # Simple polling implementation
+        # Long polling implementation
         offset = None
-        global bot_instance
-        bot_instance = self.bot
+        failures = 0
         
         logger.info("Starting bot polling...")
         while True:
             try:
                 updates = self.bot.get_updates(offset)
-                if updates.get('ok') and updates.get('result'):
-                    for update in updates['result']:
-                        asyncio.run(self.bot.process_update(update))
-                        offset = update['update_id'] + 1
-                        
-                # Small delay to prevent API spam
-                import time
-                time.sleep(1)
+                if not updates.get('ok'):
+                    failures += 1
+                    # Telegram 429 javobida retry_after ni hurmat qilish
+                    retry_after = (updates.get('parameters') or {}).get('retry_after')
+                    delay = retry_after if retry_after else polling_backoff(failures)
+                    time.sleep(delay)
+                    continue
+                
+                failures = 0
+                # Update lar kelgan bo'lsa darhol keyingi so'rovni yuborish (sleep yo'q),
+                # bo'sh javobda esa Telegram o'zi timeout gacha kutib turadi
+                for update in updates.get('result', []):
+                    asyncio.run(self.bot.process_update(update))
+                    offset = update['update_id'] + 1
                 
             except Exception as e:
                 # Ultra-safe logging
@@ -315,8 +364,8 @@ class TelegramApplication:
                     logger.error(f"Polling error: {error_safe}")
                 except:
                     logger.error("Polling error: encoding issue")
-                import time
-                time.sleep(5)
+                failures += 1
+                time.sleep(polling_backoff(failures))
 
 class Application:
     @staticmethod
@@ -333,7 +382,7 @@ class Application:
 
 # Handler creators
 def CommandHandler(command, func):
-    return (command, func)
+    return (f"/{command}", func)
 
 def MessageHandler(filters_obj, func):  
     return ('message', func)
@@ -590,7 +639,7 @@ class TelegramBot:
         
         get_ai_response, process_knowledge_base, User, Bot, ChatHistory, db, app = get_dependencies()
         
-        with app.app_context():
+        with app.app_context(), ExitStack() as request_cache:
             # Get user info
             db_user = User.query.filter_by(telegram_id=user_id).first()
             if not db_user:
@@ -611,6 +660,13 @@ class TelegramBot:
                     await update.message.reply_text("❌ Obunangiz tugagan! Iltimos, obunani yangilang.")
                 return
             
+            # Rate limit - transkripsiya va AI kvotasini himoya qilish
+            rate = check_message_rate(self.bot_id, f"tg:{user_id}", bot.owner.subscription_type if bot.owner else None)
+            if not rate.allowed:
+                if update.message:
+                    await update.message.reply_text(rate_limit_message(rate, db_user.language))
+                return
+            
             # Send typing indicator while processing
             try:
                 if update.effective_chat:
@@ -626,25 +682,38 @@ class TelegramBot:
                         await update.message.reply_text("❌ Ovoz fayli topilmadi!")
                     return
                 
-                # Get file info from Telegram API
-                file_info_url = f"{context.bot.base_url}/getFile"
-                file_info_response = requests.get(file_info_url, params={'file_id': file_id})
+                # file_unique_id barcha botlar uchun bir xil - forward qilingan audio ham
+                # qayta transkripsiya qilinmaydi
+                user_language = db_user.language
+                file_unique_id = voice_data.get('file_unique_id')
+                media_key = f"tg:{file_unique_id}" if file_unique_id else None
+                # Transkript va bilim bazasi - bitta round trip (MGET)
+                request_cache.enter_context(prefetch(
+                    *([cache_key("transcript", media_key, user_language)] if media_key else []),
+                    cache_key("kb", self.bot_id)
+                ))
+                transcribed_text = cached_transcript(media_key, user_language) if media_key else None
                 
-                if not file_info_response.json().get('ok'):
-                    if update.message:
-                        await update.message.reply_text("❌ Ovoz faylini olishda xatolik yuz berdi!")
-                    return
-                
-                file_path = file_info_response.json()['result']['file_path']
-                file_url = f"https://api.telegram.org/file/bot{context.bot.token}/{file_path}"
+                loop = asyncio.get_event_loop()
+                file_url = None
+                if not transcribed_text:
+                    # Get file info from Telegram API (cached file_id -> file_path)
+                    file_url = await loop.run_in_executor(
+                        None, lambda: get_telegram_file_url(context.bot.token, file_id, session=context.bot.session)
+                    )
+                    
+                    if not file_url:
+                        if update.message:
+                            await update.message.reply_text("❌ Ovoz faylini olishda xatolik yuz berdi!")
+                        return
                 
                 # Process the voice message using existing audio processor
                 try:
-                    # Run the synchronous audio processing in executor to avoid blocking
-                    loop = asyncio.get_event_loop()
-                    transcribed_text = await loop.run_in_executor(
-                        None, lambda: download_and_process_audio(file_url, db_user.language)
-                    )
+                    # Stream download + transcription in executor to avoid blocking
+                    if not transcribed_text:
+                        transcribed_text = await loop.run_in_executor(
+                            None, lambda: download_and_transcribe_audio(file_url, user_language, media_key=media_key)
+                        )
                     
                     if not transcribed_text or transcribed_text.strip() == "":
                         if update.message:
@@ -658,14 +727,15 @@ class TelegramBot:
                     # Process transcribed text as a regular message
                     # Get knowledge base
                     try:
-                        knowledge_base = process_knowledge_base(self.bot_id)
+                        knowledge_base = get_knowledge_base(self.bot_id, process_knowledge_base)
                         
                         # Get recent chat history
                         recent_history = ""
-                        history_entries = ChatHistory.query.filter_by(
-                            bot_id=self.bot_id, 
-                            user_telegram_id=user_id
-                        ).order_by(ChatHistory.created_at.desc()).limit(3).all()
+                        with read_replica():
+                            history_entries = ChatHistory.query.filter_by(
+                                bot_id=self.bot_id, 
+                                user_telegram_id=user_id
+                            ).order_by(ChatHistory.created_at.desc()).limit(3).all()
                         
                         if history_entries:
                             history_parts = []
@@ -749,7 +819,8 @@ class TelegramBot:
         get_ai_response, process_knowledge_base, User, Bot, ChatHistory, db, app = get_dependencies()
         logger.info("DEBUG: Dependencies loaded")
         
-        with app.app_context():
+        # Bilim bazasi kesh kaliti handler boshida bitta round trip da (L1 da bo'lsa - Redis ga bormaydi)
+        with app.app_context(), prefetch(cache_key("kb", self.bot_id)):
             # Get user info
             db_user = User.query.filter_by(telegram_id=user_id).first()
             if not db_user:
@@ -770,6 +841,25 @@ class TelegramBot:
             
             logger.info("DEBUG: Bot found")
             
+            # Recent chat history (lighter operation) - BotCustomer yozuvidan OLDIN: commit dan keyin
+            # read-your-writes bu chatning o'qishlarini primary ga yo'naltiradi, replika ishlatilmay qoladi
+            recent_history = ""
+            try:
+                with read_replica():
+                    history_entries = ChatHistory.query.filter_by(
+                        bot_id=self.bot_id, 
+                        user_telegram_id=user_id
+                    ).order_by(ChatHistory.created_at.desc()).limit(3).all()  # Reduced from 5 to 3 for speed
+                
+                if history_entries:
+                    history_parts = []
+                    for entry in reversed(history_entries):
+                        history_parts.append(f"Foydalanuvchi: {entry.message}")
+                        history_parts.append(f"Bot: {entry.response}")
+                    recent_history = "\n".join(history_parts)
+            except Exception as hist_error:
+                logger.error(f"Chat history retrieval error: {str(hist_error)[:100]}")
+            
             # Track customer interaction
             try:
                 from models import BotCustomer
@@ -818,6 +908,13 @@ class TelegramBot:
             
             logger.info("DEBUG: Subscription active")
             
+            # Rate limit - AI kvotasini himoya qilish
+            rate = check_message_rate(self.bot_id, f"tg:{user_id}", bot.owner.subscription_type if bot.owner else None)
+            if not rate.allowed:
+                if update.message:
+                    await update.message.reply_text(rate_limit_message(rate, db_user.language))
+                return
+            
             # Send typing indicator while processing
             try:
                 if update.effective_chat:
@@ -825,29 +922,14 @@ class TelegramBot:
             except Exception:
                 pass
             
-            # Get knowledge base and chat history in parallel for faster processing
+            # Knowledge base (chat history yuqorida, yozuvdan oldin o'qilgan)
             try:
-                # Optimize: Get recent chat history first (lighter operation)
-                recent_history = ""
-                history_entries = ChatHistory.query.filter_by(
-                    bot_id=self.bot_id, 
-                    user_telegram_id=user_id
-                ).order_by(ChatHistory.created_at.desc()).limit(3).all()  # Reduced from 5 to 3 for speed
-                
-                if history_entries:
-                    history_parts = []
-                    for entry in reversed(history_entries):
-                        history_parts.append(f"Foydalanuvchi: {entry.message}")
-                        history_parts.append(f"Bot: {entry.response}")
-                    recent_history = "\n".join(history_parts)
-                
                 # Get knowledge base (potentially slower operation)
-                knowledge_base = process_knowledge_base(self.bot_id)
+                knowledge_base = get_knowledge_base(self.bot_id, process_knowledge_base)
                 logger.info("DEBUG: Knowledge base and history processed")
                 
-            except Exception as hist_error:
-                logger.error(f"Chat history/knowledge retrieval error: {str(hist_error)[:100]}")
-                recent_history = ""
+            except Exception as kb_error:
+                logger.error(f"Knowledge base retrieval error: {str(kb_error)[:100]}")
                 knowledge_base = ""
 
             # Send typing indicator again before AI call
@@ -1029,21 +1111,8 @@ class TelegramBot:
     
     async def _get_telegram_file_url(self, file_id):
         """Get file URL from Telegram API"""
-        try:
-            url = f"https://api.telegram.org/bot{self.bot_token}/getFile"
-            response = requests.get(url, params={'file_id': file_id})
-            data = response.json()
-            
-            if data.get('ok') and 'result' in data:
-                file_path = data['result']['file_path']
-                return f"https://api.telegram.org/file/bot{self.bot_token}/{file_path}"
-            else:
-                logger.error(f"Telegram getFile API error: {data}")
-                return None
-                
-        except Exception as e:
-            logger.error(f"Error getting Telegram file URL: {str(e)}")
-            return None
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(None, lambda: get_telegram_file_url(self.bot_token, file_id))
     
     def run(self):
         """Start the bot"""
@@ -1159,7 +1228,14 @@ def start_bot_automatically(bot_id, bot_token):
         return False
 
 def process_webhook_update(bot_id, bot_token, update_data):
-    """Webhook orqali kelgan update ni qayta ishlash"""
+    """Webhook orqali kelgan update ni qayta ishlash (polling handlerlari kabi query_scope ichida)"""
+    handler_key = 'callback' if 'callback_query' in update_data else 'message'
+    # Xabar uchun o'qiladigan kesh kalitlari bitta round trip da (L1 da bo'lsa - Redis ga bormaydi)
+    cache_keys = [cache_key("kb", bot_id)] if handler_key == 'message' else []
+    with query_scope(f"telegram:webhook:{handler_key}"), prefetch(*cache_keys):
+        return _process_webhook_update(bot_id, bot_token, update_data)
+
+def _process_webhook_update(bot_id, bot_token, update_data):
     try:
         # Dependencies ni olish
         get_ai_response, process_knowledge_base, User, Bot, ChatHistory, db, app = get_dependencies()
@@ -1217,14 +1293,16 @@ def process_webhook_update(bot_id, bot_token, update_data):
                     send_webhook_message(bot_token, chat_id, lang_msg)
                     return True
                     
+                # Rate limit - AI kvotasini himoya qilish
+                rate = check_message_rate(bot_id, f"tg:{user_id}", bot.owner.subscription_type if bot.owner else None)
+                if not rate.allowed:
+                    send_webhook_message(bot_token, chat_id, rate_limit_message(rate, telegram_user.language))
+                    return True
+                    
                 # AI javob olish
                 try:
-                    # Bilim bazasini olish
-                    knowledge_base = ""
-                    if hasattr(bot, 'knowledge_base') and bot.knowledge_base:
-                        for kb in bot.knowledge_base:
-                            if kb.content:
-                                knowledge_base += f"{kb.content}\n\n"
+                    # Bilim bazasini olish (keshdan - polling handlerlari kabi)
+                    knowledge_base = get_knowledge_base(bot_id, process_knowledge_base) or ""
                                 
                     # Suhbat tarixini olish
                     chat_history = ""
@@ -8,11 +8,8 @@ from telegram_bot import TelegramBotHandler, get_dependencies
 
 # Import async tasks
 from tasks import generate_ai_response, save_chat_history
-from redis_cache import (
-    cached_knowledge_base, cache_knowledge_base, 
-    cached_user_context, cache_user_context,
-    rate_limit_check
-)
+from redis_cache import prefetch, cache_key, cached_user_context, cache_user_context
+from rate_limiter import check_message_rate, rate_limit_message
 
 logger = logging.getLogger(__name__)
 
@@ -35,13 +32,6 @@ class AsyncTelegramBotHandler(TelegramBotHandler):
         if not message_text:
             return
         
-        # Rate limiting check
-        if not rate_limit_check(int(user_id), limit=5, window=60):
-            await update.message.reply_text(
-                "⚠️ Juda ko'p xabar yuboryapsiz. Iltimos, bir oz kuting."
-            )
-            return
-        
         # Send immediate typing indicator
         try:
             await context.bot.send_chat_action(chat_id=chat_id, action='typing')
@@ -50,7 +40,8 @@ class AsyncTelegramBotHandler(TelegramBotHandler):
         
         get_ai_response, process_knowledge_base, User, Bot, ChatHistory, db, app = get_dependencies()
         
-        with app.app_context():
+        # Foydalanuvchi konteksti - so'rov boshida bitta round trip da
+        with app.app_context(), prefetch(cache_key("user", int(user_id), self.bot_id)):
             # Check cache for user context first
             user_context = cached_user_context(int(user_id), self.bot_id)
             
@@ -72,10 +63,17 @@ class AsyncTelegramBotHandler(TelegramBotHandler):
                     'user_id': db_user.id,
                     'language': db_user.language,
                     'subscription_active': db_user.subscription_active(),
-                    'bot_name': bot.name
+                    'bot_name': bot.name,
+                    'plan': bot.owner.subscription_type if bot.owner else None
                 }
                 cache_user_context(int(user_id), self.bot_id, user_context)
             
+            # Rate limiting check (bot egasining ta'rifi bo'yicha)
+            rate = check_message_rate(self.bot_id, f"tg:{user_id}", user_context.get('plan'))
+            if not rate.allowed:
+                await update.message.reply_text(rate_limit_message(rate, user_context.get('language')))
+                return
+            
             # Check subscription
             if not user_context.get('subscription_active'):
                 await update.message.reply_text("❌ Obunangiz tugagan! Iltimos, obunani yangilang.")
@@ -87,14 +85,6 @@ class AsyncTelegramBotHandler(TelegramBotHandler):
                 reply_to_message_id=update.message.message_id
             )
             
-            # Get cached knowledge base
-            knowledge_base = cached_knowledge_base(self.bot_id)
-            if not knowledge_base:
-                # Process and cache knowledge base
-                knowledge_base = process_knowledge_base(self.bot_id)
-                if knowledge_base:
-                    cache_knowledge_base(self.bot_id, knowledge_base)
-            
             # Get recent chat history (optimized query)
             recent_history = ""
             try:
@@ -120,7 +110,7 @@ class AsyncTelegramBotHandler(TelegramBotHandler):
                     user_context['user_id'], 
                     chat_id, 
                     message_text
-                ])
+                ], kwargs={'bot_id': self.bot_id})
             except Exception as e:
                 logger.error(f"Failed to save chat history: {e}")
             
@@ -130,11 +120,11 @@ class AsyncTelegramBotHandler(TelegramBotHandler):
                     message_text,
                     user_context.get('bot_name', 'Bot'),
                     user_context.get('language', 'uz'),
-                    knowledge_base or "",
+                    "",  # bilim bazasi workerda bot_id bo'yicha keshdan olinadi
                     recent_history,
                     chat_id,
                     user_context['user_id']
-                ])
+                ], kwargs={'bot_id': self.bot_id})
                 
                 logger.info(f"AI task queued: {task.id} for chat {chat_id}")
                 
@@ -154,16 +144,9 @@ class AsyncTelegramBotHandler(TelegramBotHandler):
         user_id = str(update.effective_user.id)
         chat_id = update.effective_chat.id
         
-        # Rate limiting
-        if not rate_limit_check(int(user_id), limit=3, window=60):
-            await update.message.reply_text(
-                "⚠️ Juda ko'p ovozli xabar yuboryapsiz. Iltimos, bir oz kuting."
-            )
-            return
-        
         get_ai_response, process_knowledge_base, User, Bot, ChatHistory, db, app = get_dependencies()
         
-        with app.app_context():
+        with app.app_context(), prefetch(cache_key("user", int(user_id), self.bot_id)):
             # Check user context (cached)
             user_context = cached_user_context(int(user_id), self.bot_id)
             
@@ -181,9 +164,16 @@ class AsyncTelegramBotHandler(TelegramBotHandler):
                 user_context = {
                     'user_id': db_user.id,
                     'language': db_user.language,
-                    'bot_name': bot.name if bot else 'Bot'
+                    'bot_name': bot.name if bot else 'Bot',
+                    'plan': bot.owner.subscription_type if bot and bot.owner else None
                 }
             
+            # Rate limiting (transkripsiya + AI ham kvotadan)
+            rate = check_message_rate(self.bot_id, f"tg:{user_id}", user_context.get('plan'))
+            if not rate.allowed:
+                await update.message.reply_text(rate_limit_message(rate, user_context.get('language')))
+                return
+            
             # Send immediate feedback
             processing_msg = await update.message.reply_text(
                 "🎤 Ovozli xabaringizni qayta ishlamoqdaman...",
@@ -202,7 +192,11 @@ class AsyncTelegramBotHandler(TelegramBotHandler):
                     file_url,
                     chat_id,
                     user_context['user_id']
-                ])
+                ], kwargs={
+                    'bot_id': self.bot_id,
+                    'bot_name': user_context.get('bot_name', 'Bot'),
+                    'user_language': user_context.get('language', 'uz')
+                })
                 
                 logger.info(f"Audio processing task queued: {task.id}")
                 
@@ -6,6 +6,7 @@ from datetime import datetime, timedelta
 from werkzeug.utils import secure_filename
 from models import User, Payment, Bot, ChatHistory
 from app import db
+from db_routing import read_replica
 
 def allowed_file(filename: str) -> bool:
     """Check if file extension is allowed"""
@@ -91,8 +92,20 @@ def check_subscription_expiry() -> None:
         
         session.commit()
 
+@read_replica()
 def get_user_stats() -> Dict[str, int]:
-    """Get user statistics"""
+    """Get user statistics (from the plan rollup when it is populated)"""
+    from stats_rollup import plan_user_counts
+    plans = plan_user_counts()
+    if plans:
+        return {
+            'total_users': sum(users for users, _ in plans.values()),
+            'free_users': plans.get('free', (0, 0))[0],
+            'basic_users': plans.get('basic', (0, 0))[0],
+            'premium_users': plans.get('premium', (0, 0))[0],
+            'active_users': sum(active for _, active in plans.values())
+        }
+    
     return {
         'total_users': User.query.count(),
         'free_users': User.query.filter_by(subscription_type='free').count(),
@@ -101,8 +114,21 @@ def get_user_stats() -> Dict[str, int]:
         'active_users': User.query.filter_by(is_active=True).count()
     }
 
+@read_replica()
 def get_payment_stats() -> Dict[str, Union[float, int]]:
-    """Get payment statistics"""
+    """Get payment statistics (from the daily payment rollup when it is populated)"""
+    from stats_rollup import payment_totals
+    total_payments, total_revenue = payment_totals()
+    pending_payments, _ = payment_totals(status='pending')
+    if total_payments or pending_payments:
+        _, monthly_revenue = payment_totals(since=datetime.utcnow() - timedelta(days=30))
+        return {
+            'total_revenue': total_revenue,
+            'monthly_revenue': monthly_revenue,
+            'total_payments': total_payments,
+            'pending_payments': pending_payments
+        }
+    
     total_revenue = db.session.query(db.func.sum(Payment.amount)).filter_by(status='completed').scalar() or 0
     monthly_revenue = db.session.query(db.func.sum(Payment.amount)).filter(
         Payment.status == 'completed',
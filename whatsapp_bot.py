@@ -8,6 +8,8 @@ from flask import Blueprint, request, jsonify, url_for
 from app import db, app
 from models import User, Bot, ChatHistory
 from ai import get_ai_response, process_knowledge_base
+from redis_cache import get_knowledge_base
+from rate_limiter import check_message_rate, rate_limit_message
 from audio_processor import download_and_process_audio
 
 # Configure logging
@@ -251,8 +253,14 @@ Yangi obunani BotFactory.uz saytidan sotib oling.
                     )
                     return True
                 
+                # Rate limit - AI kvotasini himoya qilish
+                rate = check_message_rate(self.bot_id, f"wa:{from_number}", bot.owner.subscription_type if bot.owner else None)
+                if not rate.allowed:
+                    self.send_message(from_number, rate_limit_message(rate, user.language))
+                    return True
+                
                 # AI javobini olish
-                knowledge_base = process_knowledge_base(self.bot_id)
+                knowledge_base = get_knowledge_base(self.bot_id, process_knowledge_base)
                 
                 ai_response = get_ai_response(
                     message=message_text,
@@ -343,6 +351,12 @@ Yangi obunani BotFactory.uz saytidan sotib oling.
                     self.send_message(from_number, "❌ Obunangiz tugagan! Iltimos, obunani yangilang.")
                     return False
                 
+                # Rate limit - transkripsiya va AI kvotasini himoya qilish
+                rate = check_message_rate(self.bot_id, f"wa:{from_number}", bot.owner.subscription_type if bot.owner else None)
+                if not rate.allowed:
+                    self.send_message(from_number, rate_limit_message(rate, db_user.language))
+                    return True
+                
                 # Determine file extension from mime type
                 file_ext = '.ogg'
                 if 'mp4' in mime_type:
@@ -357,7 +371,9 @@ Yangi obunani BotFactory.uz saytidan sotib oling.
                     audio_url=audio_url,
                     user_id=from_number,
                     language=db_user.language,
-                    file_extension=file_ext
+                    file_extension=file_ext,
+                    headers={'Authorization': f'Bearer {self.access_token}'},  # WhatsApp media URL token talab qiladi
+                    media_key=f"wa:{audio_id}"
                 )
                 
                 # Extract the text part and AI response